@@ -4,34 +4,114 @@ app/handlers/mail.py
 Хендлеры для команд и уведомлений, связанных с почтой
 """
 import logging
-from typing import Dict, Any
+from html import escape
+from typing import Dict, Any, List
 
-from aiogram import Bot
+from aiogram import Bot, F, Router
+from aiogram.types import CallbackQuery
 
 from lexicon.lexicon import LEXICON
 from config.config import load_config
+from database.database import Database
+from services.attachment_cache import AttachmentCache, AttachmentTooLargeForTelegram
+from services.mail_service import list_attachments_async
+from services.metrics import NOTIFICATIONS, NOTIFICATION_SEND_SECONDS
+from services.throttling import ServerThrottled
 
 logger = logging.getLogger(__name__)
 config = load_config()
 
+mail_router = Router()
 
-async def notify_user_new_email(telegram_id: int, mail_dict: Dict[str, Any], bot: Bot):
-    """Отправляет уведомление пользователю о новом письме"""
+
+def format_new_email(mail_dict: Dict[str, Any]) -> str:
+    """Текст уведомления об одном письме (экранирован для ParseMode.HTML)"""
+    # Формируем сообщение о новом письме
+    message_text = f"📧 Новое письмо:\n\n" \
+                  f"От: {escape(str(mail_dict.get('from', 'Неизвестно')))}\n" \
+                  f"Тема: {escape(str(mail_dict.get('subject', 'Без темы')))}\n" \
+                  f"Дата получения: {mail_dict.get('datetime_received', 'Неизвестна')}\n"
+    
+    if mail_dict.get('has_attachments'):
+        attachments_info = ", ".join([escape(str(att.get('name', 'Неизвестно'))) for att in mail_dict.get('attachments', [])])
+        message_text += f"Вложения: {attachments_info}\n"
+    if mail_dict.get('preview'):
+        # Начало текста письма (MAIL_PREVIEW_CHARS), уже обрезано и без HTML
+        message_text += f"\n<i>{escape(mail_dict['preview'])}</i>\n"
+    return message_text
+
+
+def format_digest(mails: List[Dict[str, Any]]) -> str:
+    """Текст одного сводного уведомления о нескольких письмах (экранирован для ParseMode.HTML)"""
+    message_text = f"📬 Новых писем: {len(mails)}\n\n"
+    for mail_dict in mails:
+        # Без превью: сводка до digest_max_items писем должна уложиться в одно сообщение
+        message_text += f"📧 {escape(str(mail_dict.get('subject', 'Без темы')))}\n" \
+                        f"От: {escape(str(mail_dict.get('from', 'Неизвестно')))}\n\n"
+    return message_text
+
+
+def build_notification(telegram_id: int, mails: List[Dict[str, Any]], mail_actions=None):
+    """
+    Возвращает (текст, клавиатура) уведомления: обычное для одного письма, сводное — для нескольких.
+    Если передан mail_actions (MailActionBatcher) — добавляет кнопки действий с письмами.
+    """
+    message_text = format_new_email(mails[0]) if len(mails) == 1 else format_digest(mails)
+    reply_markup = mail_actions.keyboard(telegram_id, mails) if mail_actions else None
+    return message_text, reply_markup
+
+
+async def notify_user_new_email(telegram_id: int, mail_dict: Dict[str, Any], bot: Bot, mail_actions=None):
+    """
+    Отправляет уведомление пользователю о новом письме.
+    Если передан mail_actions (MailActionBatcher) — добавляет кнопки действий с письмом.
+    """
     try:
-        # Формируем сообщение о новом письме
-        message_text = f"📧 Новое письмо:\n\n" \
-                      f"От: {mail_dict.get('from', 'Неизвестно')}\n" \
-                      f"Тема: {mail_dict.get('subject', 'Без темы')}\n" \
-                      f"Дата получения: {mail_dict.get('datetime_received', 'Неизвестна')}\n"
-        
-        if mail_dict.get('has_attachments'):
-            attachments_info = ", ".join([att.get('name', 'Неизвестно') for att in mail_dict.get('attachments', [])])
-            message_text += f"Вложения: {attachments_info}\n"
-        
-        await bot.send_message(telegram_id, message_text)
+        message_text, reply_markup = build_notification(telegram_id, [mail_dict], mail_actions)
+        with NOTIFICATION_SEND_SECONDS.time():
+            await bot.send_message(telegram_id, message_text, reply_markup=reply_markup)
+        NOTIFICATIONS.inc("sent")
         logger.info(f"Notification sent to user {telegram_id}: {message_text}")
     except Exception as e:
         logger.error(f"Error sending notification to user {telegram_id}: {e}")
+        NOTIFICATIONS.inc("error")
+
+
+@mail_router.callback_query(F.data.startswith('mail:'))
+async def process_mail_action_press(callback: CallbackQuery, mail_actions):
+    # callback_data: mail:<действие>:<токен письма>
+    _, action, token = callback.data.split(':', 2)
+    accepted = await mail_actions.submit(callback.from_user.id, action, token)
+    await callback.answer(text=LEXICON['mail_action_accepted' if accepted else 'mail_action_expired'])
+
+
+@mail_router.callback_query(F.data.startswith('files:'))
+async def process_mail_files_press(callback: CallbackQuery, bot: Bot, db: Database, mail_actions, attachment_cache: AttachmentCache):
+    # callback_data: files:<токен письма>; файлы приходят отдельными сообщениями
+    items = await mail_actions.items(callback.from_user.id, callback.data.split(':', 1)[1])
+    user_data = await db.get_user(callback.from_user.id) if items else None
+    if not user_data:
+        await callback.answer(text=LEXICON['mail_action_expired'])
+        return
+    await callback.answer(text=LEXICON['mail_files_sending'])
+
+    chat_id = callback.from_user.id
+    try:
+        attachments = await list_attachments_async(
+            user_data['login'], user_data['password'], items, config.mail.server, config.mail.verify_ssl
+        )
+        if not attachments:
+            await bot.send_message(chat_id, LEXICON['mail_files_empty'])
+        for attachment in attachments:
+            try:
+                await attachment_cache.send(bot, chat_id, user_data, attachment, config.mail.server, config.mail.verify_ssl)
+            except AttachmentTooLargeForTelegram:
+                await bot.send_message(chat_id, LEXICON['mail_files_too_large'].format(name=attachment['name']))
+    except ServerThrottled as e:
+        await bot.send_message(chat_id, LEXICON['server_busy'].format(minutes=max(1, round(e.retry_after / 60))))
+    except Exception as e:
+        logger.error(f"Error sending attachments to user {chat_id}: {e}")
+        await bot.send_message(chat_id, LEXICON['mail_files_error'])
 
 
 # Здесь также должны быть обработчики для команды проверки почты
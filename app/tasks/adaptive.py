@@ -0,0 +1,57 @@
+"""
+app/tasks/adaptive.py
+
+Адаптивный интервал опроса пользователя.
+Интервал зависит от того, как часто пользователю приходит почта (mail_rate, писем в час)
+и когда он последний раз писал боту (last_seen_at):
+- недавно активные в боте пользователи опрашиваются с минимальным интервалом;
+- чем больше писем в час, тем чаще опрос; для не «спящих» пользователей интервал
+  не больше max_latency (максимальная задержка уведомления);
+- «спящие» пользователи (давно не заходили и почти не получают почту) попадают в медленный уровень.
+"""
+import math
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from config.config import PollerSettings
+
+# За сколько часов наблюдений сглаживается оценка частоты писем
+RATE_WINDOW_HOURS = 24
+# Ниже этой частоты (писем в час) пользователь может считаться «спящим»
+DORMANT_RATE = 0.05
+
+
+class AdaptiveIntervals:
+    def __init__(self, settings: PollerSettings):
+        self.settings = settings
+
+    def interval(self, user_data: Dict[str, Any], now: datetime) -> float:
+        """Интервал до следующего опроса пользователя, секунд"""
+        settings = self.settings
+        last_seen_at: Optional[datetime] = user_data.get("last_seen_at")
+        rate = user_data.get("mail_rate") or 0.0
+
+        if last_seen_at and now - last_seen_at <= timedelta(seconds=settings.interactive_window):
+            return settings.min_interval
+
+        if (
+            rate < DORMANT_RATE
+            and (last_seen_at is None or now - last_seen_at >= timedelta(days=settings.dormant_after_days))
+        ):
+            return settings.dormant_interval
+
+        # Ожидаемое число писем за интервал держим около одного
+        interval = settings.max_latency / (1 + rate * settings.max_latency / 3600)
+        return max(settings.min_interval, min(interval, settings.max_latency))
+
+    @staticmethod
+    def update_rate(user_data: Dict[str, Any], new_emails: int, now: datetime) -> float:
+        """Экспоненциально сглаженная оценка частоты писем (в час) с учётом времени с прошлого опроса"""
+        rate = user_data.get("mail_rate") or 0.0
+        last_polled_at: Optional[datetime] = user_data.get("last_polled_at")
+        if last_polled_at is None:
+            return rate
+        elapsed_hours = max((now - last_polled_at).total_seconds() / 3600, 1 / 60)
+        observed = new_emails / elapsed_hours
+        weight = 1 - math.exp(-elapsed_hours / RATE_WINDOW_HOURS)
+        return rate + weight * (observed - rate)
@@ -0,0 +1,106 @@
+"""
+app/tasks/leases.py
+
+Очередь пользователей для режима нескольких poller'ов (POLLER_MODE=lease).
+Каждый экземпляр арендует в общей базе пачки пользователей, которых пора опрашивать,
+держит их в своей локальной куче, продлевает аренду, пока они у него, и отпускает после опроса.
+Если экземпляр упал, его аренды истекают через lease_seconds и пользователей забирают другие.
+Аренда выдаётся атомарным UPDATE ... RETURNING, поэтому один ящик не опрашивается дважды.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional
+
+from database.database import Database
+from app.tasks.scheduler import UserScheduler
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseScheduler(UserScheduler):
+    def __init__(
+        self,
+        db: Database,
+        owner: str,
+        lease_seconds: float = 60,
+        batch_size: int = 50,
+        max_leased: int = 500,
+        interactive_interval: Optional[float] = None,
+    ):
+        super().__init__(db, interactive_interval=interactive_interval)
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.max_leased = max_leased
+        self._lease_task: Optional[asyncio.Task] = None
+
+    async def _load(self):
+        self._wakeup = asyncio.Event()
+        self._active_count = await self.db.count_active_users()
+        self.db.listeners.append(self.on_user_changed)
+        self._loaded = True
+        self._lease_task = asyncio.create_task(self._lease_loop())
+        logger.info("Lease scheduler %s started (%d active users in total)", self.owner, self._active_count)
+
+    async def _lease_loop(self):
+        # Аренды продлеваются и добираются три раза за время жизни аренды
+        period = self.lease_seconds / 3
+        while True:
+            try:
+                await self._renew_and_claim()
+            except Exception as e:
+                logger.error(f"Lease loop error for {self.owner}: {e}")
+            await asyncio.sleep(period)
+
+    async def _renew_and_claim(self):
+        now = datetime.utcnow()
+        lease_until = now + timedelta(seconds=self.lease_seconds)
+        await self.db.renew_leases(self.owner, lease_until)
+
+        capacity = self.max_leased - len(self._users)
+        if capacity > 0:
+            # Берём тех, кого пора опрашивать до следующего продления
+            due_before = now + timedelta(seconds=self.lease_seconds / 3)
+            claimed = await self.db.claim_leases(self.owner, lease_until, due_before, min(self.batch_size, capacity))
+            for telegram_id, user in claimed.items():
+                if telegram_id in self._users:
+                    continue
+                self._users[telegram_id] = user
+                self._push(telegram_id)
+            if claimed:
+                logger.debug("%s leased %d users", self.owner, len(claimed))
+
+        self._active_count = await self.db.count_active_users()
+
+    def on_user_changed(self, telegram_id: int, fields: Dict[str, Any]):
+        # Изменения пользователей, которых этот экземпляр не арендовал, локально не отслеживаются
+        if telegram_id not in self._users:
+            return
+        active_count = self._active_count
+        super().on_user_changed(telegram_id, fields)
+        # Общее число активных берём из базы, а не из локальной кучи
+        self._active_count = active_count
+
+    def release(self, telegram_id: int):
+        """После опроса отпускает аренду: следующий опрос может выполнить любой экземпляр"""
+        self._in_flight.discard(telegram_id)
+        self._entries.pop(telegram_id, None)
+        self._users.pop(telegram_id, None)
+        if telegram_id in self._poked:
+            self._poked.discard(telegram_id)
+            self.db.update_user(telegram_id, next_poll_at=datetime.utcnow())
+        self.db.release_lease(telegram_id, self.owner)
+
+    def poke(self, telegram_id: int):
+        if telegram_id in self._users:
+            super().poke(telegram_id)
+        else:
+            # Пользователь не у нас — отмечаем в общей базе, его заберёт ближайший свободный экземпляр
+            self.db.update_user(telegram_id, next_poll_at=datetime.utcnow())
+
+    async def close(self):
+        """Останавливает продление и отпускает все аренды экземпляра"""
+        if self._lease_task:
+            self._lease_task.cancel()
+        await self.db.release_all_leases(self.owner)
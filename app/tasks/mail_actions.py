@@ -0,0 +1,155 @@
+"""
+app/tasks/mail_actions.py
+
+Накопление действий с письмами из Telegram (прочитано / в спам / удалить)
+и их пакетная отправка в EWS: действия пользователя собираются в течение
+короткого окна и применяются одним запросом на тип действия.
+Токены кнопок сохраняются в базе, поэтому кнопки из уведомлений, отправленных
+отдельным процессом poller'а, работают и в процессе бота.
+"""
+import asyncio
+import json
+import logging
+import secrets
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+
+from aiogram.types import InlineKeyboardMarkup
+
+from config.config import Config
+from database.database import Database
+from keyboards.keyboards import create_mail_actions_kb
+from lexicon.lexicon import LEXICON
+from services.mail_service import MAIL_ACTIONS, apply_mail_actions_async
+
+logger = logging.getLogger(__name__)
+
+# Сколько писем помнить в памяти для кнопок (EWS id не помещается в callback_data, поэтому храним короткий токен)
+MAX_TOKENS = 10000
+# Сколько дней кнопки уведомлений остаются рабочими
+TOKEN_TTL_DAYS = 7
+
+
+class MailActionBatcher:
+    def __init__(self, db: Database, config: Config, bot=None, unread_cache=None):
+        self.db = db
+        self.config = config
+        self.bot = bot
+        # Кэш /check_mail: после действий с письмами список непрочитанных нужно получить заново
+        self.unread_cache = unread_cache
+        # токен -> (telegram_id, [(item_id, changekey), ...]); у сводного уведомления один токен на все письма
+        self._tokens: "OrderedDict[str, Tuple[int, List[Tuple[str, Optional[str]]]]]" = OrderedDict()
+        self._tokens_saved = 0
+        # telegram_id -> item_id -> (changekey, действие)
+        self._pending: Dict[int, Dict[str, Tuple[Optional[str], str]]] = {}
+        self._flush_tasks: Dict[int, asyncio.Task] = {}
+
+    def keyboard(self, telegram_id: int, mails: List[Dict[str, Any]]) -> Optional[InlineKeyboardMarkup]:
+        """Регистрирует письма уведомления и возвращает клавиатуру с действиями над ними"""
+        items = [(mail_dict["id"], mail_dict.get("changekey")) for mail_dict in mails if mail_dict.get("id")]
+        if not items:
+            return None
+        # Случайный токен: кнопки могут создавать несколько процессов одновременно
+        token = secrets.token_hex(6)
+        self._remember(token, telegram_id, items)
+        self.db.save_action_token(token, telegram_id, json.dumps(items))
+        self._tokens_saved += 1
+        if self._tokens_saved % MAX_TOKENS == 0:
+            self.db.delete_old_action_tokens(datetime.utcnow() - timedelta(days=TOKEN_TTL_DAYS))
+        return create_mail_actions_kb(token, attachments=any(mail_dict.get("has_attachments") for mail_dict in mails))
+
+    def _remember(self, token: str, telegram_id: int, items: List[Tuple[str, Optional[str]]]):
+        self._tokens[token] = (telegram_id, items)
+        while len(self._tokens) > MAX_TOKENS:
+            self._tokens.popitem(last=False)
+
+    async def _lookup(self, token: str) -> Optional[Tuple[int, List[Tuple[str, Optional[str]]]]]:
+        """Ищет токен в памяти, затем в базе (кнопку мог создать другой процесс)"""
+        target = self._tokens.get(token)
+        if target is not None:
+            return target
+        row = await self.db.get_action_token(token)
+        if row is None:
+            return None
+        items = [tuple(item) for item in json.loads(row[1])]
+        self._remember(token, row[0], items)
+        return row[0], items
+
+    async def items(self, telegram_id: int, token: str) -> Optional[List[Tuple[str, Optional[str]]]]:
+        """Письма кнопки (item_id, changekey) или None, если кнопка устарела или чужая"""
+        target = await self._lookup(token)
+        if target is None or target[0] != telegram_id:
+            return None
+        return target[1]
+
+    async def submit(self, telegram_id: int, action: str, token: str) -> bool:
+        """
+        Ставит действие в очередь пользователя. Возвращает False, если кнопка устарела.
+        Последнее действие над письмом заменяет предыдущее.
+        """
+        if action not in MAIL_ACTIONS:
+            return False
+        items = await self.items(telegram_id, token)
+        if items is None:
+            return False
+        pending = self._pending.setdefault(telegram_id, {})
+        for item_id, changekey in items:
+            pending[item_id] = (changekey, action)
+
+        if telegram_id not in self._flush_tasks:
+            self._flush_tasks[telegram_id] = asyncio.create_task(self._flush_later(telegram_id))
+        return True
+
+    async def _flush_later(self, telegram_id: int):
+        try:
+            await asyncio.sleep(self.config.mail.actions_window)
+        finally:
+            self._flush_tasks.pop(telegram_id, None)
+        await self.flush(telegram_id)
+
+    async def flush(self, telegram_id: int):
+        """Отправляет накопленные действия пользователя в EWS и присылает одно общее подтверждение"""
+        pending = self._pending.pop(telegram_id, None)
+        if not pending:
+            return
+
+        actions: Dict[str, List[Tuple[str, Optional[str]]]] = {}
+        for item_id, (changekey, action) in pending.items():
+            # Перемещённое или удалённое письмо получит новый changekey, поэтому передаём только id
+            actions.setdefault(action, []).append((item_id, changekey if action in ("read", "unread") else None))
+
+        user_data = await self.db.get_user(telegram_id)
+        if not user_data:
+            return
+        if self.unread_cache:
+            self.unread_cache.invalidate(telegram_id)
+
+        try:
+            done = await apply_mail_actions_async(
+                email=user_data["login"],
+                password=user_data["password"],
+                actions=actions,
+                server=self.config.mail.server,
+                verify_ssl=self.config.mail.verify_ssl
+            )
+            text = LEXICON["mail_actions_done"] + "\n" + "\n".join(
+                f"{LEXICON['mail_action_' + action]}: {count}" for action, count in done.items()
+            )
+        except Exception as e:
+            logger.warning(f"Failed to apply mail actions for user {telegram_id}: {e}")
+            text = LEXICON["mail_actions_error"]
+
+        if self.bot:
+            try:
+                await self.bot.send_message(telegram_id, text)
+            except Exception as e:
+                logger.error(f"Error sending mail actions acknowledgement to user {telegram_id}: {e}")
+
+    async def close(self):
+        """Сразу применяет все накопленные действия (при остановке бота)"""
+        for task in list(self._flush_tasks.values()):
+            task.cancel()
+        self._flush_tasks.clear()
+        for telegram_id in list(self._pending):
+            await self.flush(telegram_id)
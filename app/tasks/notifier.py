@@ -0,0 +1,173 @@
+"""
+app/tasks/notifier.py
+
+Очередь исходящих уведомлений о новой почте.
+Poller только кладёт письма в очередь и не ждёт Telegram; доставкой занимаются воркеры,
+которые соблюдают лимиты Bot API (общий token bucket и по token bucket на чат),
+обрабатывают RetryAfter и объединяют несколько ожидающих писем одного чата в сводное сообщение.
+Недоставленные к остановке уведомления сохраняются в базе и отправляются после перезапуска.
+"""
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, Any, List, Set
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+from config.config import Config
+from app.handlers.mail import build_notification
+from services.metrics import NOTIFICATIONS, NOTIFICATION_QUEUE_DEPTH, NOTIFICATION_SEND_SECONDS
+from services.throttling import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class Notifier:
+    def __init__(self, config: Config, bot, mail_actions=None, db=None):
+        self.settings = config.notifier
+        self.bot = bot
+        self.mail_actions = mail_actions
+        # База для сохранения очереди при остановке (без неё недоставленное теряется)
+        self.db = db
+        self._checkpoint_name = f"notifier:{config.poller.instance_id}"
+        self.running = False
+        self._global = TokenBucket(self.settings.global_rate, self.settings.global_rate)
+        self._chats: Dict[int, TokenBucket] = {}
+        # Ожидающие письма по чатам; чат стоит в очереди не больше одного раза
+        self._pending: Dict[int, List[Dict[str, Any]]] = {}
+        self._scheduled: Set[int] = set()
+        self._ready: "asyncio.Queue[int]" = asyncio.Queue()
+        self._workers: List[asyncio.Task] = []
+        NOTIFICATION_QUEUE_DEPTH.set_function(lambda: self.queue_depth)
+
+    def enqueue(self, telegram_id: int, mail_dict: Dict[str, Any]):
+        """Ставит письмо в очередь на уведомление (не ждёт отправки)"""
+        self._pending.setdefault(telegram_id, []).append(mail_dict)
+        self._schedule(telegram_id)
+
+    @property
+    def queue_depth(self) -> int:
+        """Сколько писем ждут отправки"""
+        return sum(len(mails) for mails in self._pending.values())
+
+    def start(self):
+        self.running = True
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(max(1, self.settings.workers))]
+
+    async def restore(self):
+        """Ставит в очередь уведомления, не доставленные до прошлой остановки (любого экземпляра)"""
+        if self.db is None:
+            return
+        restored = 0
+        for _, state, _ in await self.db.take_checkpoints("notifier:"):
+            for telegram_id, mails in json.loads(state).items():
+                for mail_dict in mails:
+                    self.enqueue(int(telegram_id), mail_dict)
+                    restored += 1
+        if restored:
+            logger.info("Restored %d undelivered notifications", restored)
+
+    async def stop(self, timeout: float = 5):
+        """Пытается доставить оставшиеся уведомления за timeout секунд и останавливает воркеров"""
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        self.running = False
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        if not self._pending:
+            return
+        if self.db is None:
+            logger.warning("Dropping %d undelivered notifications on shutdown", self.queue_depth)
+            return
+        # Даты писем сохраняются строкой — в уведомлении они и так выводятся через str()
+        pending = {telegram_id: mails for telegram_id, mails in self._pending.items() if mails}
+        await self.db.save_checkpoint(self._checkpoint_name, json.dumps(pending, ensure_ascii=False, default=str))
+        logger.info("Saved %d undelivered notifications for the next start", self.queue_depth)
+
+    def _schedule(self, telegram_id: int, delay: float = 0):
+        if telegram_id in self._scheduled:
+            return
+        self._scheduled.add(telegram_id)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, telegram_id)
+        else:
+            self._ready.put_nowait(telegram_id)
+
+    def _chat_bucket(self, telegram_id: int) -> TokenBucket:
+        bucket = self._chats.get(telegram_id)
+        if bucket is None:
+            bucket = self._chats[telegram_id] = TokenBucket(self.settings.per_chat_rate, 1)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            telegram_id = await self._ready.get()
+            self._scheduled.discard(telegram_id)
+            try:
+                await self._deliver(telegram_id)
+            except Exception as e:
+                logger.error(f"Unexpected error in notifier: {e}")
+
+    async def _deliver(self, telegram_id: int):
+        if not self._pending.get(telegram_id):
+            return
+
+        # Лимит на чат: не держим воркера, а возвращаем чат в очередь, когда появится токен
+        chat_delay = self._chat_bucket(telegram_id).delay()
+        if chat_delay > 0:
+            self._schedule(telegram_id, chat_delay)
+            return
+
+        # Общий лимит Bot API
+        while (global_delay := self._global.delay()) > 0:
+            await asyncio.sleep(global_delay)
+        self._global.consume()
+        self._chat_bucket(telegram_id).consume()
+
+        # Всё, что накопилось для чата (но не больше digest_max_items), уходит одним сообщением
+        pending = self._pending[telegram_id]
+        mails = pending[:self.settings.digest_max_items]
+        del pending[:len(mails)]
+
+        try:
+            message_text, reply_markup = build_notification(telegram_id, mails, self.mail_actions)
+            with NOTIFICATION_SEND_SECONDS.time():
+                await self.bot.send_message(telegram_id, message_text, reply_markup=reply_markup)
+            NOTIFICATIONS.inc("sent")
+            logger.info(f"Notification with {len(mails)} email(s) sent to user {telegram_id}")
+        except TelegramRetryAfter as e:
+            # Возвращаем письма в начало очереди чата и ждём, сколько просит Telegram
+            logger.warning(f"Telegram flood control for user {telegram_id}, retry after {e.retry_after}s")
+            NOTIFICATIONS.inc("retry_after")
+            self._pending.setdefault(telegram_id, [])[:0] = mails
+            self._schedule(telegram_id, e.retry_after)
+            return
+        except asyncio.CancelledError:
+            # Остановка прервала отправку — письма вернутся в очередь и попадут в контрольную точку
+            self._pending.setdefault(telegram_id, [])[:0] = mails
+            raise
+        except TelegramForbiddenError:
+            # Пользователь заблокировал бота — уведомления ему больше не нужны
+            logger.info(f"User {telegram_id} blocked the bot, dropping notifications")
+            NOTIFICATIONS.inc("forbidden")
+            self._pending.pop(telegram_id, None)
+            return
+        except Exception as e:
+            logger.error(f"Error sending notification to user {telegram_id}: {e}")
+            NOTIFICATIONS.inc("error")
+
+        if self._pending.get(telegram_id):
+            self._schedule(telegram_id, self._chat_bucket(telegram_id).delay())
+        else:
+            self._pending.pop(telegram_id, None)
+            self._cleanup()
+
+    def _cleanup(self):
+        """Удаляет полные (неиспользуемые) бакеты чатов, чтобы словарь не рос бесконечно"""
+        if len(self._chats) < 1024:
+            return
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items() if bucket.is_full() and chat_id not in self._pending]:
+            del self._chats[chat_id]
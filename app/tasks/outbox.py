@@ -0,0 +1,257 @@
+"""
+app/tasks/outbox.py
+
+Очередь исходящих писем (outbox) в базе бота.
+Обработчик формы /send_email только ставит письмо в очередь и сразу отвечает пользователю;
+OutboxSender в фоне забирает письма из очереди, группирует письма одной учётной записи
+и отправляет их одним запросом CreateItem. Запрос собирается в памяти целиком, поэтому группа
+ограничена и числом писем, и суммарным размером вложений: большое письмо уходит отдельным запросом. Временные ошибки повторяются с экспоненциальной паузой,
+статус письма (отправлено / повтор / ошибка) появляется в сообщении с формой.
+Ключ идемпотентности письма сохраняется и в самом письме, поэтому повтор после потерянного ответа
+не отправляет его второй раз.
+"""
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set
+
+from config.config import Config
+from database.database import Database
+from lexicon.lexicon import LEXICON
+from services.attachments import close_attachments, download_attachments
+from services.mail_service import send_mail_batch_async
+from services.throttling import ServerThrottled
+
+logger = logging.getLogger(__name__)
+
+# Пауза перед повтором: RETRY_BASE_SECONDS * 2^(попытка-1), не больше RETRY_MAX_SECONDS
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 3600
+# Сколько дней хранить отправленные и неудавшиеся письма
+KEEP_DAYS = 7
+# Сколько секунд после нового письма подождать остальных, чтобы отправить их одним запросом
+LINGER_SECONDS = 0.05
+
+
+def _row_to_message(row) -> Dict[str, Any]:
+    return {
+        "id": row[0],
+        "key": row[1],
+        "telegram_id": row[2],
+        "login": row[3],
+        "chat_id": row[4],
+        "message_id": row[5],
+        "to": json.loads(row[6]),
+        "subject": row[7],
+        "body": row[8],
+        "attachments": json.loads(row[9]) if row[9] else [],
+        "form_text": row[10],
+        "attempts": row[11],
+    }
+
+
+class OutboxSender:
+    def __init__(self, db: Database, config: Config, bot):
+        self.db = db
+        self.settings = config.mail
+        self.server = config.mail.server
+        self.verify_ssl = config.mail.verify_ssl
+        self.bot = bot
+        self.running = False
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # Группы писем (одна учётная запись, до outbox_batch писем), отправляемые сейчас
+        self._groups: Set[asyncio.Task] = set()
+        # Забранные из базы группы, ждущие свободного места (больше outbox_workers групп одновременно не отправляется)
+        self._backlog: List[List[Dict[str, Any]]] = []
+
+    async def enqueue(
+        self,
+        idem_key: str,
+        telegram_id: int,
+        login: str,
+        to: List[str],
+        subject: Optional[str],
+        body: Optional[str],
+        attachments: List[Dict[str, Any]],
+        chat_id: Optional[int] = None,
+        message_id: Optional[int] = None,
+        form_text: Optional[str] = None,
+    ) -> bool:
+        """
+        Ставит письмо в очередь (дожидается только записи в базу).
+        attachments — описания из describe_attachment: файлы скачиваются из Telegram при отправке.
+        Возвращает False, если письмо с этим ключом уже в очереди.
+        """
+        queued = await self.db.enqueue_outbox(
+            idem_key, telegram_id, login, chat_id, message_id,
+            json.dumps(to), subject, body, json.dumps(attachments), form_text,
+        )
+        self._wakeup.set()
+        return queued
+
+    def start(self):
+        self.running = True
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10):
+        """Дожидается отправляемых групп не дольше timeout секунд; прерванные письма отправятся после перезапуска"""
+        self.running = False
+        self._wakeup.set()
+        if self._task:
+            await self._task
+        if self._groups:
+            _, pending = await asyncio.wait(self._groups, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _run(self):
+        # Письма, отправка которых прервалась остановкой, снова в очереди (повтор проверит «Отправленные»)
+        await self.db.reset_outbox()
+        self.db.delete_old_outbox(datetime.utcnow() - timedelta(days=KEEP_DAYS))
+        while self.running:
+            try:
+                self._wakeup.clear()
+                capacity = self.settings.outbox_workers - len(self._groups)
+                rows = []
+                if capacity > 0 and not self._backlog:
+                    rows = await self.db.claim_outbox(capacity * self.settings.outbox_batch)
+                    self._backlog.extend(self._group(rows))
+                while self._backlog and len(self._groups) < self.settings.outbox_workers:
+                    task = asyncio.create_task(self._send_group(self._backlog.pop(0)))
+                    self._groups.add(task)
+                    task.add_done_callback(self._group_done)
+                if rows:
+                    continue
+                await self._wait()
+            except Exception as e:
+                logger.error(f"Unexpected error in outbox sender: {e}")
+                await asyncio.sleep(5)
+
+    def _group(self, rows) -> List[List[Dict[str, Any]]]:
+        """
+        Письма одной учётной записи: не больше outbox_batch писем и outbox_batch_bytes вложений в группе.
+        Письмо, вложения которого больше outbox_batch_bytes, образует группу само.
+        """
+        by_login: Dict[str, List[Dict[str, Any]]] = {}
+        for row in rows:
+            message = _row_to_message(row)
+            by_login.setdefault(message["login"], []).append(message)
+        groups: List[List[Dict[str, Any]]] = []
+        for messages in by_login.values():
+            group: List[Dict[str, Any]] = []
+            group_bytes = 0
+            for message in messages:
+                # Размер из Telegram: файлы ещё не скачаны
+                size = sum(attachment.get("size") or 0 for attachment in message["attachments"])
+                if group and (len(group) >= self.settings.outbox_batch or group_bytes + size > self.settings.outbox_batch_bytes):
+                    groups.append(group)
+                    group, group_bytes = [], 0
+                group.append(message)
+                group_bytes += size
+            if group:
+                groups.append(group)
+        return groups
+
+    def _group_done(self, task: asyncio.Task):
+        self._groups.discard(task)
+        self._wakeup.set()
+
+    async def _wait(self):
+        """Ждёт нового письма, освобождения места или наступления времени повтора"""
+        timeout = 60.0
+        if len(self._groups) < self.settings.outbox_workers:
+            next_due = await self.db.next_outbox_due()
+            if next_due is not None:
+                timeout = min(max((next_due - datetime.utcnow()).total_seconds(), 0.05), timeout)
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            return
+        await asyncio.sleep(LINGER_SECONDS)
+
+    async def _send_group(self, messages: List[Dict[str, Any]]):
+        user_data = await self.db.get_user(messages[0]["telegram_id"])
+        if not user_data or user_data["login"] != messages[0]["login"]:
+            # Пользователь удалён или сменил учётную запись — отправлять от старой нечем
+            for message in messages:
+                await self._finish(message, "failed", "account changed")
+            return
+
+        ready: List[Dict[str, Any]] = []
+        try:
+            for message in messages:
+                try:
+                    files = await download_attachments(
+                        self.bot,
+                        message["attachments"],
+                        spool_size=self.settings.attachment_spool_size,
+                        max_size=self.settings.max_attachment_size,
+                    )
+                except Exception as e:
+                    logger.warning(f"Failed to download attachments for outbox message {message['id']}: {e}")
+                    await self._retry(message, str(e))
+                    continue
+                ready.append({**message, "files": files})
+            if not ready:
+                return
+
+            try:
+                results = await send_mail_batch_async(
+                    user_data["login"],
+                    user_data["password"],
+                    [
+                        {"key": m["key"], "to": m["to"], "subject": m["subject"], "body": m["body"], "attachments": m["files"]}
+                        for m in ready
+                    ],
+                    server=self.server,
+                    verify_ssl=self.verify_ssl,
+                    check_sent=any(m["attempts"] > 1 for m in ready),
+                )
+            except ServerThrottled as e:
+                for message in ready:
+                    await self._retry(message, str(e), delay=e.retry_after)
+                return
+            except Exception as e:
+                logger.warning(f"Failed to send {len(ready)} outbox message(s) for user {messages[0]['telegram_id']}: {e}")
+                for message in ready:
+                    await self._retry(message, str(e))
+                return
+
+            for message in ready:
+                error = results.get(message["key"], "no response")
+                # Ошибка отдельного письма (например, неверный адрес) — ответ сервера, повтор не поможет
+                await self._finish(message, "sent" if error is None else "failed", error)
+        finally:
+            for message in ready:
+                close_attachments(message["files"])
+
+    async def _retry(self, message: Dict[str, Any], error: str, delay: Optional[float] = None):
+        if message["attempts"] >= self.settings.outbox_max_attempts:
+            await self._finish(message, "failed", error)
+            return
+        if delay is None:
+            delay = min(RETRY_BASE_SECONDS * 2 ** (message["attempts"] - 1), RETRY_MAX_SECONDS)
+        self.db.retry_outbox(message["id"], datetime.utcnow() + timedelta(seconds=delay), error)
+        await self._report(message, LEXICON["outbox_retry"].format(minutes=max(1, round(delay / 60))))
+
+    async def _finish(self, message: Dict[str, Any], status: str, error: Optional[str] = None):
+        self.db.finish_outbox(message["id"], status, error)
+        if error:
+            logger.warning(f"Outbox message {message['id']} {status}: {error}")
+        await self._report(message, LEXICON["sent" if status == "sent" else "error_send"])
+
+    async def _report(self, message: Dict[str, Any], status_text: str):
+        """Показывает статус письма в сообщении с формой"""
+        if not message["chat_id"] or not message["message_id"]:
+            return
+        try:
+            await self.bot.edit_message_text(
+                text=f"{status_text}\n\n{message['form_text'] or ''}\n\n{status_text}",
+                chat_id=message["chat_id"],
+                message_id=message["message_id"],
+            )
+        except Exception as e:
+            logger.debug(f"Failed to update outbox status for message {message['id']}: {e}")
@@ -4,130 +4,270 @@ app/tasks/poller.py
 Централизованный round-robin poller для проверки почты пользователей
 """
 import asyncio
+import json
 import logging
+import random
 from datetime import datetime, timedelta
 from typing import Dict, Any
 
 # Удаляем импорт специфичных исключений из exchangelib, так как они могут отличаться в разных версиях
 # from exchangelib import ErrorServerBusy
 
-from services.mail_service import fetch_unread_emails_async
+from services.executors import BACKGROUND, use_lane
+from services.mail_service import fetch_unread_emails_async, sync_new_emails_async
+from services.metrics import POLLS, POLL_LAG_SECONDS, POLL_NEW_EMAILS, SCHEDULED_USERS
+from services.throttling import ServerThrottled, get_governor, governors_checkpoint, restore_governors
 from config.config import Config, load_config
-from database.database import init_db
+from database.database import Database
+from app.tasks.scheduler import UserScheduler
+from app.tasks.leases import LeaseScheduler
+from app.tasks.adaptive import AdaptiveIntervals
 
 logger = logging.getLogger(__name__)
 
 
 class Poller:
-    def __init__(self, db: Dict[str, Any], config: Config, bot=None):
+    def __init__(self, db: Database, config: Config, bot=None, mail_actions=None, notifier=None, mail_index=None, unread_cache=None):
         self.db = db
         self.config = config
         self.bot = bot
+        self.mail_actions = mail_actions
+        # Локальный индекс заголовков для /search: в него попадает каждое полученное письмо
+        self.mail_index = mail_index
+        # Кэш непрочитанных писем /check_mail: результаты опроса сразу видны пользователю
+        self.unread_cache = unread_cache
+        # Очередь уведомлений: если задана, poller не ждёт доставки в Telegram
+        self.notifier = notifier
         self.running = False
+        # Будит воркеров, ждущих в паузах, когда poller останавливают
+        self._stopped = asyncio.Event()
+        # Адаптивные интервалы по частоте писем и активности (иначе — slot_seconds * число активных)
+        self.intervals = AdaptiveIntervals(config.poller) if config.poller.adaptive else None
+        interactive_interval = config.poller.min_interval if self.intervals else None
+        if config.poller.mode == "lease":
+            # Несколько экземпляров делят пользователей через аренду в общей базе
+            self.scheduler = LeaseScheduler(
+                db,
+                owner=config.poller.instance_id,
+                lease_seconds=config.poller.lease_seconds,
+                batch_size=config.poller.lease_batch,
+                max_leased=config.poller.max_leased,
+                interactive_interval=interactive_interval,
+            )
+        else:
+            self.scheduler = UserScheduler(
+                db,
+                warmup_seconds=config.poller.warmup_seconds,
+                interactive_interval=interactive_interval,
+            )
+        SCHEDULED_USERS.set_function(lambda: self.scheduler.active_count)
+        # Общий лимит одновременных запросов к EWS и лимиты по серверам
+        self._global_limit = asyncio.Semaphore(config.poller.max_concurrency)
+        self._server_limits: Dict[str, asyncio.Semaphore] = {}
 
     async def poll_loop(self):
-        """Основной цикл опроса почты пользователей"""
-        logger.info("Starting poller loop")
+        """
+        Основной цикл опроса почты пользователей: запускает пул воркеров.
+        После stop() воркеры не берут новых пользователей, текущие опросы получают
+        shutdown_timeout секунд на завершение, остальные отменяются и будут повторены после перезапуска.
+        """
+        logger.info("Starting poller loop with %d worker(s)", self.config.poller.workers)
         self.running = True
+        self._stopped.clear()
+        await self._restore_checkpoint()
+        await self.scheduler.load()
 
+        workers = [asyncio.create_task(self._worker(i)) for i in range(max(1, self.config.poller.workers))]
+        try:
+            await self._stopped.wait()
+            _, pending = await asyncio.wait(workers, timeout=self.config.poller.shutdown_timeout)
+            if pending:
+                logger.warning("Cancelling %d poll(s) still running after %ss", len(pending), self.config.poller.shutdown_timeout)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await self.scheduler.close()
+            self._save_checkpoint()
+            logger.info("Poller stopped")
+
+    @property
+    def _checkpoint_name(self) -> str:
+        return f"poller:{self.config.poller.instance_id}"
+
+    async def _restore_checkpoint(self):
+        """Продолжает паузы EWS-серверов, сохранённые при прошлой остановке (любого экземпляра)"""
+        for _, state, _ in await self.db.take_checkpoints("poller:"):
+            restore_governors(json.loads(state).get("governors", {}))
+
+    def _save_checkpoint(self):
+        # Очередь опросов и backoff пользователей уже в базе (next_poll_at, poll_failures);
+        # в памяти остаются только паузы серверов
+        governors = governors_checkpoint()
+        if governors:
+            self.db.save_checkpoint(self._checkpoint_name, json.dumps({"governors": governors}))
+
+    async def _sleep(self, seconds: float):
+        """Пауза, которую прерывает stop()"""
+        try:
+            await asyncio.wait_for(self._stopped.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _worker(self, worker_id: int):
+        """Воркер: забирает пользователей, у которых наступило время опроса, и опрашивает их"""
+        # Опросы идут в фоновой полосе и не занимают потоки запросов пользователей
+        use_lane(BACKGROUND)
         while self.running:
             try:
-                # Находим пользователя с минимальным next_poll_at
-                user_to_poll = await self._get_next_user_to_poll()
+                # Пока EWS-сервер просит не беспокоить, пользователей не трогаем (их расписание не сдвигается)
+                blocked_for = get_governor(self.config.mail.server).blocked_for()
+                if blocked_for > 0:
+                    await self._sleep(min(blocked_for, 10))
+                    continue
+
+                now = datetime.utcnow()
+                user_to_poll = self.scheduler.claim(now)
                 if user_to_poll is None:
-                    # Нет активных пользователей, ждем перед следующей проверкой
-                    await asyncio.sleep(10)  # ждем 10 секунд перед следующей проверкой
+                    next_due_at = self.scheduler.next_due_at()
+                    if next_due_at is None:
+                        # Нет активных пользователей, ждем перед следующей проверкой
+                        await self.scheduler.wait(10)  # ждем 10 секунд или появления пользователя
+                    else:
+                        # Ждем до наступления времени опроса (или пока кто-то не станет срочнее)
+                        await self.scheduler.wait(max((next_due_at - now).total_seconds(), 0.01))
                     continue
 
                 telegram_id, user_data = user_to_poll
+                if user_data.get("next_poll_at"):
+                    POLL_LAG_SECONDS.observe(max((now - user_data["next_poll_at"]).total_seconds(), 0))
+                try:
+                    async with self._global_limit, self._server_limit(self.config.mail.server):
+                        await self._poll_user(telegram_id, user_data, now)
+                finally:
+                    self.scheduler.release(telegram_id)
 
-                # Проверяем, пришло ли время опроса
-                now = datetime.utcnow()
-                if user_data["next_poll_at"] > now:
-                    # Ждем до наступления времени опроса
-                    sleep_time = (user_data["next_poll_at"] - now).total_seconds()
-                    await asyncio.sleep(sleep_time)
+            except Exception as e:
+                logger.error(f"Unexpected error in poll worker {worker_id}: {e}")
+                await self._sleep(10)  # Ждем перед следующей итерацией при ошибке
 
-                # Обновляем next_poll_at до запроса, чтобы избежать двойного опроса
-                active_users_count = await self._get_active_users_count()
-                next_poll_time = now + timedelta(seconds=self.config.poller.slot_seconds * active_users_count)
-                self.db["update_user"](telegram_id, next_poll_at=next_poll_time)
+    def _server_limit(self, server: str) -> asyncio.Semaphore:
+        """Семафор, ограничивающий число одновременных запросов к одному EWS-серверу"""
+        semaphore = self._server_limits.get(server)
+        if semaphore is None:
+            semaphore = self._server_limits[server] = asyncio.Semaphore(self.config.poller.per_server_concurrency)
+        return semaphore
 
+    async def _poll_user(self, telegram_id: int, user_data: Dict[str, Any], now: datetime):
+        """Опрашивает почтовый ящик одного пользователя"""
+        # Обновляем next_poll_at до запроса, чтобы избежать двойного опроса
+        next_poll_time = now + timedelta(seconds=await self._next_poll_interval(user_data, now))
+        self.db.update_user(telegram_id, next_poll_at=next_poll_time)
+
+        try:
+            if self.config.poller.incremental:
+                # Получаем только письма, пришедшие с прошлого опроса
+                created, sync_state = await sync_new_emails_async(
+                    email=user_data["login"],
+                    password=user_data["password"],
+                    sync_state=user_data.get("sync_state"),
+                    server=self.config.mail.server,
+                    verify_ssl=self.config.mail.verify_ssl
+                )
+                # Сохраняем состояние до отправки уведомлений, чтобы письма не повторялись
+                updates = {"sync_state": sync_state, "poll_failures": 0}
+                # Пришедшие уже прочитанными (прочитаны в другом клиенте, правила сервера) — только в индекс поиска
+                emails = [mail_dict for mail_dict in created if not mail_dict.get("is_read")]
+            else:
                 # Получаем непрочитанные письма
-                try:
-                    emails = await fetch_unread_emails_async(
-                        email=user_data["login"],
-                        password=user_data["password"],
-                        server=self.config.mail.server,
-                        verify_ssl=self.config.mail.verify_ssl
-                    )
-
-                    if emails:
-                        # Отправляем уведомления о новых письмах
-                        from app.handlers.mail import notify_user_new_email
-                        for email_data in emails:
-                            if self.bot:
-                                await notify_user_new_email(telegram_id, email_data, self.bot)
-                            else:
-                                logger.warning(f"Bot not available, cannot send notification to user {telegram_id}")
-
-                        # Сброс ошибок при успешном опросе
-                        self.db["update_user"](telegram_id, poll_failures=0)
-                        logger.info(f"Found {len(emails)} new emails for user {telegram_id}")
-
-                except Exception as e:
-                    # Обработка ошибок EWS, включая ошибки ограничения частоты
-                    logger.warning(f"EWS error for user {telegram_id}: {e}")
-                    # Проверяем, является ли ошибка ошибкой ограничения частоты
-                    if "rate" in str(e).lower() or "throttle" in str(e).lower() or "limit" in str(e).lower() or "429" in str(e):
-                        # Обработка ошибки ограничения частоты
-                        backoff_seconds = 300  # 5 минут по умолчанию для rate limit
-                        logger.info(f"Rate limit detected for user {telegram_id}, applying {backoff_seconds}s backoff")
+                emails = await fetch_unread_emails_async(
+                    email=user_data["login"],
+                    password=user_data["password"],
+                    server=self.config.mail.server,
+                    verify_ssl=self.config.mail.verify_ssl
+                )
+                if self.unread_cache:
+                    self.unread_cache.put(telegram_id, emails)
+                created = emails
+                updates = {"poll_failures": 0}
+
+            if self.intervals:
+                # Пересчитываем частоту писем и интервал с учётом результата опроса (в обоих режимах)
+                user_data["mail_rate"] = self.intervals.update_rate(user_data, len(emails), now)
+                updates.update(
+                    mail_rate=user_data["mail_rate"],
+                    last_polled_at=now,
+                    next_poll_at=now + timedelta(seconds=self.intervals.interval(user_data, now)),
+                )
+            self.db.update_user(telegram_id, **updates)
+
+            if emails and self.unread_cache and self.config.poller.incremental:
+                self.unread_cache.add_new(telegram_id, emails)
+            if created and self.mail_index:
+                self.mail_index.add(telegram_id, created)
+
+            if emails:
+                # Отправляем уведомления о новых письмах
+                from app.handlers.mail import notify_user_new_email
+                for email_data in emails:
+                    if self.notifier:
+                        self.notifier.enqueue(telegram_id, email_data)
+                    elif self.bot:
+                        await notify_user_new_email(telegram_id, email_data, self.bot, self.mail_actions)
                     else:
-                        # Обработка других ошибок с экспоненциальным backoff
-                        current_failures = user_data.get("poll_failures", 0)
-                        backoff_seconds = min(300 * (2 ** current_failures), 3600) # Экспоненциальный backoff, максимум 1 час
-                        logger.info(f"Other error for user {telegram_id}, applying {backoff_seconds}s backoff with failure count {current_failures + 1}")
-                    
-                    next_poll_time = now + timedelta(seconds=backoff_seconds)
-                    current_failures = user_data.get("poll_failures", 0)
-                    self.db["update_user"](
-                        telegram_id,
-                        next_poll_at=next_poll_time,
-                        poll_failures=current_failures + 1
-                    )
+                        logger.warning(f"Bot not available, cannot send notification to user {telegram_id}")
 
-            except Exception as e:
-                logger.error(f"Unexpected error in poll loop: {e}")
-                await asyncio.sleep(10)  # Ждем перед следующей итерацией при ошибке
+                # Сброс ошибок при успешном опросе
+                self.db.update_user(telegram_id, poll_failures=0)
+                POLL_NEW_EMAILS.inc(amount=len(emails))
+                logger.info(f"Found {len(emails)} new emails for user {telegram_id}")
+            POLLS.inc("success")
 
-    async def _get_next_user_to_poll(self):
-        """Находит пользователя с минимальным next_poll_at"""
-        now = datetime.utcnow()
-        next_user = None
-        min_next_poll_at = None
+        except ServerThrottled as e:
+            # Перегружен сервер, а не ящик пользователя: откладываем опрос до конца паузы, не считая это ошибкой
+            POLLS.inc("rate_limited")
+            logger.info(f"EWS server busy, postponing poll of user {telegram_id} by {e.retry_after:.0f}s")
+            # Разброс, чтобы после паузы пользователи не пришли на сервер все разом
+            delay = max(e.retry_after, 1) * random.uniform(1, 1.2)
+            self.db.update_user(telegram_id, next_poll_at=now + timedelta(seconds=delay))
+
+        except asyncio.CancelledError:
+            # Опрос прерван остановкой: next_poll_at уже сдвинут вперёд, возвращаем пользователя в начало очереди
+            self.db.update_user(telegram_id, next_poll_at=now)
+            raise
 
-        for telegram_id in self.db["get_all_user_ids"]():
-            user_data = self.db["get_user"](telegram_id)
-            if not user_data.get("active", False):
-                continue
+        except Exception as e:
+            logger.warning(f"EWS error for user {telegram_id}: {e}")
+            # Экспоненциальный backoff для ошибок конкретного ящика
+            current_failures = user_data.get("poll_failures", 0)
+            backoff_seconds = min(300 * (2 ** current_failures), 3600) # Экспоненциальный backoff, максимум 1 час
+            POLLS.inc("backoff")
+            logger.info(f"Error for user {telegram_id}, applying {backoff_seconds}s backoff with failure count {current_failures + 1}")
 
-            next_poll_at = user_data.get("next_poll_at")
-            if next_poll_at and (min_next_poll_at is None or next_poll_at < min_next_poll_at):
-                min_next_poll_at = next_poll_at
-                next_user = (telegram_id, user_data)
+            next_poll_time = now + timedelta(seconds=backoff_seconds)
+            current_failures = user_data.get("poll_failures", 0)
+            self.db.update_user(
+                telegram_id,
+                next_poll_at=next_poll_time,
+                poll_failures=current_failures + 1
+            )
 
-        return next_user
+    async def _next_poll_interval(self, user_data: Dict[str, Any], now: datetime) -> float:
+        """Интервал до следующего опроса пользователя, секунд"""
+        if self.intervals:
+            return self.intervals.interval(user_data, now)
+        return self.config.poller.slot_seconds * await self._get_active_users_count()
+
+    async def _get_next_user_to_poll(self):
+        """Находит пользователя с минимальным next_poll_at"""
+        return self.scheduler.peek()
 
     async def _get_active_users_count(self):
         """Возвращает количество активных пользователей"""
-        count = 0
-        for telegram_id in self.db["get_all_user_ids"]():
-            user_data = self.db["get_user"](telegram_id)
-            if user_data and user_data.get("active", False):
-                count += 1
-        return count
+        return self.scheduler.active_count
 
     def stop(self):
-        """Останавливает poller"""
+        """Останавливает poller: воркеры просыпаются и не берут новых пользователей"""
         self.running = False
+        self._stopped.set()
+        self.scheduler.wake()
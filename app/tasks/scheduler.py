@@ -0,0 +1,205 @@
+"""
+app/tasks/scheduler.py
+
+Очередь пользователей для poller'а: min-heap по next_poll_at в памяти.
+Состояние загружается из базы один раз при старте и дальше поддерживается
+через подписку на изменения (add_user / update_user), в базу пишутся только изменения.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+from database.database import Database
+
+logger = logging.getLogger(__name__)
+
+
+class UserScheduler:
+    def __init__(self, db: Database, warmup_seconds: float = 0, interactive_interval: Optional[float] = None):
+        self.db = db
+        # Просроченные на старте опросы распределяются по окну warmup_seconds
+        self.warmup_seconds = warmup_seconds
+        # Если задан — после сообщения боту опрос пользователя переносится не позже чем на этот интервал
+        self.interactive_interval = interactive_interval
+        self._users: Dict[int, Dict[str, Any]] = {}
+        # Элементы кучи: (next_poll_at, seq, telegram_id); устаревшие элементы удаляются лениво
+        self._heap: List[Tuple[datetime, int, int]] = []
+        # Актуальный seq для каждого пользователя в куче
+        self._entries: Dict[int, int] = {}
+        self._seq = itertools.count()
+        self._active_count = 0
+        # Пользователи, которых сейчас опрашивает какой-либо воркер
+        self._in_flight: Set[int] = set()
+        # Пользователи, для которых пришло событие о новой почте во время опроса
+        self._poked: Set[int] = set()
+        # Будит ожидающих воркеров, когда в голове очереди появляется более ранний пользователь
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+
+    async def load(self):
+        """Загружает всех пользователей одним запросом и подписывается на изменения"""
+        async with self._load_lock:
+            if not self._loaded:
+                await self._load()
+
+    async def _load(self):
+        self._wakeup = asyncio.Event()
+        self._users = await self.db.load_all_users()
+        self._heap.clear()
+        self._entries.clear()
+        self._active_count = 0
+        now = datetime.utcnow()
+        overdue = 0
+        for telegram_id, user in self._users.items():
+            if user.get("active", False):
+                self._active_count += 1
+                if self.warmup_seconds and user.get("next_poll_at") and user["next_poll_at"] <= now:
+                    # Защита от «шторма» после рестарта: только в памяти, в базу попадёт при опросе
+                    user["next_poll_at"] = now + timedelta(seconds=random.uniform(0, self.warmup_seconds))
+                    overdue += 1
+                self._push(telegram_id)
+        if overdue:
+            logger.info("Spreading %d overdue users over %ss warm-up window", overdue, self.warmup_seconds)
+        self.db.listeners.append(self.on_user_changed)
+        self._loaded = True
+        logger.info("Scheduler loaded %d users (%d active)", len(self._users), self._active_count)
+
+    @property
+    def active_count(self) -> int:
+        """Количество активных пользователей, O(1)"""
+        return self._active_count
+
+    def peek(self) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """Возвращает пользователя с минимальным next_poll_at (копию его данных) или None"""
+        while self._heap:
+            _, seq, telegram_id = self._heap[0]
+            if self._entries.get(telegram_id) == seq:
+                return telegram_id, dict(self._users[telegram_id])
+            heapq.heappop(self._heap)
+        return None
+
+    def claim(self, now: datetime) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """
+        Забирает пользователя, у которого наступило время опроса.
+        Пока пользователь не возвращён через release(), другие воркеры его не получат.
+        """
+        head = self.peek()
+        if head is None:
+            return None
+        telegram_id, user_data = head
+        if user_data["next_poll_at"] > now:
+            return None
+        heapq.heappop(self._heap)
+        self._entries.pop(telegram_id, None)
+        self._in_flight.add(telegram_id)
+        return telegram_id, user_data
+
+    def release(self, telegram_id: int):
+        """Возвращает пользователя в очередь после опроса"""
+        self._in_flight.discard(telegram_id)
+        user = self._users.get(telegram_id)
+        if not user or not user.get("active", False):
+            self._poked.discard(telegram_id)
+            return
+        if telegram_id in self._poked:
+            # Во время опроса пришло новое письмо — опрашиваем ещё раз сразу
+            self._poked.discard(telegram_id)
+            self.db.update_user(telegram_id, next_poll_at=datetime.utcnow())
+        else:
+            self._push(telegram_id)
+
+    def poke(self, telegram_id: int):
+        """Переносит опрос пользователя на текущий момент (например, по push-событию о новой почте)"""
+        user = self._users.get(telegram_id)
+        if not user or not user.get("active", False):
+            return
+        if telegram_id in self._in_flight:
+            self._poked.add(telegram_id)
+            return
+        now = datetime.utcnow()
+        if user.get("next_poll_at") is not None and user["next_poll_at"] <= now:
+            return
+        self.db.update_user(telegram_id, next_poll_at=now)
+
+    def active_user_ids(self) -> List[int]:
+        """ID всех активных пользователей"""
+        return [telegram_id for telegram_id, user in self._users.items() if user.get("active", False)]
+
+    def get_user(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        """Копия данных пользователя из памяти планировщика"""
+        user = self._users.get(telegram_id)
+        return dict(user) if user is not None else None
+
+    async def wait(self, timeout: Optional[float]):
+        """Ждёт timeout секунд или пока в очереди не появится пользователь с более ранним временем опроса"""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def wake(self):
+        """Будит ожидающих воркеров (например, при остановке poller'а)"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def next_due_at(self) -> Optional[datetime]:
+        """Ближайшее время опроса среди пользователей в очереди"""
+        head = self.peek()
+        return head[1]["next_poll_at"] if head else None
+
+    def on_user_changed(self, telegram_id: int, fields: Dict[str, Any]):
+        """Синхронизирует очередь с изменениями пользователя в базе"""
+        user = self._users.get(telegram_id)
+        if user is None:
+            if "login" not in fields:
+                # Обновление несуществующего пользователя — в базе ничего не изменилось
+                return
+            user = self._users[telegram_id] = {}
+        was_active = bool(user.get("active", False))
+        user.update(fields)
+        is_active = bool(user.get("active", False))
+
+        if was_active != is_active:
+            self._active_count += 1 if is_active else -1
+
+        if not is_active or telegram_id in self._in_flight:
+            # Опрашиваемый сейчас пользователь вернётся в очередь через release()
+            self._entries.pop(telegram_id, None)
+        elif "next_poll_at" in fields or not was_active:
+            self._push(telegram_id)
+
+        if "last_seen_at" in fields and is_active and self.interactive_interval and fields["last_seen_at"]:
+            # Пользователь пишет боту — не держим его в медленном уровне
+            due = fields["last_seen_at"] + timedelta(seconds=self.interactive_interval)
+            if telegram_id in self._in_flight:
+                return
+            if user.get("next_poll_at") is None or user["next_poll_at"] > due:
+                self.db.update_user(telegram_id, next_poll_at=due)
+
+    async def close(self):
+        """Освобождает ресурсы планировщика (для локальной очереди ничего делать не нужно)"""
+
+    def _push(self, telegram_id: int):
+        next_poll_at = self._users[telegram_id].get("next_poll_at")
+        if next_poll_at is None:
+            # Пользователи без next_poll_at в очередь не попадают
+            self._entries.pop(telegram_id, None)
+            return
+        seq = next(self._seq)
+        self._entries[telegram_id] = seq
+        heapq.heappush(self._heap, (next_poll_at, seq, telegram_id))
+        if self._heap[0][1] == seq and self._wakeup is not None:
+            self._wakeup.set()
+        if len(self._heap) > 4 * len(self._entries) + 64:
+            self._compact()
+
+    def _compact(self):
+        """Удаляет из кучи устаревшие элементы"""
+        self._heap = [entry for entry in self._heap if self._entries.get(entry[2]) == entry[1]]
+        heapq.heapify(self._heap)
@@ -0,0 +1,271 @@
+"""
+app/tasks/subscriber.py
+
+Push-обнаружение новой почты через подписки EWS.
+- streaming-подписка: одно долгое соединение GetStreamingEvents на пользователя (до max_streams пользователей);
+- pull-подписка: остальные пользователи и те, у кого streaming не работает, — короткий GetEvents
+  раз в pull_interval секунд по общим keep-alive соединениям из кэша подключений;
+- если не работает и pull, пользователь остаётся только на обычном poller'е до следующей попытки.
+
+Подписка сама письма не загружает: по событию о новом письме пользователь переносится
+в начало очереди poller'а (UserScheduler.poke), и письма забирает обычная инкрементальная синхронизация.
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Tuple
+
+from config.config import Config
+from database.database import Database
+from app.tasks.scheduler import UserScheduler
+from services.executors import BACKGROUND, use_lane
+from services.mail_service import (
+    get_pull_new_mail_async,
+    invalidate_account,
+    iter_streaming_new_mail,
+    subscribe_new_mail_async,
+    unsubscribe_new_mail_async,
+)
+from services.throttling import ServerThrottled, get_governor
+
+logger = logging.getLogger(__name__)
+
+# После скольких ошибок подряд переходить на следующий режим (stream -> pull -> poll)
+MAX_FAILURES = 3
+# Пауза перед повторной streaming-подпиской: STREAM_RETRY_SECONDS * число ошибок, не больше STREAM_RETRY_MAX_SECONDS
+STREAM_RETRY_SECONDS = 60
+STREAM_RETRY_MAX_SECONDS = 300
+
+STREAM = "stream"
+PULL = "pull"
+POLL = "poll"
+
+
+class Subscriber:
+    def __init__(self, db: Database, config: Config, scheduler: UserScheduler):
+        self.db = db
+        self.config = config
+        self.settings = config.subscriptions
+        self.scheduler = scheduler
+        self.running = False
+        self._stopped = asyncio.Event()
+        # Режим обнаружения почты для каждого пользователя
+        self._modes: Dict[int, str] = {}
+        self._streams: Dict[int, asyncio.Task] = {}
+        # telegram_id -> (subscription_id, watermark) pull-подписки
+        self._pull: Dict[int, Tuple[str, str]] = {}
+        self._failures: Dict[int, int] = {}
+        # Когда повторить попытку подписки для пользователей в режиме POLL (time.monotonic())
+        self._retry_at: Dict[int, float] = {}
+        # Streaming-соединения блокируют поток на всё время соединения, поэтому у них свой пул
+        self._executor = ThreadPoolExecutor(max_workers=max(1, self.settings.max_streams), thread_name_prefix="ews-stream")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def run(self):
+        """Основной цикл: запускает подписки и раз в pull_interval опрашивает pull-подписки"""
+        logger.info("Starting EWS subscriber")
+        self.running = True
+        self._stopped.clear()
+        self._loop = asyncio.get_running_loop()
+        # Подписки — фоновая работа: их запросы идут в фоновой полосе через общий ограничитель сервера
+        use_lane(BACKGROUND)
+        await self.scheduler.load()
+        self.db.listeners.append(self.on_user_changed)
+
+        for telegram_id in self.scheduler.active_user_ids():
+            self._start(telegram_id)
+
+        try:
+            while self.running:
+                try:
+                    await self._pull_round()
+                    self._retry_failed()
+                except Exception as e:
+                    logger.error(f"Unexpected error in subscriber loop: {e}")
+                await self._sleep(self.settings.pull_interval)
+        finally:
+            await self._shutdown()
+
+    async def _sleep(self, seconds: float):
+        """Пауза, которую прерывает stop()"""
+        try:
+            await asyncio.wait_for(self._stopped.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def on_user_changed(self, telegram_id: int, fields: Dict[str, Any]):
+        """Перезапускает подписку при регистрации/смене пароля и снимает её при деактивации"""
+        if "login" in fields:
+            self._stop_user(telegram_id)
+            if self.running:
+                self._start(telegram_id)
+        elif fields.get("active") is False:
+            self._stop_user(telegram_id)
+        elif fields.get("active") and telegram_id not in self._modes and self.running:
+            self._start(telegram_id)
+
+    def _start(self, telegram_id: int):
+        if telegram_id in self._modes:
+            return
+        if len(self._streams) < self.settings.max_streams:
+            self._modes[telegram_id] = STREAM
+            self._streams[telegram_id] = asyncio.create_task(self._stream_user(telegram_id))
+        else:
+            # Pull-подписка будет создана в ближайшем _pull_round
+            self._modes[telegram_id] = PULL
+
+    def _stop_user(self, telegram_id: int):
+        mode = self._modes.pop(telegram_id, None)
+        self._failures.pop(telegram_id, None)
+        self._retry_at.pop(telegram_id, None)
+        pull = self._pull.pop(telegram_id, None)
+        user = self.scheduler.get_user(telegram_id)
+        if pull and user:
+            asyncio.create_task(self._in_background(unsubscribe_new_mail_async(
+                user["login"], user["password"], pull[0],
+                self.config.mail.server, self.config.mail.verify_ssl,
+            )))
+        # Streaming-задача завершится сама, когда увидит, что она больше не текущая
+        if self._streams.pop(telegram_id, None) is not None:
+            logger.debug("Streaming subscription for user %s will be closed (mode %s)", telegram_id, mode)
+
+    def _fail(self, telegram_id: int, mode: str) -> bool:
+        """Учитывает ошибку подписки; возвращает True, если пора переключиться на следующий режим"""
+        failures = self._failures.get(telegram_id, 0) + 1
+        self._failures[telegram_id] = failures
+        if failures < MAX_FAILURES:
+            return False
+        self._failures.pop(telegram_id, None)
+        if mode == STREAM:
+            logger.info(f"Streaming subscription failed for user {telegram_id}, falling back to pull")
+            self._modes[telegram_id] = PULL
+        else:
+            logger.info(f"Pull subscription failed for user {telegram_id}, falling back to poller")
+            self._modes[telegram_id] = POLL
+            self._retry_at[telegram_id] = time.monotonic() + self.settings.retry_seconds
+        return True
+
+    def _is_current_stream(self, telegram_id: int) -> bool:
+        return (
+            self.running
+            and self._modes.get(telegram_id) == STREAM
+            and self._streams.get(telegram_id) is asyncio.current_task()
+        )
+
+    @staticmethod
+    async def _in_background(coro):
+        """Выполняет coro в фоновой полосе (задачи из обработчиков Telegram наследуют полосу interactive)"""
+        use_lane(BACKGROUND)
+        return await coro
+
+    async def _wait_governor(self):
+        """Ждёт, пока сервер на паузе: streaming-соединение не идёт через ограничитель, но и не должно его обходить"""
+        blocked_for = get_governor(self.config.mail.server).blocked_for()
+        if blocked_for > 0:
+            await self._sleep(blocked_for)
+
+    async def _stream_user(self, telegram_id: int):
+        use_lane(BACKGROUND)
+        try:
+            while self._is_current_stream(telegram_id):
+                user = self.scheduler.get_user(telegram_id)
+                if not user or not user.get("active", False):
+                    break
+                try:
+                    subscription_id, _ = await subscribe_new_mail_async(
+                        user["login"], user["password"], True,
+                        self.config.mail.server, self.config.mail.verify_ssl,
+                    )
+                    self._failures.pop(telegram_id, None)
+                    # Переподключаемся к той же подписке, пока она жива; долгое соединение держит свой поток,
+                    # а не поток фоновой полосы, поэтому паузу сервера соблюдаем перед каждым подключением
+                    while self._is_current_stream(telegram_id):
+                        await self._wait_governor()
+                        if not self._is_current_stream(telegram_id):
+                            break
+                        await self._loop.run_in_executor(
+                            self._executor, self._consume_stream, telegram_id, user, subscription_id
+                        )
+                except ServerThrottled as e:
+                    # Перегрузка сервера — не ошибка подписки: ждём паузу и пробуем снова
+                    await self._sleep(e.retry_after)
+                except Exception as e:
+                    logger.warning(f"Streaming subscription error for user {telegram_id}: {e}")
+                    if self._fail(telegram_id, STREAM):
+                        break
+                    await self._sleep(min(STREAM_RETRY_SECONDS * self._failures.get(telegram_id, 1), STREAM_RETRY_MAX_SECONDS))
+        finally:
+            if self._streams.get(telegram_id) is asyncio.current_task():
+                del self._streams[telegram_id]
+
+    def _consume_stream(self, telegram_id: int, user: Dict[str, Any], subscription_id: str):
+        """Выполняется в отдельном потоке: держит streaming-соединение и будит poller по событиям"""
+        for _ in iter_streaming_new_mail(
+            user["login"], user["password"], subscription_id,
+            self.settings.stream_timeout_minutes,
+            self.config.mail.server, self.config.mail.verify_ssl,
+        ):
+            if not self.running:
+                return
+            self._loop.call_soon_threadsafe(self.scheduler.poke, telegram_id)
+
+    async def _pull_round(self):
+        limit = asyncio.Semaphore(self.settings.pull_concurrency)
+        telegram_ids = [telegram_id for telegram_id, mode in self._modes.items() if mode == PULL]
+        await asyncio.gather(*(self._pull_user(telegram_id, limit) for telegram_id in telegram_ids))
+
+    async def _pull_user(self, telegram_id: int, limit: asyncio.Semaphore):
+        async with limit:
+            user = self.scheduler.get_user(telegram_id)
+            if not user or not user.get("active", False) or self._modes.get(telegram_id) != PULL:
+                return
+            try:
+                subscription = self._pull.get(telegram_id)
+                if subscription is None:
+                    self._pull[telegram_id] = await subscribe_new_mail_async(
+                        user["login"], user["password"], False,
+                        self.config.mail.server, self.config.mail.verify_ssl,
+                    )
+                    return
+                subscription_id, watermark = subscription
+                has_new_mail, watermark = await get_pull_new_mail_async(
+                    user["login"], user["password"], subscription_id, watermark,
+                    self.config.mail.server, self.config.mail.verify_ssl,
+                )
+                self._pull[telegram_id] = (subscription_id, watermark)
+                self._failures.pop(telegram_id, None)
+                if has_new_mail:
+                    self.scheduler.poke(telegram_id)
+            except ServerThrottled:
+                # Сервер на паузе: подписка жива, события заберём в следующем раунде
+                pass
+            except Exception as e:
+                logger.warning(f"Pull subscription error for user {telegram_id}: {e}")
+                # Подписка могла истечь — при следующей попытке создадим новую
+                self._pull.pop(telegram_id, None)
+                self._fail(telegram_id, PULL)
+
+    def _retry_failed(self):
+        """Повторяет подписку для пользователей, которые временно остались только на poller'е"""
+        now = time.monotonic()
+        for telegram_id, retry_at in list(self._retry_at.items()):
+            if retry_at <= now:
+                del self._retry_at[telegram_id]
+                self._modes.pop(telegram_id, None)
+                self._start(telegram_id)
+
+    async def _shutdown(self):
+        for telegram_id in list(self._streams):
+            user = self.scheduler.get_user(telegram_id)
+            if user:
+                # Закрытие сессии прерывает висящее streaming-соединение
+                invalidate_account(user["login"])
+        for task in list(self._streams.values()):
+            task.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stop(self):
+        """Останавливает подписки: основной цикл и паузы перед повтором прерываются сразу"""
+        self.running = False
+        self._stopped.set()
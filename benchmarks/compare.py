@@ -0,0 +1,49 @@
+"""
+benchmarks/compare.py
+
+Сравнивает два результата benchmarks/run.py:
+    python -m benchmarks.compare benchmarks/results/old.json benchmarks/results/new.json
+Печатает числовые показатели обоих прогонов и изменение в процентах.
+"""
+import json
+import sys
+from typing import Any, Dict
+
+
+def _flatten(data: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    out: Dict[str, float] = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            out.update(_flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[name] = value
+    return out
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print("usage: python -m benchmarks.compare OLD.json NEW.json")
+        sys.exit(2)
+    with open(argv[0]) as f:
+        old = json.load(f)
+    with open(argv[1]) as f:
+        new = json.load(f)
+
+    if old.get("params") != new.get("params"):
+        print("warning: benchmark parameters differ, results are not directly comparable")
+    print(f"{'metric':<45} {old.get('commit', 'old'):>12} {new.get('commit', 'new'):>12} {'change':>9}")
+
+    old_values = _flatten(old["results"])
+    new_values = _flatten(new["results"])
+    for name in sorted(set(old_values) | set(new_values)):
+        before, after = old_values.get(name), new_values.get(name)
+        change = ""
+        if before and after is not None:
+            change = f"{(after - before) / before * 100:+.1f}%"
+        print(f"{name:<45} {before if before is not None else '-':>12} {after if after is not None else '-':>12} {change:>9}")
+
+
+if __name__ == "__main__":
+    main()
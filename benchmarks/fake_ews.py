@@ -0,0 +1,383 @@
+"""
+benchmarks/fake_ews.py
+
+Локальный заменитель EWS (SOAP) для нагрузочных тестов.
+Поддерживает ровно те операции, которые выполняет services/mail_service через exchangelib
+или нативный клиент services/ews_client: ResolveNames и ConvertId (определение версии), GetFolder/FindFolder,
+FindItem, GetItem (вложения), SyncFolderItems, UpdateItem, CreateItem, а также pull-подписки
+(Subscribe, GetEvents, Unsubscribe). Streaming-подписки не поддерживаются: Subscribe отвечает ошибкой,
+как сервер, на котором они отключены. Авторизация — Basic, логин выбирает ящик.
+Отправленные письма не хранятся, запоминаются только их ключи outbox (поиск в «Отправленных»).
+
+Содержимое ящиков генерируется, а не хранится: в каждом ящике initial_unread старых
+непрочитанных писем, и с частотой mail_rate (писем в час) приходят новые. Время прихода
+письма вычисляется по его номеру, поэтому fake Telegram может посчитать задержку уведомления.
+Задержка ответа, доля ошибок и доля ответов ErrorServerBusy (throttling) настраиваются.
+"""
+import asyncio
+import base64
+import random
+import re
+import time
+import xml.etree.ElementTree as ET
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set
+from xml.sax.saxutils import escape
+
+from aiohttp import web
+
+SOAP_NS = "http://schemas.xmlsoap.org/soap/envelope/"
+M_NS = "http://schemas.microsoft.com/exchange/services/2006/messages"
+T_NS = "http://schemas.microsoft.com/exchange/services/2006/types"
+
+# Тема письма содержит номер ящика и номер письма — по ней fake Telegram находит время прихода
+SUBJECT_RE = re.compile(r"bench (\d+)-(\d+)")
+_ITEM_ID_RE = re.compile(r"AAM(\d+)x(\d+)")
+
+_FOLDERS = {
+    "root": ("Root", None),
+    "msgfolderroot": ("Top of Information Store", None),
+    "inbox": ("Inbox", "IPF.Note"),
+    "sentitems": ("Sent Items", "IPF.Note"),
+    "junkemail": ("Junk Email", "IPF.Note"),
+    "deleteditems": ("Deleted Items", "IPF.Note"),
+}
+
+
+def _ts(value: float) -> str:
+    return datetime.fromtimestamp(value, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class Mailbox:
+    """Генерируемый почтовый ящик: письма 0..initial-1 уже лежат, дальше приходят раз в period секунд"""
+
+    def __init__(self, index: int, login: str, initial: int, period: Optional[float], attachment_ratio: float):
+        self.index = index
+        self.login = login
+        self.initial = initial
+        self.period = period
+        self.attachment_ratio = attachment_ratio
+        self.created = time.time()
+        # Сдвиг, чтобы письма разных ящиков не приходили одновременно
+        self.offset = random.uniform(0, period) if period else 0.0
+        self.read: Set[int] = set()
+        # Ключи outbox отправленных писем
+        self.sent_keys: Set[str] = set()
+        # Действующие pull-подписки
+        self.subscriptions: Set[str] = set()
+        self._next_subscription = 0
+
+    def count(self, now: float) -> int:
+        """Сколько писем в ящике к моменту now"""
+        if not self.period or now < self.created + self.offset:
+            return self.initial
+        return self.initial + int((now - self.created - self.offset) // self.period) + 1
+
+    def deliver(self, count: int = 1):
+        """Кладёт в ящик count новых писем сразу (для тестов; время прихода — как у старых писем)"""
+        self.initial += count
+
+    def new_subscription(self) -> str:
+        self._next_subscription += 1
+        subscription_id = f"SUB{self.index}-{self._next_subscription}"
+        self.subscriptions.add(subscription_id)
+        return subscription_id
+
+    def arrival_time(self, number: int) -> float:
+        if number < self.initial:
+            return self.created - 3600
+        return self.created + self.offset + (number - self.initial) * self.period
+
+    def has_attachments(self, number: int) -> bool:
+        return (number * 2654435761 + self.index) % 1000 < self.attachment_ratio * 1000
+
+    def item_id(self, number: int) -> str:
+        return f"AAM{self.index}x{number}"
+
+    def message_xml(self, number: int, with_attachments: bool = False, body_size: Optional[int] = None) -> str:
+        parts = [
+            f'<t:ItemId Id="{self.item_id(number)}" ChangeKey="CQAAAB{number}"/>',
+            f"<t:Subject>bench {self.index}-{number}</t:Subject>",
+            f"<t:DateTimeReceived>{_ts(self.arrival_time(number))}</t:DateTimeReceived>",
+            f"<t:HasAttachments>{'true' if self.has_attachments(number) else 'false'}</t:HasAttachments>",
+            "<t:Sender><t:Mailbox><t:Name>Benchmark</t:Name>"
+            "<t:EmailAddress>sender@bench.local</t:EmailAddress><t:RoutingType>SMTP</t:RoutingType></t:Mailbox></t:Sender>",
+            f"<t:IsRead>{'true' if number in self.read else 'false'}</t:IsRead>",
+        ]
+        if with_attachments and self.has_attachments(number):
+            parts.append(
+                "<t:Attachments><t:FileAttachment>"
+                f'<t:AttachmentId Id="{self.item_id(number)}a0"/>'
+                "<t:Name>report.pdf</t:Name><t:ContentType>application/pdf</t:ContentType>"
+                f"<t:Size>{10000 + number}</t:Size>"
+                "</t:FileAttachment></t:Attachments>"
+            )
+        if body_size is not None:
+            # Тело письма текстом, обрезанное до MaximumBodySize (0 — без ограничения)
+            text = f"Benchmark message {self.index}-{number}. " * 40
+            parts.append(f'<t:Body BodyType="Text">{escape(text[:body_size] if body_size else text)}</t:Body>')
+        return "<t:Message>" + "".join(parts) + "</t:Message>"
+
+
+class FakeEWS:
+    def __init__(
+        self,
+        initial_unread: int = 5,
+        mail_rate: float = 6.0,
+        latency: float = 0.05,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        attachment_ratio: float = 0.2,
+    ):
+        self.initial_unread = initial_unread
+        self.period = 3600 / mail_rate if mail_rate > 0 else None
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.attachment_ratio = attachment_ratio
+        self.mailboxes: Dict[str, Mailbox] = {}
+        self.by_index: List[Mailbox] = []
+        self.requests: Counter = Counter()
+        self.errors: Counter = Counter()
+
+    def mailbox(self, login: str) -> Mailbox:
+        key = login.lower()
+        box = self.mailboxes.get(key)
+        if box is None:
+            box = Mailbox(len(self.by_index), login, self.initial_unread, self.period, self.attachment_ratio)
+            self.mailboxes[key] = box
+            self.by_index.append(box)
+        return box
+
+    def arrival_time(self, index: int, number: int) -> Optional[float]:
+        """Время прихода нового письма (None для писем, лежавших в ящике до начала теста)"""
+        if index >= len(self.by_index) or number < self.by_index[index].initial:
+            return None
+        return self.by_index[index].arrival_time(number)
+
+    def stats(self) -> Dict[str, object]:
+        return {"requests": dict(self.requests), "errors": dict(self.errors), "mailboxes": len(self.by_index)}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        auth = request.headers.get("Authorization", "")
+        if not auth.startswith("Basic "):
+            # exchangelib определяет способ авторизации по заголовку ответа 401
+            return web.Response(status=401, headers={"WWW-Authenticate": 'Basic realm="bench"'})
+        login = base64.b64decode(auth[6:]).decode().split(":", 1)[0]
+
+        body = ET.fromstring(await request.read()).find(f"{{{SOAP_NS}}}Body")[0]
+        operation = body.tag.split("}", 1)[1]
+        self.requests[operation] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+        if operation not in ("ResolveNames", "ConvertId"):
+            roll = random.random()
+            if roll < self.error_rate:
+                self.errors["internal"] += 1
+                return self._fault("ErrorInternalServerError", "An internal server error occurred. The operation failed.")
+            if roll < self.error_rate + self.throttle_rate:
+                self.errors["server_busy"] += 1
+                return self._xml(self._response(operation, [self._error(
+                    operation, "ErrorServerBusy", "The server cannot service this request right now. Try again later.",
+                    backoff_ms=random.randint(1000, 5000),
+                )]))
+
+        handler = getattr(self, f"_op_{operation}", None)
+        if handler is None:
+            return self._fault("ErrorInvalidRequest", f"Operation {operation} is not supported by the fake server")
+        return self._xml(self._response(operation, handler(self.mailbox(login), body)))
+
+    # --- операции ---
+
+    def _op_ResolveNames(self, box: Mailbox, body: ET.Element) -> List[str]:
+        return [self._error("ResolveNames", "ErrorNameResolutionNoResults", "No results were found.")]
+
+    def _op_ConvertId(self, box: Mailbox, body: ET.Element) -> List[str]:
+        # exchangelib узнаёт версию сервера из заголовка ответа на ConvertId с фиктивным id
+        return [self._error("ConvertId", "ErrorInvalidIdMalformed", "Id is malformed.")]
+
+    def _op_GetFolder(self, box: Mailbox, body: ET.Element) -> List[str]:
+        messages = []
+        for folder in body.find(f"{{{M_NS}}}FolderIds"):
+            name = folder.get("Id", "").rsplit("-", 1)[-1]
+            display_name, folder_class = _FOLDERS.get(name, ("Folder", "IPF.Note"))
+            total = box.count(time.time()) if name == "inbox" else 0
+            folder_xml = (
+                f'<t:Folder><t:FolderId Id="AAF{box.index}-{name}" ChangeKey="AQAAAA=="/>'
+                + (f"<t:FolderClass>{folder_class}</t:FolderClass>" if folder_class else "")
+                + f"<t:DisplayName>{display_name}</t:DisplayName>"
+                f"<t:TotalCount>{total}</t:TotalCount><t:ChildFolderCount>0</t:ChildFolderCount>"
+                f"<t:UnreadCount>{max(total - len(box.read), 0)}</t:UnreadCount></t:Folder>"
+            )
+            messages.append(self._ok("GetFolder", f"<m:Folders>{folder_xml}</m:Folders>"))
+        return messages
+
+    def _op_FindFolder(self, box: Mailbox, body: ET.Element) -> List[str]:
+        return [self._ok(
+            "FindFolder",
+            '<m:RootFolder IndexedPagingOffset="0" TotalItemsInView="0" IncludesLastItemInRange="true"><t:Folders/></m:RootFolder>',
+        )]
+
+    def _op_FindItem(self, box: Mailbox, body: ET.Element) -> List[str]:
+        folder = body.find(f"{{{M_NS}}}ParentFolderIds/{{{T_NS}}}DistinguishedFolderId")
+        if folder is not None and folder.get("Id") == "sentitems":
+            return [self._find_sent(box, body)]
+        view = body.find(f"{{{M_NS}}}IndexedPageItemView")
+        limit = int(view.get("MaxEntriesReturned", 100)) if view is not None else 100
+        offset = int(view.get("Offset", 0)) if view is not None else 0
+        # Единственный фильтр, который использует бот, — непрочитанные письма
+        unread_only = body.find(f"{{{M_NS}}}Restriction") is not None
+        numbers = [n for n in range(box.count(time.time()) - 1, -1, -1) if not (unread_only and n in box.read)]
+        page = numbers[offset:offset + limit]
+        last = offset + len(page) >= len(numbers)
+        items = "".join(box.message_xml(n) for n in page)
+        return [self._ok(
+            "FindItem",
+            f'<m:RootFolder IndexedPagingOffset="{offset + len(page)}" TotalItemsInView="{len(numbers)}" '
+            f'IncludesLastItemInRange="{"true" if last else "false"}"><t:Items>{items}</t:Items></m:RootFolder>',
+        )]
+
+    def _find_sent(self, box: Mailbox, body: ET.Element) -> str:
+        """Поиск отправленных писем по ключу outbox"""
+        keys = {c.get("Value") for c in body.iter(f"{{{T_NS}}}Constant")} & box.sent_keys
+        items = "".join(
+            f'<t:Message><t:ItemId Id="AAS{box.index}x{escape(key)}" ChangeKey="CQAAAD"/><t:ExtendedProperty>'
+            '<t:ExtendedFieldURI DistinguishedPropertySetId="PublicStrings" PropertyName="MailBotOutboxKey" PropertyType="String"/>'
+            f"<t:Value>{escape(key)}</t:Value></t:ExtendedProperty></t:Message>"
+            for key in sorted(keys)
+        )
+        return self._ok(
+            "FindItem",
+            f'<m:RootFolder IndexedPagingOffset="{len(keys)}" TotalItemsInView="{len(keys)}" '
+            f'IncludesLastItemInRange="true"><t:Items>{items}</t:Items></m:RootFolder>',
+        )
+
+    def _op_GetItem(self, box: Mailbox, body: ET.Element) -> List[str]:
+        fields = {uri.get("FieldURI") for uri in body.iter(f"{{{T_NS}}}FieldURI")}
+        body_size = int(body.findtext(f".//{{{T_NS}}}MaximumBodySize") or 0) if "item:Body" in fields else None
+        messages = []
+        for item_id in body.iter(f"{{{T_NS}}}ItemId"):
+            match = _ITEM_ID_RE.fullmatch(item_id.get("Id", ""))
+            if not match:
+                messages.append(self._error("GetItem", "ErrorItemNotFound", "The specified object was not found in the store."))
+                continue
+            message = box.message_xml(int(match.group(2)), with_attachments=True, body_size=body_size)
+            messages.append(self._ok("GetItem", f"<m:Items>{message}</m:Items>"))
+        return messages
+
+    def _op_SyncFolderItems(self, box: Mailbox, body: ET.Element) -> List[str]:
+        state_elem = body.find(f"{{{M_NS}}}SyncState")
+        state = int(state_elem.text) if state_elem is not None and state_elem.text else 0
+        max_changes = int(body.findtext(f"{{{M_NS}}}MaxChangesReturned") or 100)
+        total = box.count(time.time())
+        end = min(total, state + max_changes)
+        changes = "".join(f"<t:Create>{box.message_xml(n)}</t:Create>" for n in range(state, end))
+        return [self._ok(
+            "SyncFolderItems",
+            f"<m:SyncState>{end}</m:SyncState>"
+            f"<m:IncludesLastItemInRange>{'true' if end >= total else 'false'}</m:IncludesLastItemInRange>"
+            f"<m:Changes>{changes}</m:Changes>",
+        )]
+
+    def _op_UpdateItem(self, box: Mailbox, body: ET.Element) -> List[str]:
+        messages = []
+        for item_id in body.iter(f"{{{T_NS}}}ItemId"):
+            match = _ITEM_ID_RE.fullmatch(item_id.get("Id", ""))
+            if match:
+                box.read.add(int(match.group(2)))
+            messages.append(self._ok(
+                "UpdateItem",
+                f'<m:Items><t:Message><t:ItemId Id="{escape(item_id.get("Id", ""))}" ChangeKey="CQAAAC"/></t:Message></m:Items>'
+                "<m:ConflictResults><t:Count>0</t:Count></m:ConflictResults>",
+            ))
+        return messages
+
+    def _op_CreateItem(self, box: Mailbox, body: ET.Element) -> List[str]:
+        messages = []
+        for message in body.find(f"{{{M_NS}}}Items"):
+            key = message.findtext(f"{{{T_NS}}}ExtendedProperty/{{{T_NS}}}Value")
+            if key:
+                box.sent_keys.add(key)
+            messages.append(self._ok("CreateItem", "<m:Items/>"))
+        return messages
+
+    def _op_Subscribe(self, box: Mailbox, body: ET.Element) -> List[str]:
+        if body.find(f"{{{M_NS}}}PullSubscriptionRequest") is None:
+            return [self._error("Subscribe", "ErrorInvalidSubscriptionRequest", "Only pull subscriptions are supported.")]
+        # Водяной знак — число писем в ящике: события — письма, пришедшие после него
+        return [self._ok(
+            "Subscribe",
+            f"<m:SubscriptionId>{box.new_subscription()}</m:SubscriptionId>"
+            f"<m:Watermark>{box.count(time.time())}</m:Watermark>",
+        )]
+
+    def _op_GetEvents(self, box: Mailbox, body: ET.Element) -> List[str]:
+        subscription_id = body.findtext(f"{{{M_NS}}}SubscriptionId") or ""
+        if subscription_id not in box.subscriptions:
+            return [self._error("GetEvents", "ErrorSubscriptionNotFound", "The specified subscription was not found.")]
+        watermark = int(body.findtext(f"{{{M_NS}}}Watermark") or 0)
+        total = box.count(time.time())
+        parent = f'<t:ParentFolderId Id="AAF{box.index}-inbox" ChangeKey="AQAAAA=="/>'
+        events = "".join(
+            f"<t:NewMailEvent><t:Watermark>{n + 1}</t:Watermark><t:TimeStamp>{_ts(box.arrival_time(n))}</t:TimeStamp>"
+            f'<t:ItemId Id="{box.item_id(n)}" ChangeKey="CQAAAB{n}"/>{parent}</t:NewMailEvent>'
+            for n in range(watermark, total)
+        ) or f"<t:StatusEvent><t:Watermark>{watermark}</t:Watermark></t:StatusEvent>"
+        return [self._ok(
+            "GetEvents",
+            f"<m:Notification><t:SubscriptionId>{escape(subscription_id)}</t:SubscriptionId>"
+            f"<t:PreviousWatermark>{watermark}</t:PreviousWatermark><t:MoreEvents>false</t:MoreEvents>"
+            f"{events}</m:Notification>",
+        )]
+
+    def _op_Unsubscribe(self, box: Mailbox, body: ET.Element) -> List[str]:
+        box.subscriptions.discard(body.findtext(f"{{{M_NS}}}SubscriptionId") or "")
+        return [self._ok("Unsubscribe")]
+
+    # --- формирование ответов ---
+
+    @staticmethod
+    def _ok(operation: str, content: str = "") -> str:
+        return (
+            f'<m:{operation}ResponseMessage ResponseClass="Success"><m:ResponseCode>NoError</m:ResponseCode>'
+            f"{content}</m:{operation}ResponseMessage>"
+        )
+
+    @staticmethod
+    def _error(operation: str, code: str, text: str, backoff_ms: Optional[int] = None) -> str:
+        extra = (
+            f'<m:MessageXml><t:Value Name="BackOffMilliseconds">{backoff_ms}</t:Value></m:MessageXml>'
+            if backoff_ms else ""
+        )
+        return (
+            f'<m:{operation}ResponseMessage ResponseClass="Error"><m:MessageText>{escape(text)}</m:MessageText>'
+            f"<m:ResponseCode>{code}</m:ResponseCode><m:DescriptiveLinkKey>0</m:DescriptiveLinkKey>{extra}"
+            f"</m:{operation}ResponseMessage>"
+        )
+
+    @staticmethod
+    def _response(operation: str, messages: List[str]) -> str:
+        return (
+            f'<m:{operation}Response xmlns:m="{M_NS}" xmlns:t="{T_NS}">'
+            f"<m:ResponseMessages>{''.join(messages)}</m:ResponseMessages></m:{operation}Response>"
+        )
+
+    @staticmethod
+    def _xml(body: str, status: int = 200) -> web.Response:
+        text = (
+            f'<?xml version="1.0" encoding="utf-8"?><s:Envelope xmlns:s="{SOAP_NS}"><s:Header>'
+            f'<h:ServerVersionInfo xmlns:h="{T_NS}" MajorVersion="15" MinorVersion="1" MajorBuildNumber="2507" '
+            f'MinorBuildNumber="6" Version="V2017_07_11"/></s:Header><s:Body>{body}</s:Body></s:Envelope>'
+        )
+        return web.Response(text=text, status=status, content_type="text/xml", charset="utf-8")
+
+    def _fault(self, code: str, text: str) -> web.Response:
+        return self._xml(
+            f'<s:Fault><faultcode xmlns:a="{T_NS}">a:{code}</faultcode><faultstring xml:lang="en-US">{escape(text)}</faultstring>'
+            f'<detail><e:ResponseCode xmlns:e="http://schemas.microsoft.com/exchange/services/2006/errors">{code}</e:ResponseCode>'
+            f'<e:Message xmlns:e="http://schemas.microsoft.com/exchange/services/2006/errors">{escape(text)}</e:Message></detail></s:Fault>',
+            status=500,
+        )
@@ -0,0 +1,84 @@
+"""
+benchmarks/fake_telegram.py
+
+Локальный заменитель Telegram Bot API для нагрузочных тестов.
+Отвечает на sendMessage (и подтверждает остальные методы), по темам писем в тексте
+уведомления находит время их прихода в fake EWS и считает задержку доставки.
+Может отвечать 429 (flood control) с заданной вероятностью.
+"""
+import asyncio
+import random
+import time
+from itertools import count
+from typing import Any, Dict, List, Set, Tuple
+
+from aiohttp import web
+
+from benchmarks.fake_ews import FakeEWS, SUBJECT_RE
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+
+    return {"p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": round(ordered[-1], 4), "count": len(ordered)}
+
+
+class FakeTelegram:
+    def __init__(self, ews: FakeEWS, latency: float = 0.03, retry_rate: float = 0.0):
+        self.ews = ews
+        self.latency = latency
+        self.retry_rate = retry_rate
+        self.messages = 0
+        self.retries = 0
+        self.latencies: List[float] = []
+        # Письма, о которых уже было уведомление (повторы при опросе непрочитанных не считаем)
+        self._notified: Set[Tuple[int, int]] = set()
+        self._message_ids = count(1)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "messages": self.messages,
+            "retry_after": self.retries,
+            "emails_notified": len(self._notified),
+            "notification_latency": percentiles(self.latencies),
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+        if method != "sendMessage":
+            return web.json_response({"ok": True, "result": True})
+
+        if random.random() < self.retry_rate:
+            self.retries += 1
+            return web.json_response(
+                {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1}},
+                status=429,
+            )
+
+        now = time.time()
+        self.messages += 1
+        for index, number in SUBJECT_RE.findall(str(data.get("text", ""))):
+            key = (int(index), int(number))
+            if key in self._notified:
+                continue
+            self._notified.add(key)
+            arrived = self.ews.arrival_time(*key)
+            if arrived is not None:
+                self.latencies.append(max(now - arrived, 0.0))
+
+        chat_id = int(data.get("chat_id", 0))
+        return web.json_response({"ok": True, "result": {
+            "message_id": next(self._message_ids),
+            "date": int(now),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": str(data.get("text", "")),
+        }})
@@ -0,0 +1,270 @@
+"""
+benchmarks/run.py
+
+Сквозной нагрузочный тест: настоящий Poller, services/mail_service (exchangelib или нативный
+asyncio-клиент, --ews-backend) и отправка уведомлений работают против локальных fake EWS и fake Telegram Bot API.
+Заменители запускаются в отдельном процессе, поэтому CPU и память меряются только у бота.
+
+Запуск из корня репозитория:
+    python -m benchmarks.run --users 1000 --duration 120
+    python -m benchmarks.run --users 10000 --interval 600 --fetch-unread --direct-notify
+    python -m benchmarks.run --users 10000 --ews-backend aiohttp
+Результат сохраняется в JSON (по умолчанию benchmarks/results/<commit>-<время>.json);
+два результата сравнивает python -m benchmarks.compare old.json new.json.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import socket
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict
+
+from aiohttp import ClientSession, web
+
+from benchmarks.fake_ews import FakeEWS
+from benchmarks.fake_telegram import FakeTelegram
+
+logger = logging.getLogger(__name__)
+
+BOT_TOKEN = "123456:BENCHMARK"
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="End-to-end poller benchmark against fake EWS and Telegram servers")
+    parser.add_argument("--users", type=int, default=1000, help="number of mailboxes")
+    parser.add_argument("--duration", type=float, default=60, help="measured run time, seconds")
+    parser.add_argument("--interval", type=int, default=60, help="poll interval per user, seconds")
+    parser.add_argument("--workers", type=int, default=4, help="POLL_WORKERS")
+    parser.add_argument("--concurrency", type=int, default=10, help="POLL_MAX_CONCURRENCY and POLL_PER_SERVER_CONCURRENCY")
+    parser.add_argument("--ews-rate", type=float, default=20, help="MAIL_EWS_RATE: governor admission rate, requests/sec")
+    parser.add_argument("--ews-backend", choices=("exchangelib", "aiohttp"), default="exchangelib", help="MAIL_EWS_BACKEND")
+    parser.add_argument("--preview-chars", type=int, default=0, help="MAIL_PREVIEW_CHARS: text preview length in notifications")
+    parser.add_argument("--fetch-unread", action="store_true", help="poll with fetch_unread_emails instead of SyncFolderItems")
+    parser.add_argument("--direct-notify", action="store_true", help="call notify_user_new_email instead of the notifier queue")
+    parser.add_argument("--mail-rate", type=float, default=6.0, help="new emails per mailbox per hour")
+    parser.add_argument("--initial-unread", type=int, default=5, help="unread emails in each mailbox at start")
+    parser.add_argument("--attachment-ratio", type=float, default=0.2, help="share of emails with attachments")
+    parser.add_argument("--ews-latency", type=float, default=0.05, help="mean fake EWS response time, seconds")
+    parser.add_argument("--ews-error-rate", type=float, default=0.0, help="share of EWS requests failing with a SOAP fault")
+    parser.add_argument("--ews-throttle-rate", type=float, default=0.0, help="share of EWS requests answered ErrorServerBusy")
+    parser.add_argument("--tg-latency", type=float, default=0.03, help="mean fake Telegram response time, seconds")
+    parser.add_argument("--tg-retry-rate", type=float, default=0.0, help="share of sendMessage calls answered 429")
+    parser.add_argument("--output", help="result file (default: benchmarks/results/<commit>-<time>.json)")
+    return parser.parse_args(argv)
+
+
+# --- процесс с заменителями серверов ---
+
+def serve_fakes(options: Dict[str, Any], conn):
+    asyncio.run(_serve_fakes(options, conn))
+
+
+async def _serve_fakes(options: Dict[str, Any], conn):
+    ews = FakeEWS(
+        initial_unread=options["initial_unread"],
+        mail_rate=options["mail_rate"],
+        latency=options["ews_latency"],
+        error_rate=options["ews_error_rate"],
+        throttle_rate=options["ews_throttle_rate"],
+        attachment_ratio=options["attachment_ratio"],
+    )
+    telegram = FakeTelegram(ews, latency=options["tg_latency"], retry_rate=options["tg_retry_rate"])
+
+    async def handle_stats(request: web.Request) -> web.Response:
+        return web.json_response({"ews": ews.stats(), "telegram": telegram.stats()})
+
+    app = web.Application()
+    app.router.add_post("/EWS/Exchange.asmx", ews.handle)
+    app.router.add_post("/bot{token}/{method}", telegram.handle)
+    app.router.add_get("/_stats", handle_stats)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    await web.SockSite(runner, sock).start()
+    conn.send(sock.getsockname()[1])
+
+    # Работаем, пока родительский процесс не попросит остановиться
+    await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+    await runner.cleanup()
+
+
+# --- процесс бота ---
+
+def _configure_env(args: argparse.Namespace, base_url: str):
+    """Настройки бота для теста; модули бота читают их при импорте"""
+    os.environ.update({
+        "BOT_TOKEN": BOT_TOKEN,
+        "MAIL_SERVER": f"{base_url}/EWS/Exchange.asmx",
+        "MAIL_ACCOUNT_CACHE_SIZE": str(args.users),
+        "POLL_WORKERS": str(args.workers),
+        "POLL_MAX_CONCURRENCY": str(args.concurrency),
+        "POLL_PER_SERVER_CONCURRENCY": str(args.concurrency),
+        "MAIL_EWS_RATE": str(args.ews_rate),
+        "MAIL_EWS_BURST": str(args.ews_rate),
+        "MAIL_EWS_BACKEND": args.ews_backend,
+        "MAIL_EWS_CONNECTIONS": str(args.concurrency),
+        "MAIL_EWS_BACKGROUND_WORKERS": str(args.concurrency),
+        "MAIL_PREVIEW_CHARS": str(args.preview_chars),
+        "POLL_INCREMENTAL": "false" if args.fetch_unread else "true",
+        # Все уровни адаптивного интервала равны --interval: каждый ящик опрашивается с одной частотой
+        "POLL_ADAPTIVE": "true",
+        "POLL_MIN_INTERVAL": str(args.interval),
+        "POLL_MAX_LATENCY": str(args.interval),
+        "POLL_DORMANT_INTERVAL": str(args.interval),
+        "POLL_WARMUP_SECONDS": str(args.interval),
+        "POLLER_MODE": "local",
+        "METRICS_ENABLED": "false",
+    })
+
+
+def _cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+async def run_benchmark(args: argparse.Namespace, base_url: str) -> Dict[str, Any]:
+    _configure_env(args, base_url)
+
+    # Импортируем после настройки окружения: config.load_config() вызывается при импорте хендлеров
+    from aiogram import Bot
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.enums import ParseMode
+
+    from app.tasks.notifier import Notifier
+    from app.tasks.poller import Poller
+    from config.config import load_config
+    from database.database import init_db
+    from services.executors import configure_lanes
+    from services.mail_service import close_backend, configure_account_pool, configure_backend, on_user_changed
+    from services.metrics import POLLS, POLL_NEW_EMAILS
+    from services.previews import configure_previews
+    from services.throttling import configure_governors
+
+    config = load_config()
+    workdir = tempfile.mkdtemp(prefix="mail-bench-")
+    db = init_db(os.path.join(workdir, "users.db"))
+    for telegram_id in range(1, args.users + 1):
+        db.add_user(telegram_id, f"user{telegram_id}@bench.local", "secret")
+    await db.flush()
+
+    configure_account_pool(config.mail.account_cache_size, config.mail.account_idle_ttl)
+    configure_governors(
+        rate=config.mail.ews_rate,
+        burst=config.mail.ews_burst,
+        max_wait=config.mail.ews_max_wait,
+        backoff=config.mail.ews_backoff,
+        max_backoff=config.mail.ews_max_backoff,
+        ramp_seconds=config.mail.ews_ramp_seconds,
+    )
+    configure_lanes(
+        interactive_workers=config.mail.interactive_workers,
+        interactive_timeout=config.mail.interactive_timeout,
+        background_workers=config.mail.background_workers,
+        background_timeout=config.mail.background_timeout,
+    )
+    configure_backend(config.mail.ews_backend, config.mail.ews_connections)
+    configure_previews(config.mail.preview_chars, config.mail.preview_cache_size)
+    db.listeners.append(on_user_changed)
+
+    bot = Bot(
+        token=BOT_TOKEN,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(base_url)),
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    )
+    notifier = None
+    if not args.direct_notify:
+        notifier = Notifier(config, bot)
+        notifier.start()
+    poller = Poller(db, config, bot, notifier=notifier)
+
+    cpu_start = _cpu_seconds()
+    started = time.monotonic()
+    poller_task = asyncio.create_task(poller.poll_loop())
+    await asyncio.sleep(args.duration)
+    poller.stop()
+    poller_task.cancel()
+    await asyncio.gather(poller_task, return_exceptions=True)
+    elapsed = time.monotonic() - started
+    if notifier:
+        await notifier.stop()
+    cpu = _cpu_seconds() - cpu_start
+
+    async with ClientSession() as session:
+        async with session.get(f"{base_url}/_stats") as response:
+            fake_stats = await response.json()
+
+    await bot.session.close()
+    await close_backend()
+    await db.close()
+
+    outcomes = {outcome: POLLS.value(outcome) for outcome in ("success", "rate_limited", "backoff")}
+    polls = sum(outcomes.values())
+    return {
+        "polls": polls,
+        "polls_per_sec": round(polls / elapsed, 2),
+        "poll_outcomes": outcomes,
+        "new_emails": POLL_NEW_EMAILS.value(),
+        "notification_latency": fake_stats["telegram"]["notification_latency"],
+        "notifications": {key: fake_stats["telegram"][key] for key in ("messages", "retry_after", "emails_notified")},
+        "ews": fake_stats["ews"],
+        "cpu_seconds": round(cpu, 2),
+        "cpu_utilisation": round(cpu / elapsed, 3),
+        # На Linux ru_maxrss в килобайтах
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "elapsed": round(elapsed, 2),
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    context = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = context.Pipe()
+    fakes = context.Process(target=serve_fakes, args=(vars(args), child_conn), daemon=True)
+    fakes.start()
+    base_url = f"http://127.0.0.1:{parent_conn.recv()}"
+    try:
+        results = asyncio.run(run_benchmark(args, base_url))
+    finally:
+        parent_conn.send("stop")
+        fakes.join(timeout=5)
+
+    commit = _git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": datetime.utcnow().isoformat(timespec="seconds"),
+        "params": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results,
+    }
+    output = Path(args.output) if args.output else RESULTS_DIR / f"{commit}-{datetime.utcnow():%Y%m%dT%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    print(f"Saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
-from dataclasses import dataclass
+import os
+import socket
+from dataclasses import dataclass, field
 from environs import Env
 
 
@@ -12,11 +14,91 @@ class MailSettings:
     server: str
     port: int
     verify_ssl: bool = True
+    account_cache_size: int = 256  # сколько подключений EWS держать открытыми
+    account_idle_ttl: int = 900  # через сколько секунд простоя подключение закрывается
+    actions_window: float = 2.0  # сколько секунд копить действия с письмами перед пакетной отправкой
+    max_attachment_size: int = 20 * 1024 * 1024  # максимальный размер одного вложения (лимит Bot API на скачивание)
+    max_attachments_total: int = 25 * 1024 * 1024  # максимальный суммарный размер вложений письма
+    attachment_spool_size: int = 1024 * 1024  # до какого размера вложение держится в памяти, дальше — на диске
+    ews_rate: float = 20  # запросов в секунду к одному EWS-серверу (на процесс)
+    ews_burst: float = 20  # сколько запросов можно отправить разом сверх средней частоты
+    ews_max_wait: float = 10  # сколько секунд запрос может ждать разрешения, прежде чем считать сервер перегруженным
+    ews_backoff: float = 5  # начальная пауза при перегрузке сервера, если он не указал свою
+    ews_max_backoff: float = 300  # максимальная пауза при перегрузке сервера
+    ews_ramp_seconds: float = 60  # за сколько секунд частота запросов возвращается к норме после сбоя
+    unread_cache_ttl: float = 60  # сколько секунд результат /check_mail считается свежим
+    unread_cache_max_stale: float = 900  # до какого возраста результат отдаётся сразу с обновлением в фоне
+    attachment_cache_dir: str = "attachment_cache"  # каталог кэша вложений писем, пересылаемых в Telegram
+    attachment_cache_size: int = 1024 * 1024 * 1024  # максимальный размер кэша вложений на диске, байт
+    outbox_workers: int = 2  # сколько учётных записей очередь исходящих писем обслуживает одновременно
+    outbox_batch: int = 10  # максимум писем одной учётной записи в одном запросе CreateItem
+    # Бэкенд exchangelib читает каждое вложение пакета в память целиком (в base64 — ещё в 4/3 раза больше),
+    # поэтому этот предел ограничивает и память на одну отправку; нативный клиент передаёт вложения потоком
+    outbox_batch_bytes: int = 10 * 1024 * 1024  # максимум вложений в одном запросе CreateItem, байт (большое письмо уходит отдельно)
+    outbox_max_attempts: int = 5  # сколько раз пытаться отправить письмо, прежде чем сообщить об ошибке
+    interactive_workers: int = 8  # потоков для запросов EWS, которых ждёт пользователь
+    interactive_timeout: float = 60  # таймаут запроса пользователя к EWS (очередь + выполнение), секунд
+    background_workers: int = 8  # потоков для фоновых запросов EWS (poller)
+    background_timeout: float = 120  # таймаут фонового запроса к EWS, секунд
+    ews_backend: str = "exchangelib"  # exchangelib или aiohttp — нативный asyncio-клиент для опроса и отправки (только Basic)
+    ews_connections: int = 100  # максимум соединений нативного клиента к EWS
+    preview_chars: int = 0  # длина превью текста письма в уведомлениях и /check_mail (0 — без превью)
+    preview_cache_size: int = 10000  # сколько превью писем помнить, чтобы не запрашивать тело повторно
 
 
 @dataclass
 class PollerSettings:
     slot_seconds: int
+    workers: int = 10  # количество параллельных воркеров опроса (по умолчанию — как max_concurrency)
+    max_concurrency: int = 10  # общий лимит одновременных запросов к EWS
+    per_server_concurrency: int = 4  # лимит одновременных запросов к одному EWS-серверу
+    incremental: bool = True  # инкрементальная синхронизация (SyncFolderItems) вместо выборки всех непрочитанных
+    adaptive: bool = True  # адаптивный интервал по частоте писем и активности пользователя вместо slot_seconds * N
+    min_interval: int = 60  # минимальный интервал опроса, секунд
+    max_latency: int = 900  # максимальная задержка уведомления для не «спящих» пользователей, секунд
+    interactive_window: int = 1800  # сколько секунд после сообщения боту пользователь опрашивается с min_interval
+    dormant_after_days: int = 14  # через сколько дней без активности и почты пользователь считается «спящим»
+    dormant_interval: int = 3600  # интервал опроса «спящих» пользователей, секунд
+    warmup_seconds: int = 120  # окно, по которому при старте распределяются просроченные опросы
+    shutdown_timeout: int = 10  # сколько секунд при остановке ждать завершения текущих опросов
+    mode: str = "local"  # local — один poller в процессе бота; lease — несколько poller'ов с арендой пользователей
+    embedded: bool = True  # запускать poller внутри процесса бота (в режиме lease можно вынести в poller_main.py)
+    instance_id: str = field(default_factory=lambda: f"{socket.gethostname()}-{os.getpid()}")
+    lease_seconds: int = 60  # время жизни аренды; столько ждут пользователи упавшего экземпляра
+    lease_batch: int = 50  # сколько пользователей арендовать за раз
+    max_leased: int = 500  # максимум пользователей в аренде у одного экземпляра
+
+
+@dataclass
+class SubscriptionSettings:
+    enabled: bool = False  # push-обнаружение новой почты через подписки EWS
+    max_streams: int = 50  # сколько пользователей держать на streaming-подписке (по соединению на каждого)
+    stream_timeout_minutes: int = 5  # длительность одного соединения GetStreamingEvents
+    pull_interval: int = 30  # как часто опрашивать pull-подписки, секунд
+    pull_concurrency: int = 4  # одновременных запросов GetEvents
+    retry_seconds: int = 3600  # через сколько повторить подписку после отката на обычный poller
+
+
+@dataclass
+class NotifierSettings:
+    global_rate: float = 25  # сообщений в секунду на весь бот (лимит Bot API — около 30)
+    per_chat_rate: float = 1  # сообщений в секунду в один чат
+    workers: int = 4  # воркеров доставки
+    digest_max_items: int = 10  # сколько писем объединять в одно сводное сообщение
+
+
+@dataclass
+class SearchSettings:
+    retention_days: int = 90  # сколько дней хранить заголовки писем в локальном индексе
+    max_per_user: int = 5000  # максимум писем в индексе одного пользователя
+    results: int = 10  # сколько писем показывать в ответ на /search
+
+
+@dataclass
+class MetricsSettings:
+    enabled: bool = False  # отдавать метрики Prometheus по HTTP
+    host: str = "127.0.0.1"
+    port: int = 9108
 
 
 @dataclass
@@ -31,6 +113,10 @@ class Config:
     mail: MailSettings
     poller: PollerSettings
     log: LogSettings
+    subscriptions: SubscriptionSettings
+    notifier: NotifierSettings
+    metrics: MetricsSettings
+    search: SearchSettings
 
 
 def load_config(path: str | None = None) -> Config:
@@ -41,13 +127,83 @@ def load_config(path: str | None = None) -> Config:
         mail=MailSettings(
             server=env("MAIL_SERVER", "mail.spbstu.ru"),
             port=env.int("MAIL_PORT", 443),
-            verify_ssl=env.bool("DEFAULT_VERIFY_SSL", True)
+            verify_ssl=env.bool("DEFAULT_VERIFY_SSL", True),
+            account_cache_size=env.int("MAIL_ACCOUNT_CACHE_SIZE", 256),
+            account_idle_ttl=env.int("MAIL_ACCOUNT_IDLE_TTL", 900),
+            actions_window=env.float("MAIL_ACTIONS_WINDOW", 2.0),
+            max_attachment_size=env.int("MAIL_MAX_ATTACHMENT_SIZE", 20 * 1024 * 1024),
+            max_attachments_total=env.int("MAIL_MAX_ATTACHMENTS_TOTAL", 25 * 1024 * 1024),
+            attachment_spool_size=env.int("MAIL_ATTACHMENT_SPOOL_SIZE", 1024 * 1024),
+            ews_rate=env.float("MAIL_EWS_RATE", 20),
+            ews_burst=env.float("MAIL_EWS_BURST", 20),
+            ews_max_wait=env.float("MAIL_EWS_MAX_WAIT", 10),
+            ews_backoff=env.float("MAIL_EWS_BACKOFF", 5),
+            ews_max_backoff=env.float("MAIL_EWS_MAX_BACKOFF", 300),
+            ews_ramp_seconds=env.float("MAIL_EWS_RAMP_SECONDS", 60),
+            unread_cache_ttl=env.float("MAIL_UNREAD_CACHE_TTL", 60),
+            unread_cache_max_stale=env.float("MAIL_UNREAD_CACHE_MAX_STALE", 900),
+            attachment_cache_dir=env.str("MAIL_ATTACHMENT_CACHE_DIR", "attachment_cache"),
+            attachment_cache_size=env.int("MAIL_ATTACHMENT_CACHE_SIZE", 1024 * 1024 * 1024),
+            outbox_workers=env.int("MAIL_OUTBOX_WORKERS", 2),
+            outbox_batch=env.int("MAIL_OUTBOX_BATCH", 10),
+            outbox_batch_bytes=env.int("MAIL_OUTBOX_BATCH_BYTES", 10 * 1024 * 1024),
+            outbox_max_attempts=env.int("MAIL_OUTBOX_MAX_ATTEMPTS", 5),
+            interactive_workers=env.int("MAIL_EWS_INTERACTIVE_WORKERS", 8),
+            interactive_timeout=env.float("MAIL_EWS_INTERACTIVE_TIMEOUT", 60),
+            background_workers=env.int("MAIL_EWS_BACKGROUND_WORKERS", 8),
+            background_timeout=env.float("MAIL_EWS_BACKGROUND_TIMEOUT", 120),
+            ews_backend=env("MAIL_EWS_BACKEND", "exchangelib"),
+            ews_connections=env.int("MAIL_EWS_CONNECTIONS", 100),
+            preview_chars=env.int("MAIL_PREVIEW_CHARS", 0),
+            preview_cache_size=env.int("MAIL_PREVIEW_CACHE_SIZE", 10000)
         ),
         poller=PollerSettings(
-            slot_seconds=env.int("POLL_SLOT_SECONDS", 300)
+            slot_seconds=env.int("POLL_SLOT_SECONDS", 300),
+            workers=env.int("POLL_WORKERS", 10),
+            max_concurrency=env.int("POLL_MAX_CONCURRENCY", 10),
+            per_server_concurrency=env.int("POLL_PER_SERVER_CONCURRENCY", 4),
+            incremental=env.bool("POLL_INCREMENTAL", True),
+            adaptive=env.bool("POLL_ADAPTIVE", True),
+            min_interval=env.int("POLL_MIN_INTERVAL", 60),
+            max_latency=env.int("POLL_MAX_LATENCY", 900),
+            interactive_window=env.int("POLL_INTERACTIVE_WINDOW", 1800),
+            dormant_after_days=env.int("POLL_DORMANT_AFTER_DAYS", 14),
+            dormant_interval=env.int("POLL_DORMANT_INTERVAL", 3600),
+            warmup_seconds=env.int("POLL_WARMUP_SECONDS", 120),
+            shutdown_timeout=env.int("POLL_SHUTDOWN_TIMEOUT", 10),
+            mode=env("POLLER_MODE", "local"),
+            embedded=env.bool("POLLER_EMBEDDED", True),
+            instance_id=env("POLLER_INSTANCE_ID", "") or f"{socket.gethostname()}-{os.getpid()}",
+            lease_seconds=env.int("POLLER_LEASE_SECONDS", 60),
+            lease_batch=env.int("POLLER_LEASE_BATCH", 50),
+            max_leased=env.int("POLLER_MAX_LEASED", 500)
         ),
         log=LogSettings(
             level=env("LOG_LEVEL", "INFO"),
             format=env("LOG_FORMAT", "%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        ),
+        subscriptions=SubscriptionSettings(
+            enabled=env.bool("SUBSCRIPTIONS_ENABLED", False),
+            max_streams=env.int("SUBSCRIPTIONS_MAX_STREAMS", 50),
+            stream_timeout_minutes=env.int("SUBSCRIPTIONS_STREAM_TIMEOUT_MINUTES", 5),
+            pull_interval=env.int("SUBSCRIPTIONS_PULL_INTERVAL", 30),
+            pull_concurrency=env.int("SUBSCRIPTIONS_PULL_CONCURRENCY", 4),
+            retry_seconds=env.int("SUBSCRIPTIONS_RETRY_SECONDS", 3600)
+        ),
+        notifier=NotifierSettings(
+            global_rate=env.float("NOTIFY_GLOBAL_RATE", 25),
+            per_chat_rate=env.float("NOTIFY_PER_CHAT_RATE", 1),
+            workers=env.int("NOTIFY_WORKERS", 4),
+            digest_max_items=env.int("NOTIFY_DIGEST_MAX_ITEMS", 10)
+        ),
+        metrics=MetricsSettings(
+            enabled=env.bool("METRICS_ENABLED", False),
+            host=env("METRICS_HOST", "127.0.0.1"),
+            port=env.int("METRICS_PORT", 9108)
+        ),
+        search=SearchSettings(
+            retention_days=env.int("SEARCH_RETENTION_DAYS", 90),
+            max_per_user=env.int("SEARCH_MAX_PER_USER", 5000),
+            results=env.int("SEARCH_RESULTS", 10)
         )
     )
\ No newline at end of file
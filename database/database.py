@@ -1,119 +1,598 @@
 # app/database.py
 
+import asyncio
+import logging
+import queue
 import sqlite3
 import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Callable, Awaitable, Sequence, Set, Tuple
+
+logger = logging.getLogger(__name__)
 
 # Путь к файлу базы данных
 DB_PATH = "users.db"
 
-# Глобальная блокировка для потокобезопасности
-_db_lock = threading.Lock()
+# Подписчик на изменения пользователя: (telegram_id, изменённые поля)
+UserListener = Callable[[int, Dict[str, Any]], None]
+
+# Запросы держим константами: sqlite3 кэширует подготовленные выражения по тексту запроса
+_USER_COLUMNS = (
+    "login, password, active, next_poll_at, poll_failures, created_at, sync_state, "
+    "mail_rate, last_polled_at, last_seen_at"
+)
+_SQL_ADD_USER = """
+    INSERT OR REPLACE INTO users (telegram_id, login, password, active, next_poll_at, poll_failures, created_at, sync_state,
+                                  mail_rate, last_polled_at, last_seen_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+_SQL_GET_USER = f"SELECT {_USER_COLUMNS} FROM users WHERE telegram_id = ?"
+_SQL_ALL_USER_IDS = "SELECT telegram_id FROM users"
+_SQL_ALL_USERS = f"SELECT telegram_id, {_USER_COLUMNS} FROM users"
+_SQL_ACTIVE_USER_IDS = "SELECT telegram_id FROM users WHERE active = 1"
+
+# Аренда пользователей экземплярами poller'а.
+# Выбирает до N пользователей, чьё время опроса наступит до заданного момента и кого никто не арендовал
+# (или чья аренда истекла), и атомарно записывает аренду на себя.
+_SQL_CLAIM_LEASES = f"""
+    UPDATE users SET lease_owner = ?, lease_until = ?
+    WHERE telegram_id IN (
+        SELECT telegram_id FROM users
+        WHERE active = 1 AND next_poll_at IS NOT NULL AND next_poll_at <= ?
+          AND (lease_owner IS NULL OR lease_owner = ? OR lease_until < ?)
+        ORDER BY next_poll_at
+        LIMIT ?
+    )
+    RETURNING telegram_id, {_USER_COLUMNS}
+"""
+_SQL_RENEW_LEASES = "UPDATE users SET lease_until = ? WHERE lease_owner = ?"
+_SQL_RELEASE_LEASE = "UPDATE users SET lease_owner = NULL, lease_until = NULL WHERE telegram_id = ? AND lease_owner = ?"
+_SQL_RELEASE_ALL_LEASES = "UPDATE users SET lease_owner = NULL, lease_until = NULL WHERE lease_owner = ?"
+_SQL_COUNT_ACTIVE = "SELECT COUNT(*) FROM users WHERE active = 1"
+
+# Токены кнопок действий с письмами (общие для бота и отдельных процессов poller'а)
+_SQL_SAVE_ACTION_TOKEN = "INSERT OR REPLACE INTO mail_action_tokens (token, telegram_id, items, created_at) VALUES (?, ?, ?, ?)"
+_SQL_GET_ACTION_TOKEN = "SELECT telegram_id, items FROM mail_action_tokens WHERE token = ?"
+_SQL_DELETE_OLD_ACTION_TOKENS = "DELETE FROM mail_action_tokens WHERE created_at < ?"
+
+# Состояния и данные FSM (черновики /send_email), общие для всех экземпляров бота
+_SQL_GET_FSM_RECORD = "SELECT state, data FROM fsm_storage WHERE key = ?"
+_SQL_SAVE_FSM_RECORD = "INSERT OR REPLACE INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?)"
+_SQL_DELETE_FSM_RECORD = "DELETE FROM fsm_storage WHERE key = ?"
+
+# Состояние фоновых задач, сохранённое при остановке (очередь уведомлений, паузы EWS-серверов)
+_SQL_SAVE_CHECKPOINT = "INSERT OR REPLACE INTO checkpoints (name, state, saved_at) VALUES (?, ?, ?)"
+_SQL_TAKE_CHECKPOINTS = "DELETE FROM checkpoints WHERE name LIKE ? RETURNING name, state, saved_at"
+
+# Очередь исходящих писем (outbox): обработчик только ставит письмо в очередь, отправляет фоновый OutboxSender
+_OUTBOX_COLUMNS = (
+    "id, idem_key, telegram_id, login, chat_id, message_id, recipients, subject, body, attachments, form_text, attempts"
+)
+_SQL_OUTBOX_ENQUEUE = """
+    INSERT OR IGNORE INTO outbox (idem_key, telegram_id, login, chat_id, message_id, recipients, subject, body, attachments,
+                                  form_text, status, attempts, next_attempt_at, created_at, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'queued', 0, ?, ?, ?)
+    RETURNING id
+"""
+# Забирает готовые к отправке письма; attempts увеличивается до отправки, чтобы повтор знал о прошлой попытке
+_SQL_OUTBOX_CLAIM = f"""
+    UPDATE outbox SET status = 'sending', attempts = attempts + 1, updated_at = ?
+    WHERE id IN (
+        SELECT id FROM outbox WHERE status = 'queued' AND next_attempt_at <= ? ORDER BY id LIMIT ?
+    )
+    RETURNING {_OUTBOX_COLUMNS}
+"""
+_SQL_OUTBOX_RETRY = "UPDATE outbox SET status = 'queued', next_attempt_at = ?, last_error = ?, updated_at = ? WHERE id = ?"
+_SQL_OUTBOX_FINISH = "UPDATE outbox SET status = ?, last_error = ?, updated_at = ? WHERE id = ?"
+_SQL_OUTBOX_RESET = "UPDATE outbox SET status = 'queued' WHERE status = 'sending'"
+_SQL_OUTBOX_NEXT_DUE = "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'queued'"
+_SQL_OUTBOX_DELETE_OLD = "DELETE FROM outbox WHERE status IN ('sent', 'failed') AND updated_at < ?"
 
+# Кэш вложений: псевдоним вложения (письмо + имя + размер) -> хэш содержимого -> file_id в Telegram
+_SQL_GET_ATTACHMENT_ALIAS = "SELECT sha256 FROM attachment_aliases WHERE alias = ?"
+_SQL_SAVE_ATTACHMENT_ALIAS = "INSERT OR IGNORE INTO attachment_aliases (alias, sha256, created_at) VALUES (?, ?, ?)"
+_SQL_DELETE_OLD_ATTACHMENT_ALIASES = "DELETE FROM attachment_aliases WHERE created_at < ?"
+_SQL_GET_ATTACHMENT_FILE_ID = "SELECT file_id FROM attachment_files WHERE sha256 = ?"
+_SQL_SAVE_ATTACHMENT_FILE_ID = "INSERT OR REPLACE INTO attachment_files (sha256, file_id, updated_at) VALUES (?, ?, ?)"
 
-def init_db() -> Dict[str, Any]:
+# Колонки, которые можно менять через update_user
+_UPDATABLE_COLUMNS = {
+    "login", "password", "active", "next_poll_at", "poll_failures", "sync_state",
+    "mail_rate", "last_polled_at", "last_seen_at",
+}
+
+
+def init_db(path: str = DB_PATH) -> "Database":
     """
     Инициализирует SQLite базу данных и возвращает объект для работы с ней
     """
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cursor = conn.cursor()
-    
-    # Создаем таблицу пользователей, если она не существует
+    return Database(path)
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, cached_statements=256)
+    # WAL: читатели не блокируют писателя и наоборот; synchronous=NORMAL — fsync только на checkpoint
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+def _migrate(cursor: sqlite3.Cursor):
+    """Добавляет в таблицу users колонки, появившиеся в новых версиях"""
+    cursor.execute("PRAGMA table_info(users)")
+    columns = {row[1] for row in cursor.fetchall()}
+    # Состояние инкрементальной синхронизации (SyncFolderItems) папки «Входящие»
+    if "sync_state" not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN sync_state TEXT")
+    # Статистика для адаптивного интервала опроса: писем в час, время последнего опроса и активности в боте
+    if "mail_rate" not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN mail_rate REAL DEFAULT 0")
+    if "last_polled_at" not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN last_polled_at TIMESTAMP")
+    if "last_seen_at" not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN last_seen_at TIMESTAMP")
+    # Аренда пользователя экземпляром poller'а (режим нескольких poller'ов)
+    if "lease_owner" not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN lease_owner TEXT")
+    if "lease_until" not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN lease_until TIMESTAMP")
+    cursor.execute("CREATE INDEX IF NOT EXISTS users_due ON users (active, next_poll_at)")
+    # Кнопки действий с письмами: общий для всех процессов реестр коротких токенов
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            telegram_id INTEGER PRIMARY KEY,
+        CREATE TABLE IF NOT EXISTS mail_action_tokens (
+            token TEXT PRIMARY KEY,
+            telegram_id INTEGER NOT NULL,
+            items TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL
+        )
+    """)
+    # Контрольные точки фоновых задач: сохраняются при остановке и забираются при следующем старте
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            name TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            saved_at TIMESTAMP NOT NULL
+        )
+    """)
+    # Очередь исходящих писем; idem_key — ключ идемпотентности (форма письма), он же метка письма в EWS
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            idem_key TEXT NOT NULL UNIQUE,
+            telegram_id INTEGER NOT NULL,
             login TEXT NOT NULL,
-            password TEXT NOT NULL,
-            active BOOLEAN DEFAULT 1,
-            next_poll_at TIMESTAMP,
-            poll_failures INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            chat_id INTEGER,
+            message_id INTEGER,
+            recipients TEXT NOT NULL,
+            subject TEXT,
+            body TEXT,
+            attachments TEXT,
+            form_text TEXT,
+            status TEXT NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL,
+            last_error TEXT,
+            created_at TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP NOT NULL
         )
     """)
-    conn.commit()
-    
-    # Возвращаем словарь с функциями для работы с базой данных
+    cursor.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+    # Вложения писем, пересланные в Telegram: повторно отправляются по file_id без загрузки
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS attachment_files (
+            sha256 TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            updated_at TIMESTAMP NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS attachment_aliases (
+            alias TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL
+        )
+    """)
+    # Хранилище FSM: состояние и данные (JSON) по ключу StorageKey
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at TIMESTAMP NOT NULL
+        )
+    """)
+
+
+# Нормализация текста для полнотекстового индекса: unicode61 не сводит «ё» к «е»
+_FTS_TEXT = "replace(replace(coalesce({0}, ''), 'ё', 'е'), 'Ё', 'Е')"
+_FTS_VALUES = "'u' || {0}.telegram_id, " + ", ".join(
+    _FTS_TEXT.format(f"{{0}}.{column}") for column in ("subject", "sender", "attachments")
+)
+
+
+def _create_header_index(cursor: sqlite3.Cursor) -> bool:
+    """
+    Создаёт локальный индекс заголовков писем. Возвращает True, если доступен полнотекстовый поиск (FTS5).
+    FTS-таблица без собственного содержимого (content=''): хранит только индекс, строки — в mail_headers.
+    Колонка owner (u<telegram_id>) позволяет искать только по письмам одного пользователя средствами FTS.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mail_headers (
+            id INTEGER PRIMARY KEY,
+            telegram_id INTEGER NOT NULL,
+            item_id TEXT NOT NULL,
+            changekey TEXT,
+            sender TEXT,
+            subject TEXT,
+            attachments TEXT,
+            received_at TIMESTAMP,
+            UNIQUE (telegram_id, item_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS mail_headers_received ON mail_headers (telegram_id, received_at)")
+    # Отметки «индекс полон с такого-то момента» из прежних версий: индекс никогда не бывает полным
+    cursor.execute("DROP TABLE IF EXISTS mail_index_users")
+    try:
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS mail_headers_fts USING fts5(
+                owner, subject, sender, attachments, content='', tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        logger.warning(f"SQLite FTS5 is not available, mail search will use LIKE: {e}")
+        return False
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS mail_headers_ai AFTER INSERT ON mail_headers BEGIN
+            INSERT INTO mail_headers_fts (rowid, owner, subject, sender, attachments)
+            VALUES (new.id, {_FTS_VALUES.format("new")});
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS mail_headers_ad AFTER DELETE ON mail_headers BEGIN
+            INSERT INTO mail_headers_fts (mail_headers_fts, rowid, owner, subject, sender, attachments)
+            VALUES ('delete', old.id, {_FTS_VALUES.format("old")});
+        END
+    """)
+    return True
+
+
+def _row_to_user(row: Sequence[Any]) -> Dict[str, Any]:
     return {
-        "conn": conn,
-        "add_user": lambda telegram_id, login, password: _add_user(telegram_id, login, password, conn),
-        "get_all_user_ids": lambda: _get_all_user_ids(conn),
-        "get_user": lambda telegram_id: _get_user(telegram_id, conn),
-        "update_user": lambda telegram_id, **kwargs: _update_user(telegram_id, conn, **kwargs),
-        "load_all_users": lambda: _load_all_users(conn)
+        "login": row[0],
+        "password": row[1],
+        "active": bool(row[2]),
+        "next_poll_at": datetime.fromisoformat(row[3]) if row[3] else None,
+        "poll_failures": row[4],
+        "created_at": datetime.fromisoformat(row[5]) if row[5] else None,
+        "sync_state": row[6],
+        "mail_rate": row[7] or 0.0,
+        "last_polled_at": datetime.fromisoformat(row[8]) if row[8] else None,
+        "last_seen_at": datetime.fromisoformat(row[9]) if row[9] else None
     }
 
 
-def _add_user(telegram_id: int, login: str, password: str, conn: sqlite3.Connection):
-    """Добавляет нового пользователя в базу данных"""
-    with _db_lock:
-        cursor = conn.cursor()
-        try:
-            cursor.execute("""
-                INSERT OR REPLACE INTO users (telegram_id, login, password, active, next_poll_at, poll_failures, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (
-                telegram_id, login, password, True, datetime.utcnow(), 0, datetime.utcnow()
-            ))
-            conn.commit()
-        except Exception as e:
-            print(f"Error adding user to database: {e}")
-
-
-def _get_all_user_ids(conn: sqlite3.Connection) -> List[int]:
-    """Возвращает список всех ID пользователей"""
-    with _db_lock:
-        cursor = conn.cursor()
-        cursor.execute("SELECT telegram_id FROM users")
-        return [row[0] for row in cursor.fetchall()]
-
-
-def _get_user(telegram_id: int, conn: sqlite3.Connection) -> Optional[Dict[str, Any]]:
-    """Возвращает информацию о пользователе по его ID"""
-    with _db_lock:
-        cursor = conn.cursor()
-        cursor.execute("SELECT login, password, active, next_poll_at, poll_failures, created_at FROM users WHERE telegram_id = ?", (telegram_id,))
-        row = cursor.fetchone()
-        if row:
-            return {
-                "login": row[0],
-                "password": row[1],
-                "active": bool(row[2]),
-                "next_poll_at": datetime.fromisoformat(row[3]) if row[3] else None,
-                "poll_failures": row[4],
-                "created_at": datetime.fromisoformat(row[5]) if row[5] else None
-            }
-        return None
-
-
-def _update_user(telegram_id: int, conn: sqlite3.Connection, **kwargs):
-    """Обновляет информацию о пользователе"""
-    with _db_lock:
-        cursor = conn.cursor()
-        # Формируем SQL-запрос динамически в зависимости от переданных параметров
-        set_clause = ", ".join([f"{key} = ?" for key in kwargs.keys()])
-        values = list(kwargs.values()) + [telegram_id]
-        query = f"UPDATE users SET {set_clause} WHERE telegram_id = ?"
+class Database:
+    """
+    Асинхронный репозиторий поверх SQLite.
+    - чтения выполняются параллельно в пуле потоков, у каждого потока своё соединение;
+    - все записи идут через один поток-писатель, который собирает накопившиеся запросы
+      и фиксирует их одной транзакцией (group commit) раз в commit_interval секунд;
+    - подписчики (listeners) узнают об изменении сразу при постановке записи в очередь.
+    Методы записи возвращают awaitable: его можно дождаться (запись зафиксирована) или не ждать.
+    """
+
+    def __init__(
+        self,
+        path: str = DB_PATH,
+        read_connections: int = 4,
+        commit_interval: float = 0.005,
+        max_batch: int = 512,
+    ):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        # Подписчики (например, планировщик poller'а), которым нужно знать об изменениях пользователей
+        self.listeners: List[UserListener] = []
+        # Активные зарегистрированные пользователи: фильтр KnownUser проверяет их без обращения к базе
+        self._registered: Set[int] = set()
+
+        conn = _connect(path)
+        # Создаем таблицу пользователей, если она не существует
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                telegram_id INTEGER PRIMARY KEY,
+                login TEXT NOT NULL,
+                password TEXT NOT NULL,
+                active BOOLEAN DEFAULT 1,
+                next_poll_at TIMESTAMP,
+                poll_failures INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        _migrate(conn.cursor())
+        # Полнотекстовый индекс заголовков писем (поиск /search)
+        self.fts_enabled = _create_header_index(conn.cursor())
+        conn.commit()
+        conn.close()
+
+        self._local = threading.local()
+        self._readers = ThreadPoolExecutor(max_workers=read_connections, thread_name_prefix="db-reader")
+        self._writes: "queue.Queue[Optional[Tuple[str, Sequence[Any], Future, bool]]]" = queue.Queue()
+        self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self._writer.start()
+
+    # --- пользователи ---
+
+    def add_user(self, telegram_id: int, login: str, password: str) -> Awaitable[bool]:
+        """Добавляет нового пользователя в базу данных"""
+        now = datetime.utcnow()
+        self._registered.add(telegram_id)
+        result = self.execute(_SQL_ADD_USER, (telegram_id, login, password, True, now, 0, now, None, 0.0, None, now))
+        self._notify(telegram_id, {
+            "login": login,
+            "password": password,
+            "active": True,
+            "next_poll_at": now,
+            "poll_failures": 0,
+            "created_at": now,
+            "sync_state": None,
+            "mail_rate": 0.0,
+            "last_polled_at": None,
+            "last_seen_at": now,
+        })
+        return result
+
+    def update_user(self, telegram_id: int, **kwargs) -> Awaitable[bool]:
+        """Обновляет информацию о пользователе"""
+        unknown = set(kwargs) - _UPDATABLE_COLUMNS
+        if unknown:
+            raise ValueError(f"Unknown user columns: {', '.join(sorted(unknown))}")
+        # Формируем SQL-запрос динамически; порядок колонок фиксирован, чтобы переиспользовать подготовленные выражения
+        keys = sorted(kwargs)
+        set_clause = ", ".join([f"{key} = ?" for key in keys])
+        values = [kwargs[key] for key in keys] + [telegram_id]
+        result = self.execute(f"UPDATE users SET {set_clause} WHERE telegram_id = ?", values)
+        if "active" in kwargs:
+            if kwargs["active"]:
+                self._registered.add(telegram_id)
+            else:
+                self._registered.discard(telegram_id)
+        self._notify(telegram_id, kwargs)
+        return result
+
+    async def get_user(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        """Возвращает информацию о пользователе по его ID"""
+        row = await self.fetchone(_SQL_GET_USER, (telegram_id,))
+        return _row_to_user(row) if row else None
+
+    async def get_all_user_ids(self) -> List[int]:
+        """Возвращает список всех ID пользователей"""
+        return [row[0] for row in await self.fetchall(_SQL_ALL_USER_IDS)]
+
+    async def load_all_users(self) -> Dict[int, Dict[str, Any]]:
+        """Загружает всех пользователей из базы данных"""
+        return {row[0]: _row_to_user(row[1:]) for row in await self.fetchall(_SQL_ALL_USERS)}
+
+    async def load_registered_users(self):
+        """Заполняет кэш зарегистрированных пользователей (вызывается при старте)"""
+        self._registered = {row[0] for row in await self.fetchall(_SQL_ACTIVE_USER_IDS)}
+
+    def is_registered(self, telegram_id: int) -> bool:
+        """Проверяет, зарегистрирован ли активный пользователь, без обращения к базе"""
+        return telegram_id in self._registered
+
+    # --- аренда пользователей экземплярами poller'а ---
+
+    async def claim_leases(self, owner: str, lease_until: datetime, due_before: datetime, limit: int) -> Dict[int, Dict[str, Any]]:
+        """Атомарно арендует до limit пользователей, которых пора опрашивать до due_before"""
+        now = datetime.utcnow()
+        rows = await self.execute_returning(_SQL_CLAIM_LEASES, (owner, lease_until, due_before, owner, now, limit))
+        return {row[0]: _row_to_user(row[1:]) for row in rows or []}
+
+    def renew_leases(self, owner: str, lease_until: datetime) -> Awaitable[bool]:
+        """Продлевает все аренды экземпляра одним запросом"""
+        return self.execute(_SQL_RENEW_LEASES, (lease_until, owner))
+
+    def release_lease(self, telegram_id: int, owner: str) -> Awaitable[bool]:
+        return self.execute(_SQL_RELEASE_LEASE, (telegram_id, owner))
+
+    def release_all_leases(self, owner: str) -> Awaitable[bool]:
+        return self.execute(_SQL_RELEASE_ALL_LEASES, (owner,))
+
+    async def count_active_users(self) -> int:
+        row = await self.fetchone(_SQL_COUNT_ACTIVE)
+        return row[0] if row else 0
+
+    # --- токены кнопок действий с письмами ---
+
+    def save_action_token(self, token: str, telegram_id: int, items: str) -> Awaitable[bool]:
+        """Сохраняет токен кнопок уведомления; items — письма в JSON"""
+        return self.execute(_SQL_SAVE_ACTION_TOKEN, (token, telegram_id, items, datetime.utcnow()))
+
+    async def get_action_token(self, token: str) -> Optional[Tuple[int, str]]:
+        """Возвращает (telegram_id, items) по токену или None"""
+        return await self.fetchone(_SQL_GET_ACTION_TOKEN, (token,))
+
+    def delete_old_action_tokens(self, created_before: datetime) -> Awaitable[bool]:
+        return self.execute(_SQL_DELETE_OLD_ACTION_TOKENS, (created_before,))
+
+    # --- хранилище FSM ---
+
+    async def get_fsm_record(self, key: str) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        """Возвращает (state, data в JSON) по ключу или None"""
+        return await self.fetchone(_SQL_GET_FSM_RECORD, (key,))
+
+    def save_fsm_record(self, key: str, state: Optional[str], data: str) -> Awaitable[bool]:
+        return self.execute(_SQL_SAVE_FSM_RECORD, (key, state, data, datetime.utcnow()))
+
+    def delete_fsm_record(self, key: str) -> Awaitable[bool]:
+        return self.execute(_SQL_DELETE_FSM_RECORD, (key,))
+
+    # --- очередь исходящих писем ---
+
+    async def enqueue_outbox(
+        self,
+        idem_key: str,
+        telegram_id: int,
+        login: str,
+        chat_id: Optional[int],
+        message_id: Optional[int],
+        recipients: str,
+        subject: Optional[str],
+        body: Optional[str],
+        attachments: str,
+        form_text: Optional[str],
+    ) -> bool:
+        """Ставит письмо в очередь; False, если письмо с таким ключом уже в очереди (повторное нажатие)"""
+        now = datetime.utcnow()
+        rows = await self.execute_returning(
+            _SQL_OUTBOX_ENQUEUE,
+            (idem_key, telegram_id, login, chat_id, message_id, recipients, subject, body, attachments, form_text, now, now, now),
+        )
+        return bool(rows)
+
+    async def claim_outbox(self, limit: int) -> List[Tuple[Any, ...]]:
+        now = datetime.utcnow()
+        return await self.execute_returning(_SQL_OUTBOX_CLAIM, (now, now, limit)) or []
+
+    def retry_outbox(self, outbox_id: int, next_attempt_at: datetime, error: str) -> Awaitable[bool]:
+        return self.execute(_SQL_OUTBOX_RETRY, (next_attempt_at, error, datetime.utcnow(), outbox_id))
+
+    def finish_outbox(self, outbox_id: int, status: str, error: Optional[str] = None) -> Awaitable[bool]:
+        return self.execute(_SQL_OUTBOX_FINISH, (status, error, datetime.utcnow(), outbox_id))
+
+    def reset_outbox(self) -> Awaitable[bool]:
+        """Возвращает в очередь письма, отправка которых прервалась остановкой процесса"""
+        return self.execute(_SQL_OUTBOX_RESET)
+
+    async def next_outbox_due(self) -> Optional[datetime]:
+        row = await self.fetchone(_SQL_OUTBOX_NEXT_DUE)
+        return datetime.fromisoformat(row[0]) if row and row[0] else None
+
+    def delete_old_outbox(self, updated_before: datetime) -> Awaitable[bool]:
+        return self.execute(_SQL_OUTBOX_DELETE_OLD, (updated_before,))
+
+    # --- кэш вложений ---
+
+    async def get_attachment_alias(self, alias: str) -> Optional[str]:
+        row = await self.fetchone(_SQL_GET_ATTACHMENT_ALIAS, (alias,))
+        return row[0] if row else None
+
+    def save_attachment_alias(self, alias: str, sha256: str) -> Awaitable[bool]:
+        return self.execute(_SQL_SAVE_ATTACHMENT_ALIAS, (alias, sha256, datetime.utcnow()))
+
+    def delete_old_attachment_aliases(self, created_before: datetime) -> Awaitable[bool]:
+        return self.execute(_SQL_DELETE_OLD_ATTACHMENT_ALIASES, (created_before,))
+
+    async def get_attachment_file_id(self, sha256: str) -> Optional[str]:
+        row = await self.fetchone(_SQL_GET_ATTACHMENT_FILE_ID, (sha256,))
+        return row[0] if row else None
+
+    def save_attachment_file_id(self, sha256: str, file_id: str) -> Awaitable[bool]:
+        return self.execute(_SQL_SAVE_ATTACHMENT_FILE_ID, (sha256, file_id, datetime.utcnow()))
+
+    # --- контрольные точки ---
+
+    def save_checkpoint(self, name: str, state: str) -> Awaitable[bool]:
+        """Сохраняет состояние (JSON) под именем вида <задача>:<экземпляр>"""
+        return self.execute(_SQL_SAVE_CHECKPOINT, (name, state, datetime.utcnow()))
+
+    async def take_checkpoints(self, prefix: str) -> List[Tuple[str, str, str]]:
+        """Забирает (и удаляет) все контрольные точки с именем, начинающимся с prefix"""
+        return await self.execute_returning(_SQL_TAKE_CHECKPOINTS, (f"{prefix}%",)) or []
+
+    def _notify(self, telegram_id: int, fields: Dict[str, Any]):
+        """Сообщает подписчикам об изменении пользователя"""
+        for listener in self.listeners:
+            try:
+                listener(telegram_id, fields)
+            except Exception as e:
+                logger.error(f"Error in user listener: {e}")
+
+    # --- низкоуровневый доступ (для других таблиц бота) ---
+
+    def execute(self, sql: str, params: Sequence[Any] = ()) -> Awaitable[bool]:
+        """Ставит запись в очередь писателя; результат — True, если запись зафиксирована"""
+        future: Future = Future()
+        self._writes.put((sql, params, future, False))
+        return asyncio.wrap_future(future)
+
+    def execute_returning(self, sql: str, params: Sequence[Any] = ()) -> Awaitable[Optional[List[Tuple[Any, ...]]]]:
+        """Как execute, но для запросов с RETURNING: результат — строки после фиксации или None при ошибке"""
+        future: Future = Future()
+        self._writes.put((sql, params, future, True))
+        return asyncio.wrap_future(future)
+
+    async def fetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[Tuple[Any, ...]]:
+        return await self._read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: Sequence[Any] = ()) -> List[Tuple[Any, ...]]:
+        return await self._read(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def flush(self):
+        """Дожидается фиксации всех ранее поставленных записей"""
+        await self.execute("SELECT 1")
+
+    async def close(self):
+        """Фиксирует очередь записей и закрывает соединения"""
+        await self.flush()
+        self._writes.put(None)
+        await asyncio.to_thread(self._writer.join)
+        self._readers.shutdown(wait=True)
+
+    def _read(self, fn: Callable[[sqlite3.Connection], Any]) -> Awaitable[Any]:
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._readers, self._run_read, fn)
+
+    def _run_read(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = _connect(self.path)
+        return fn(conn)
+
+    def _writer_loop(self):
+        conn = _connect(self.path)
+        stopping = False
+        while not stopping:
+            item = self._writes.get()
+            if item is None:
+                break
+            batch = [item]
+            # Собираем всё, что успело прийти за commit_interval, в одну транзакцию
+            deadline = time.monotonic() + self.commit_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._writes.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(conn, batch)
+        conn.close()
+
+    def _commit(self, conn: sqlite3.Connection, batch: List[Tuple[str, Sequence[Any], Future, bool]]):
+        results: List[Any] = []
         try:
-            cursor.execute(query, values)
+            for sql, params, _, returning in batch:
+                try:
+                    cursor = conn.execute(sql, params)
+                    results.append(cursor.fetchall() if returning else True)
+                except Exception as e:
+                    # Ошибка одного запроса не отменяет остальные в пачке
+                    logger.error(f"Error writing to database: {e}")
+                    results.append(None if returning else False)
             conn.commit()
         except Exception as e:
-            print(f"Error updating user in database: {e}")
-
-
-def _load_all_users(conn: sqlite3.Connection) -> Dict[int, Dict[str, Any]]:
-    """Загружает всех пользователей из базы данных"""
-    with _db_lock:
-        cursor = conn.cursor()
-        cursor.execute("SELECT telegram_id, login, password, active, next_poll_at, poll_failures, created_at FROM users")
-        users = {}
-        for row in cursor.fetchall():
-            users[row[0]] = {
-                "login": row[1],
-                "password": row[2],
-                "active": bool(row[3]),
-                "next_poll_at": datetime.fromisoformat(row[4]) if row[4] else None,
-                "poll_failures": row[5],
-                "created_at": datetime.fromisoformat(row[6]) if row[6] else None
-            }
-        return users
+            logger.error(f"Error committing to database: {e}")
+            conn.rollback()
+            results = [None if returning else False for _, _, _, returning in batch]
+        for (_, _, future, _), result in zip(batch, results):
+            future.set_result(result)
@@ -0,0 +1,123 @@
+"""
+database/fsm_storage.py
+
+Хранилище FSM aiogram в базе бота (таблица fsm_storage).
+- Черновики /send_email переживают перезапуск и доступны любому экземпляру бота.
+- На время обработки одного апдейта запись пользователя читается из базы один раз и лежит в снимке:
+  повторные get_data()/get_state() не обращаются к базе.
+- update_data()/set_state() меняют только снимок; изменения записываются одним запросом
+  после обработки апдейта (FSMSnapshotMiddleware) и не задерживают ответ пользователю.
+Вне снимка (например, в фоновых задачах) хранилище читает и пишет сразу.
+"""
+import json
+import logging
+from contextvars import ContextVar, Token
+from dataclasses import dataclass, field
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+from database.database import Database
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Record:
+    state: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+    dirty: bool = False
+
+
+# Снимок записей текущего апдейта: ключ -> запись
+_snapshot: ContextVar[Optional[Dict[str, _Record]]] = ContextVar("fsm_snapshot", default=None)
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, db: Database):
+        self.db = db
+        # Записи, поставленные в очередь писателя, но ещё не зафиксированные:
+        # следующий апдейт того же пользователя должен видеть их, а не старую строку
+        self._pending: Dict[str, Tuple[Optional[str], Dict[str, Any]]] = {}
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        business_connection_id = getattr(key, "business_connection_id", None)
+        return (
+            f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:"
+            f"{business_connection_id or ''}:{key.destiny}"
+        )
+
+    # --- снимок апдейта ---
+
+    def open_snapshot(self) -> Token:
+        return _snapshot.set({})
+
+    def close_snapshot(self, token: Token):
+        """Записывает изменённые за апдейт записи (не дожидаясь фиксации) и закрывает снимок"""
+        snapshot = _snapshot.get()
+        _snapshot.reset(token)
+        for key, record in (snapshot or {}).items():
+            if record.dirty:
+                self._save(key, record)
+
+    async def _load(self, key: str) -> _Record:
+        snapshot = _snapshot.get()
+        if snapshot is not None and key in snapshot:
+            return snapshot[key]
+        pending = self._pending.get(key)
+        if pending is not None:
+            record = _Record(pending[0], dict(pending[1]))
+        else:
+            row = await self.db.get_fsm_record(key)
+            record = _Record(row[0], json.loads(row[1]) if row[1] else {}) if row else _Record()
+        if snapshot is not None:
+            snapshot[key] = record
+        return record
+
+    def _changed(self, key: str, record: _Record):
+        if _snapshot.get() is not None:
+            record.dirty = True
+        else:
+            self._save(key, record)
+
+    def _save(self, key: str, record: _Record):
+        value = (record.state, dict(record.data))
+        self._pending[key] = value
+        if record.state is None and not record.data:
+            result = self.db.delete_fsm_record(key)
+        else:
+            result = self.db.save_fsm_record(key, record.state, json.dumps(record.data, ensure_ascii=False))
+
+        def done(future):
+            if not future.cancelled() and not future.result():
+                logger.error(f"Failed to save FSM record {key}")
+            # Более поздняя запись того же ключа могла встать в очередь после этой
+            if self._pending.get(key) is value:
+                del self._pending[key]
+
+        result.add_done_callback(done)
+
+    # --- BaseStorage ---
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._key(key)
+        record = await self._load(storage_key)
+        record.state = state.state if isinstance(state, State) else state
+        self._changed(storage_key, record)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(self._key(key))).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        storage_key = self._key(key)
+        record = await self._load(storage_key)
+        record.data = dict(data)
+        self._changed(storage_key, record)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._load(self._key(key))).data.copy()
+
+    async def close(self) -> None:
+        await self.db.flush()
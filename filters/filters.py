@@ -1,10 +1,8 @@
 from aiogram.filters import BaseFilter
 from aiogram.types import Message
+from database.database import Database
 
 class KnownUser(BaseFilter):
-    async def __call__(self, message: Message, db: dict) -> bool:
-        print(message.from_user.id)
-        print(db)
-        # Проверяем наличие пользователя в постоянной базе данных
-        user = db['get_user'](message.from_user.id)
-        return user is not None
\ No newline at end of file
+    async def __call__(self, message: Message, db: Database) -> bool:
+        # Проверяем наличие пользователя по кэшу зарегистрированных пользователей (без запроса к базе)
+        return db.is_registered(message.from_user.id)
\ No newline at end of file
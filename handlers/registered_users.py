@@ -1,25 +1,47 @@
+from html import escape
+
 from aiogram import F, Router
 from aiogram.types import CallbackQuery, Message
-from aiogram.filters import Command, CommandStart, StateFilter
+from aiogram.filters import Command, CommandObject, CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import default_state
 from states.states import FSMFillEmail
 from keyboards.keyboards import create_inline_kb
 from lexicon.lexicon import LEXICON
 from filters.filters import KnownUser
-from services.mail_service import send_mail_async
+from app.tasks.outbox import OutboxSender
+from services.mail_cache import UnreadCache
+from services.mail_index import MailIndex
+from services.throttling import ServerThrottled
+from services.attachments import (
+    AttachmentTooLarge,
+    check_attachment_size,
+    describe_attachment,
+)
+from config.config import load_config
+from database.database import Database
 
 
 registered_users_router = Router()
+config = load_config()
 
 registered_users_router.message.filter(KnownUser())
 
+# Поля формы письма, которые вводит пользователь (и имена его файлов)
+_FORM_FIELDS = ("addressees", "topic", "text_massage", "attachment_names")
+
+
+def _form_text(data: dict, key: str = 'fill_send') -> str:
+    """Текст формы письма для ParseMode.HTML: введённые пользователем значения экранируются"""
+    return LEXICON[key].format(**{**data, **{field: escape(str(data.get(field, ''))) for field in _FORM_FIELDS}})
+
+
 @registered_users_router.message(Command(commands="send_email"), StateFilter(default_state))
 async def process_send_email_command(message: Message, state: FSMContext):
     await state.set_state(FSMFillEmail.fill_form)
-    await state.update_data(addressees = '', topic = '', text_massage = '', attachment = None)
+    await state.update_data(addressees = '', topic = '', text_massage = '', attachments = [], attachment_names = '')
     await message.answer(
-        text=LEXICON[message.text].format(**(await state.get_data())),
+        text=_form_text(await state.get_data(), message.text),
         reply_markup=create_inline_kb(2,'but_addressees', 'but_topic', 'but_text_massage', 'but_attachment', last_btns= ['but_send', 'but_cancel']),
         )
     
@@ -39,7 +61,7 @@ async def process_addressees_sent(message: Message, state: FSMContext):
     await message.bot.edit_message_text(
         chat_id=message.chat.id,
         message_id= (await state.get_data()).get("fill_form_msg_id") ,
-        text=LEXICON['fill_send'].format(**(await state.get_data())),
+        text=_form_text(await state.get_data()),
         reply_markup=create_inline_kb(2,'but_addressees', 'but_topic', 'but_text_massage', 'but_attachment', last_btns= ['but_send', 'but_cancel']),
         )
     await state.set_state(FSMFillEmail.fill_form)
@@ -60,7 +82,7 @@ async def process_topic_sent(message: Message, state: FSMContext):
     await message.bot.edit_message_text(
         chat_id=message.chat.id,
         message_id= (await state.get_data()).get("fill_form_msg_id") ,
-        text=LEXICON['fill_send'].format(**(await state.get_data())),
+        text=_form_text(await state.get_data()),
         reply_markup=create_inline_kb(2,'but_addressees', 'but_topic', 'but_text_massage', 'but_attachment', last_btns= ['but_send', 'but_cancel']),
         )
     await state.set_state(FSMFillEmail.fill_form)
@@ -81,7 +103,7 @@ async def process_text_massage_sent(message: Message, state: FSMContext):
     await message.bot.edit_message_text(
         chat_id=message.chat.id,
         message_id= (await state.get_data()).get("fill_form_msg_id") ,
-        text=LEXICON['fill_send'].format(**(await state.get_data())),
+        text=_form_text(await state.get_data()),
         reply_markup=create_inline_kb(2,'but_addressees', 'but_topic', 'but_text_massage', 'but_attachment', last_btns= ['but_send', 'but_cancel']),
         )
     await state.set_state(FSMFillEmail.fill_form)
@@ -97,12 +119,26 @@ async def process_upload_attachment_press(callback: CallbackQuery, state: FSMCon
     
 @registered_users_router.message(StateFilter(FSMFillEmail.upload_attachment), F.photo | F.video | F.document | F.audio)
 async def process_upload_attachment_sent(message: Message, state: FSMContext):
-    await state.update_data(attachment=message.document) #Необходимо ппродумать как сохранять любой тип вложения
+    # Сохраняем только описание файла (file_id, имя, размер) — сам файл скачивается при отправке письма
+    attachment = describe_attachment(message)
+    attachments = (await state.get_data()).get("attachments", [])
+    if attachment is None:
+        await message.answer(text=LEXICON['attachment_unsupported'])
+    else:
+        try:
+            check_attachment_size(attachments, attachment, config.mail.max_attachment_size, config.mail.max_attachments_total)
+            attachments = attachments + [attachment]
+            await state.update_data(
+                attachments=attachments,
+                attachment_names=', '.join(a['name'] for a in attachments),
+            )
+        except AttachmentTooLarge:
+            await message.answer(text=LEXICON['attachment_too_large'].format(name=escape(attachment['name'])))
     await message.delete()
     await message.bot.edit_message_text(
         chat_id=message.chat.id,
         message_id= (await state.get_data()).get("fill_form_msg_id") ,
-        text=LEXICON['fill_send'].format(**(await state.get_data())),
+        text=_form_text(await state.get_data()),
         reply_markup=create_inline_kb(2,'but_addressees', 'but_topic', 'but_text_massage', 'but_attachment', last_btns= ['but_send', 'but_cancel']),
         )
     await state.set_state(FSMFillEmail.fill_form)
@@ -111,26 +147,35 @@ async def process_upload_attachment_sent(message: Message, state: FSMContext):
 
     
 @registered_users_router.callback_query(F.data == 'but_send', StateFilter(FSMFillEmail.fill_form))
-async def process_send_email_press(callback: CallbackQuery, state: FSMContext, db: dict):
+async def process_send_email_press(callback: CallbackQuery, state: FSMContext, db: Database, outbox: OutboxSender):
     # Получаем пользователя из постоянной базы данных
-    user_data = db['get_user'](callback.from_user.id)
+    user_data = await db.get_user(callback.from_user.id)
     if not user_data:
         await callback.message.edit_text(text="Вы не зарегистрированы в системе.")
         await state.clear()
         return
 
-    if (await state.get_data()).get("addressees") != '':
-        ok = await send_mail_async(
-            email=user_data['login'],
-            password=user_data['password'],
-            to=(await state.get_data()).get("addressees"),
-            subject=(await state.get_data()).get("topic"),
-            body=(await state.get_data()).get("text_massage")
+    data = await state.get_data()
+    if data.get("addressees") != '':
+        # Письмо уходит в очередь: отправляет его фоновый OutboxSender, статус появится в этом же сообщении.
+        # Ключ — сообщение с формой, поэтому повторное нажатие не поставит письмо в очередь второй раз
+        form_text = _form_text(data)
+        await outbox.enqueue(
+            idem_key=f"{callback.message.chat.id}:{callback.message.message_id}",
+            telegram_id=callback.from_user.id,
+            login=user_data['login'],
+            to=data.get("addressees"),
+            subject=data.get("topic"),
+            body=data.get("text_massage"),
+            attachments=data.get("attachments", []),
+            chat_id=callback.message.chat.id,
+            message_id=callback.message.message_id,
+            form_text=form_text,
         )
         await callback.message.edit_text(
-            text=LEXICON["sent" if ok else "error_send"]+'\n\n'+
-            LEXICON['fill_send'].format(**(await state.get_data()))+'\n\n'+
-            LEXICON["sent" if ok else "error_send"]
+            text=LEXICON["outbox_queued"]+'\n\n'+
+            form_text+'\n\n'+
+            LEXICON["outbox_queued"]
         )
         await state.clear()
     
@@ -142,32 +187,84 @@ async def process_cancel_command(callback: CallbackQuery, state: FSMContext):
 
 # Обработчик для команды проверки почты
 @registered_users_router.message(Command(commands="check_mail"), StateFilter(default_state))
-async def process_check_mail_command(message: Message, db: dict):
+async def process_check_mail_command(message: Message, db: Database, mail_index: MailIndex, unread_cache: UnreadCache):
     from services.mail_service import fetch_unread_emails_async
     from datetime import datetime
     
     # Получаем пользователя из постоянной базы данных
-    user_data = db['get_user'](message.from_user.id)
+    user_data = await db.get_user(message.from_user.id)
     if not user_data:
         await message.answer(text="Вы не зарегистрированы в системе.")
         return
     
-    # Получаем непрочитанные письма
-    emails = await fetch_unread_emails_async(
-        email=user_data['login'],
-        password=user_data['password'],
-        server="mail.spbstu.ru",  # В реальном приложении нужно использовать значение из конфига
-        verify_ssl=True
-    )
+    # Получаем непрочитанные письма: недавний результат берём из кэша, повторные нажатия не идут на сервер
+    def fetch():
+        return fetch_unread_emails_async(
+            email=user_data['login'],
+            password=user_data['password'],
+            server=config.mail.server,
+            verify_ssl=config.mail.verify_ssl,
+            raise_errors=True
+        )
+
+    try:
+        emails, age = await unread_cache.get(message.from_user.id, fetch)
+    except ServerThrottled as e:
+        await message.answer(text=LEXICON['server_busy'].format(minutes=max(1, round(e.retry_after / 60))))
+        return
+    except Exception:
+        emails, age = [], 0.0
     
     if emails:
+        if age == 0:
+            # Полученные заголовки пополняют индекс для /search
+            mail_index.add(message.from_user.id, emails)
         response_text = f"Найдено {len(emails)} непрочитанных писем:\n\n"
         for email in emails[:5]:  # Показываем только первые 5 писем
             subject = email.get('subject', 'Без темы')
             sender = email.get('from', 'Неизвестно')
             date = email.get('datetime_received', 'Неизвестно')
-            response_text += f"📧 Тема: {subject}\nОт: {sender}\nДата: {date}\n\n"
+            response_text += f"📧 Тема: {escape(str(subject))}\nОт: {escape(str(sender))}\nДата: {date}\n"
+            if email.get('preview'):
+                # Превью из кэша: повторный /check_mail не запрашивает тело письма
+                response_text += f"<i>{escape(email['preview'])}</i>\n"
+            response_text += "\n"
     else:
         response_text = "Нет новых писем."
+    if age >= unread_cache.ttl:
+        response_text += LEXICON['check_mail_stale'].format(minutes=max(1, round(age / 60)))
     
-    await message.answer(text=response_text)
\ No newline at end of file
+    await message.answer(text=response_text)
+
+
+# Поиск по письмам: отвечает из локального индекса заголовков, к серверу идёт только при необходимости
+@registered_users_router.message(Command(commands="search"), StateFilter(default_state))
+async def process_search_command(message: Message, command: CommandObject, db: Database, mail_index: MailIndex):
+    if not command.args:
+        await message.answer(text=LEXICON['search_usage'])
+        return
+
+    user_data = await db.get_user(message.from_user.id)
+    if not user_data:
+        await message.answer(text="Вы не зарегистрированы в системе.")
+        return
+
+    try:
+        emails, _ = await mail_index.search(message.from_user.id, user_data, command.args)
+    except ServerThrottled as e:
+        await message.answer(text=LEXICON['server_busy'].format(minutes=max(1, round(e.retry_after / 60))))
+        return
+    except Exception:
+        emails = []
+
+    if not emails:
+        await message.answer(text=LEXICON['search_empty'])
+        return
+
+    response_text = LEXICON['search_results'].format(count=len(emails)) + "\n\n"
+    for email in emails:
+        subject = email.get('subject') or 'Без темы'
+        sender = email.get('from') or 'Неизвестно'
+        date = email.get('datetime_received') or 'Неизвестно'
+        response_text += f"📧 Тема: {escape(str(subject))}\nОт: {escape(str(sender))}\nДата: {date}\n\n"
+    await message.answer(text=response_text)
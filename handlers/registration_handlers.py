@@ -7,6 +7,7 @@ from states.states import FSMFillRegistration
 from keyboards.keyboards import create_registration_keyboard
 from filters.filters import KnownUser
 from lexicon.lexicon import LEXICON
+from database.database import Database
 
 
 unregistered_users_router = Router()
@@ -40,7 +41,7 @@ async def process_login_sent(message: Message, state: FSMContext):
     await state.set_state(FSMFillRegistration.fill_password)
     
 @unregistered_users_router.message(StateFilter(FSMFillRegistration.fill_password), F.text)
-async def process_password_sent(message: Message, state: FSMContext, db: dict):
+async def process_password_sent(message: Message, state: FSMContext, db: Database):
     # Получаем данные пользователя для проверки учетных данных
     user_data = await state.get_data()
     login = user_data.get('login')
@@ -56,12 +57,12 @@ async def process_password_sent(message: Message, state: FSMContext, db: dict):
     #     await message.answer(text=LEXICON['wrong_credentials'])
     #     return
 
-    await state.update_data(password=password)
+    # Пароль не кладём в данные FSM: они хранятся в таблице fsm_storage, пока состояние не сброшено
     await message.delete()
     await message.answer(text=LEXICON['end_registration'])
     
     # Сохраняем пользователя в постоянное хранилище
-    db["add_user"](message.from_user.id, login, password)
+    await db.add_user(message.from_user.id, login, password)
     print(db)
     # здесь запускается функция которая мониторит новые сообшения
     await state.clear()
@@ -79,6 +80,6 @@ async def send_echo_not_registration(message: Message):
     )
     
 @unregistered_users_router.my_chat_member(ChatMemberUpdatedFilter(member_status_changed=KICKED), KnownUser())
-async def process_user_blocked_bot(event: ChatMemberUpdated, db: dict):
+async def process_user_blocked_bot(event: ChatMemberUpdated, db: Database):
     # Удаляем из постоянной базы данных, установив active в False
-    db["update_user"](event.from_user.id, active=False)
\ No newline at end of file
+    await db.update_user(event.from_user.id, active=False)
\ No newline at end of file
@@ -36,4 +36,19 @@ def create_inline_kb(width: int, *args: str, last_btns: list | None = None) -> I
         for button in last_btns:
             kb_builder.row(InlineKeyboardButton(text=LEXICON[button], callback_data=button))
 
-    return kb_builder.as_markup()
\ No newline at end of file
+    return kb_builder.as_markup()
+
+
+def create_mail_actions_kb(token: str, attachments: bool = False) -> InlineKeyboardMarkup:
+    # Кнопки под уведомлением о письме; token — короткий ключ письма (EWS id не помещается в callback_data)
+    kb_builder = InlineKeyboardBuilder()
+    kb_builder.row(
+        *[
+            InlineKeyboardButton(text=LEXICON[f'but_mail_{action}'], callback_data=f'mail:{action}:{token}')
+            for action in ('read', 'junk', 'delete')
+        ],
+        width=3,
+    )
+    if attachments:
+        kb_builder.row(InlineKeyboardButton(text=LEXICON['but_mail_files'], callback_data=f'files:{token}'))
+    return kb_builder.as_markup()
@@ -16,8 +16,8 @@ LEXICON = {
     "not_registration": 'Необходимо пройти регистрацию по кнопке ниже',
     "wrong_credentials": 'Неправильный логин или пароль. Пожалуйста, попробуйте снова.',
     
-    '/send_email': 'Пример заполненого письма:\n\nКому: {addressees}\nТема: {topic}\nТекст письма:{text_massage}\nВложения: ###нужно придумать как присылать названия файлов###\n\n Заполните письмо используя кнопки снизу',
-    'fill_send': 'Пример заполненого письма:\n\nКому: {addressees}\nТема: {topic}\nТекст письма:{text_massage}\nВложения: ###нужно придумать как присылать названия файлов###\n\n Заполните письмо используя кнопки снизу',
+    '/send_email': 'Пример заполненого письма:\n\nКому: {addressees}\nТема: {topic}\nТекст письма:{text_massage}\nВложения: {attachment_names}\n\n Заполните письмо используя кнопки снизу',
+    'fill_send': 'Пример заполненого письма:\n\nКому: {addressees}\nТема: {topic}\nТекст письма:{text_massage}\nВложения: {attachment_names}\n\n Заполните письмо используя кнопки снизу',
     'addressees': "Введите адреса получателей через пробел (не используйте знаки препинания для разделения почтовых адресов):",
     'topic': "Введите тему письма:", 
     'text_massage': "Введите текст письма:",
@@ -30,12 +30,39 @@ LEXICON = {
     'but_cancel': "Отмена",
     'sent': 'Отправлено',
     'error_send': 'Ошибка',
+    'outbox_queued': 'Письмо поставлено в очередь на отправку',
+    'outbox_retry': 'Не удалось отправить, повторю попытку через {minutes} мин.',
+    'attachment_too_large': 'Файл «{name}» слишком большой и не будет прикреплён.',
+    'server_busy': 'Почтовый сервер сейчас перегружен. Попробуйте через {minutes} мин.',
+    'check_mail_stale': '\n\nДанные получены {minutes} мин. назад, список обновляется — повторите команду чуть позже.',
+    'search_usage': 'Напишите, что искать: /search &lt;слова из темы, отправителя или имени вложения&gt;',
+    'search_empty': 'Ничего не найдено.',
+    'search_results': 'Найдено писем: {count}',
+    'attachment_unsupported': 'Этот тип вложения не поддерживается.',
+
+    'but_mail_read': '✅ Прочитано',
+    'but_mail_junk': '🚫 В спам',
+    'but_mail_delete': '🗑 Удалить',
+    'but_mail_files': '📎 Вложения',
+    'mail_action_accepted': 'Принято',
+    'mail_action_expired': 'Кнопка устарела',
+    'mail_action_read': 'Отмечено прочитанными',
+    'mail_action_unread': 'Отмечено непрочитанными',
+    'mail_action_junk': 'Перемещено в спам',
+    'mail_action_delete': 'Удалено',
+    'mail_actions_done': 'Готово:',
+    'mail_actions_error': 'Не удалось применить действия с письмами, попробуйте позже.',
+    'mail_files_sending': 'Отправляю вложения…',
+    'mail_files_empty': 'В письме нет файлов, которые можно переслать.',
+    'mail_files_too_large': 'Файл «{name}» больше 50 МБ — Telegram не позволяет боту его отправить.',
+    'mail_files_error': 'Не удалось переслать вложения, попробуйте позже.',
 
 }
 
 LEXICON_COMMANDS = {
     "/send_email": "Отправить письмо",
     "/check_mail": "Проверить почту",
+    "/search": "Поиск по письмам",
     "/setting": "Настройки",
     "/help": "Справка по работе бота",
 }
\ No newline at end of file
@@ -7,8 +7,24 @@ from config.config import Config, load_config
 from handlers.registration_handlers import unregistered_users_router
 from handlers.registered_users import registered_users_router
 from keyboards.menu_commands import set_main_menu
-from database.database import init_db
+from database.database import Database, init_db
+from database.fsm_storage import SQLiteStorage
 from app.tasks.poller import Poller
+from app.tasks.mail_actions import MailActionBatcher
+from app.tasks.subscriber import Subscriber
+from app.tasks.notifier import Notifier
+from app.tasks.outbox import OutboxSender
+from app.handlers.mail import mail_router
+from middlewares.activity import ActivityMiddleware
+from middlewares.fsm_snapshot import FSMSnapshotMiddleware
+from services.attachment_cache import AttachmentCache
+from services.mail_cache import UnreadCache
+from services.mail_index import MailIndex
+from services.executors import configure_lanes
+from services.mail_service import close_backend, configure_account_pool, configure_backend, on_user_changed
+from services.metrics import start_metrics_server
+from services.previews import configure_previews
+from services.throttling import configure_governors
 
 logger = logging.getLogger(__name__)
 
@@ -26,27 +42,109 @@ async def main():
         token=config.bot.token,
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
-    dp = Dispatcher()
+    db: Database = init_db()
+    await db.load_registered_users()
 
-    db: dict = init_db()
+    # Состояния FSM (черновики писем) хранятся в базе и переживают перезапуск бота
+    storage = SQLiteStorage(db)
+    dp = Dispatcher(storage=storage)
 
-    dp.workflow_data.update(db=db)
+    # Общий кэш EWS-подключений для poller'а и хендлеров
+    configure_account_pool(config.mail.account_cache_size, config.mail.account_idle_ttl)
+    configure_governors(
+        rate=config.mail.ews_rate,
+        burst=config.mail.ews_burst,
+        max_wait=config.mail.ews_max_wait,
+        backoff=config.mail.ews_backoff,
+        max_backoff=config.mail.ews_max_backoff,
+        ramp_seconds=config.mail.ews_ramp_seconds,
+    )
+    configure_lanes(
+        interactive_workers=config.mail.interactive_workers,
+        interactive_timeout=config.mail.interactive_timeout,
+        background_workers=config.mail.background_workers,
+        background_timeout=config.mail.background_timeout,
+    )
+    configure_backend(config.mail.ews_backend, config.mail.ews_connections)
+    configure_previews(config.mail.preview_chars, config.mail.preview_cache_size)
+    db.listeners.append(on_user_changed)
+
+    # Пакетная обработка действий с письмами из кнопок уведомлений
+    # Кэш непрочитанных писем для /check_mail, общий с poller'ом
+    unread_cache = UnreadCache(config.mail.unread_cache_ttl, config.mail.unread_cache_max_stale)
+    mail_actions = MailActionBatcher(db, config, bot, unread_cache)
+    # Локальный индекс заголовков писем для /search
+    mail_index = MailIndex(db, config)
+    # Кэш вложений, пересылаемых из писем в Telegram
+    attachment_cache = AttachmentCache(db, config.mail.attachment_cache_dir, config.mail.attachment_cache_size)
+    await attachment_cache.load()
+
+    # Очередь исходящих писем: форма /send_email не ждёт ответа EWS
+    outbox = OutboxSender(db, config, bot)
+
+    dp.workflow_data.update(
+        db=db,
+        outbox=outbox,
+        mail_actions=mail_actions,
+        mail_index=mail_index,
+        unread_cache=unread_cache,
+        attachment_cache=attachment_cache,
+    )
     
     await set_main_menu(bot)
 
+    # Активность пользователя в боте учитывается при выборе интервала опроса
+    dp.update.outer_middleware(ActivityMiddleware())
+    # Снимок FSM на время апдейта; регистрируется после FSMContextMiddleware диспетчера, поэтому внутри его блокировки
+    dp.update.outer_middleware(FSMSnapshotMiddleware(storage))
+
+    dp.include_router(mail_router)
     dp.include_router(registered_users_router)
     dp.include_router(unregistered_users_router)
 
-    # Создаем и запускаем poller
-    poller = Poller(db, config, bot)
-    poller_task = asyncio.create_task(poller.poll_loop())
+    # Очередь уведомлений с учётом лимитов Telegram
+    notifier = Notifier(config, bot, mail_actions, db)
+    notifier.start()
+    await notifier.restore()
+    outbox.start()
+
+    # Создаем и запускаем poller (в режиме lease его можно вынести в отдельные процессы poller_main.py)
+    poller = None
+    if config.poller.embedded:
+        poller = Poller(db, config, bot, mail_actions, notifier, mail_index, unread_cache)
+        poller_task = asyncio.create_task(poller.poll_loop())
+
+    # Push-подписки EWS будят poller при появлении новой почты
+    subscriber = None
+    if config.subscriptions.enabled and (poller is None or config.poller.mode == "lease"):
+        logger.warning("EWS subscriptions require an embedded poller in local mode, falling back to polling")
+    elif config.subscriptions.enabled:
+        subscriber = Subscriber(db, config, poller.scheduler)
+        subscriber_task = asyncio.create_task(subscriber.run())
+
+    # Метрики Prometheus на локальном HTTP-порту
+    metrics_runner = None
+    if config.metrics.enabled:
+        metrics_runner = await start_metrics_server(config.metrics.host, config.metrics.port)
 
     await bot.delete_webhook(drop_pending_updates=True)
     try:
         await dp.start_polling(bot)
     finally:
-        poller.stop()
-        await poller_task  # Ждем завершения задачи poller
+        if poller:
+            poller.stop()
+        if subscriber:
+            subscriber.stop()
+            await subscriber_task
+        if poller:
+            await poller_task  # Ждем завершения задачи poller
+        await notifier.stop()
+        await outbox.stop()
+        await mail_actions.close()
+        await close_backend()
+        await db.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,29 @@
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+
+# Запоминает время последнего обращения пользователя к боту (для адаптивного интервала опроса)
+class ActivityMiddleware(BaseMiddleware):
+    def __init__(self, min_update_seconds: int = 300):
+        # Не пишем в базу чаще, чем раз в min_update_seconds на пользователя
+        self.min_update_seconds = min_update_seconds
+        self._last_written: Dict[int, datetime] = {}
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        db = data.get("db")
+        if user is not None and db is not None and db.is_registered(user.id):
+            now = datetime.utcnow()
+            last_written = self._last_written.get(user.id)
+            if last_written is None or (now - last_written).total_seconds() >= self.min_update_seconds:
+                self._last_written[user.id] = now
+                db.update_user(user.id, last_seen_at=now)
+        return await handler(event, data)
@@ -0,0 +1,25 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from database.fsm_storage import SQLiteStorage
+
+
+# Открывает снимок FSM на время обработки апдейта: get_data() читает базу один раз,
+# а все изменения состояния записываются одним запросом после хендлера
+class FSMSnapshotMiddleware(BaseMiddleware):
+    def __init__(self, storage: SQLiteStorage):
+        self.storage = storage
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        token = self.storage.open_snapshot()
+        try:
+            return await handler(event, data)
+        finally:
+            self.storage.close_snapshot(token)
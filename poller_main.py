@@ -0,0 +1,98 @@
+"""
+Отдельный процесс poller'а для режима POLLER_MODE=lease.
+Запускает только опрос почты и отправку уведомлений; пользователей делит с другими
+экземплярами через аренду в общей базе. Бот при этом можно запускать с POLLER_EMBEDDED=false.
+"""
+import asyncio
+import logging
+import signal
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.enums import ParseMode
+from config.config import Config, load_config
+from database.database import Database, init_db
+from app.tasks.poller import Poller
+from app.tasks.mail_actions import MailActionBatcher
+from app.tasks.notifier import Notifier
+from services.mail_cache import UnreadCache
+from services.mail_index import MailIndex
+from services.executors import configure_lanes
+from services.mail_service import close_backend, configure_account_pool, configure_backend, on_user_changed
+from services.metrics import start_metrics_server
+from services.previews import configure_previews
+from services.throttling import configure_governors
+
+logger = logging.getLogger(__name__)
+
+
+async def main():
+    config: Config = load_config()
+
+    logging.basicConfig(
+        level=logging.getLevelName(level=config.log.level),
+        format=config.log.format,
+    )
+    if config.poller.mode != "lease":
+        logger.warning("POLLER_MODE is not 'lease': this process would poll the same users as the bot")
+    logger.info("Starting poller %s", config.poller.instance_id)
+
+    bot = Bot(
+        token=config.bot.token,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    )
+
+    db: Database = init_db()
+    configure_account_pool(config.mail.account_cache_size, config.mail.account_idle_ttl)
+    configure_governors(
+        rate=config.mail.ews_rate,
+        burst=config.mail.ews_burst,
+        max_wait=config.mail.ews_max_wait,
+        backoff=config.mail.ews_backoff,
+        max_backoff=config.mail.ews_max_backoff,
+        ramp_seconds=config.mail.ews_ramp_seconds,
+    )
+    configure_lanes(
+        interactive_workers=config.mail.interactive_workers,
+        interactive_timeout=config.mail.interactive_timeout,
+        background_workers=config.mail.background_workers,
+        background_timeout=config.mail.background_timeout,
+    )
+    configure_backend(config.mail.ews_backend, config.mail.ews_connections)
+    configure_previews(config.mail.preview_chars, config.mail.preview_cache_size)
+    db.listeners.append(on_user_changed)
+
+    # Кнопки уведомлений сохраняются в базе, нажатия обрабатывает процесс бота
+    # Кэш непрочитанных писем для /check_mail, общий с poller'ом
+    unread_cache = UnreadCache(config.mail.unread_cache_ttl, config.mail.unread_cache_max_stale)
+    mail_actions = MailActionBatcher(db, config, bot, unread_cache)
+    # Локальный индекс заголовков писем для /search
+    mail_index = MailIndex(db, config)
+    notifier = Notifier(config, bot, mail_actions, db)
+    notifier.start()
+    await notifier.restore()
+
+    poller = Poller(db, config, bot, mail_actions, notifier, mail_index, unread_cache)
+
+    # Метрики Prometheus на локальном HTTP-порту
+    metrics_runner = None
+    if config.metrics.enabled:
+        metrics_runner = await start_metrics_server(config.metrics.host, config.metrics.port)
+
+    # SIGINT/SIGTERM останавливают poller штатно: текущие опросы доделываются, состояние сохраняется
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, poller.stop)
+
+    try:
+        await poller.poll_loop()
+    finally:
+        await notifier.stop()
+        await close_backend()
+        await db.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,230 @@
+"""
+services/attachment_cache.py
+
+Пересылка вложений писем в Telegram с кэшем по содержимому.
+- Вложение скачивается из EWS потоком прямо в файл кэша; имя файла — SHA-256 содержимого,
+  поэтому одинаковые файлы из разных ящиков хранятся один раз.
+- Размер кэша ограничен, вытесняются давно не использованные файлы (LRU).
+- После первой загрузки в Telegram запоминается file_id: следующие отправки тех же байтов
+  идут через send_document(file_id) без загрузки.
+- (ящик, Message-ID, имя, размер) запоминается как псевдоним хэша: повторная пересылка того же вложения
+  не скачивает его из EWS. Псевдоним привязан к ящику: Message-ID задаёт отправитель письма, и общий
+  для всех псевдоним позволил бы подменить вложение в чужих ящиках; первый записанный хэш не перезаписывается.
+- Файлы, которые сейчас загружаются в Telegram, не вытесняются; если файл всё же пропал, он скачивается заново.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.types import FSInputFile
+
+from database.database import Database
+from services.mail_service import download_attachment_async
+from services.metrics import ATTACHMENT_CACHE_BYTES, ATTACHMENT_DELIVERIES
+
+logger = logging.getLogger(__name__)
+
+# Лимит Bot API на отправку файла ботом
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+# Сколько дней помнить псевдонимы вложений (хэши и file_id не устаревают)
+ALIAS_TTL_DAYS = 30
+
+
+class AttachmentTooLargeForTelegram(Exception):
+    pass
+
+
+def _alias(login: str, attachment: Dict[str, Any]) -> Optional[str]:
+    """Ключ вложения в ящике login (если у письма есть Message-ID)"""
+    if not attachment.get("message_id"):
+        return None
+    key = f"{login.lower()}\0{attachment['message_id']}\0{attachment.get('name')}\0{attachment.get('size')}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class AttachmentCache:
+    def __init__(self, db: Database, directory: str, max_bytes: int):
+        self.db = db
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        # sha256 -> размер файла; порядок — от давно использованных к недавним
+        self._files: "OrderedDict[str, int]" = OrderedDict()
+        self._total = 0
+        # Одновременные скачивания одного вложения и загрузки одного файла объединяются
+        self._downloads: Dict[str, asyncio.Task] = {}
+        self._uploads: Dict[str, asyncio.Task] = {}
+        # sha256 -> сколько загрузок сейчас читают файл; такие файлы _evict не удаляет
+        self._pins: Dict[str, int] = {}
+        ATTACHMENT_CACHE_BYTES.set_function(lambda: self._total)
+
+    async def load(self):
+        """Восстанавливает LRU по файлам на диске (порядок — по времени последнего использования)"""
+        files = await asyncio.to_thread(self._scan)
+        for digest, size in files:
+            self._files[digest] = size
+            self._total += size
+        self._evict()
+        self.db.delete_old_attachment_aliases(datetime.utcnow() - timedelta(days=ALIAS_TTL_DAYS))
+        logger.info("Attachment cache: %d files, %.1f MB", len(self._files), self._total / 1024 / 1024)
+
+    def _scan(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        files = []
+        for path in self.directory.glob("*/*"):
+            if path.name.startswith("."):
+                # Недокачанный временный файл прошлого запуска
+                path.unlink(missing_ok=True)
+                continue
+            stat = path.stat()
+            files.append((stat.st_atime, path.name, stat.st_size))
+        return [(digest, size) for _, digest, size in sorted(files)]
+
+    def _path(self, digest: str) -> Path:
+        return self.directory / digest[:2] / digest
+
+    async def send(self, bot: Bot, chat_id: int, user_data: Dict[str, Any], attachment: Dict[str, Any], server: str, verify_ssl: bool):
+        """
+        Отправляет вложение (описание из list_attachments) в чат.
+        Бросает AttachmentTooLargeForTelegram, ServerThrottled и ошибки EWS / Telegram.
+        """
+        if (attachment.get("size") or 0) > TELEGRAM_UPLOAD_LIMIT:
+            raise AttachmentTooLargeForTelegram(attachment.get("name"))
+
+        alias = _alias(user_data["login"], attachment)
+        digest = await self.db.get_attachment_alias(alias) if alias else None
+        file_id = await self.db.get_attachment_file_id(digest) if digest else None
+        source = "cache"
+        if file_id is None and (digest is None or digest not in self._files):
+            digest, _ = await self._single_flight(
+                self._downloads, alias or attachment["attachment_id"],
+                lambda: self._download(user_data, attachment, alias, server, verify_ssl),
+                share_errors=True,
+            )
+            file_id = await self.db.get_attachment_file_id(digest)
+            source = "download"
+
+        if file_id is None:
+            def redownload() -> Awaitable[str]:
+                return self._download(user_data, attachment, alias, server, verify_ssl)
+
+            file_id, uploaded = await self._single_flight(
+                self._uploads, digest, lambda: self._upload(bot, chat_id, digest, attachment["name"], redownload),
+            )
+            if uploaded:
+                ATTACHMENT_DELIVERIES.inc(source)
+                return
+            if file_id is None:
+                # Чужая загрузка не удалась — загружаем сами
+                await self._upload(bot, chat_id, digest, attachment["name"], redownload)
+                ATTACHMENT_DELIVERIES.inc(source)
+                return
+
+        # Эти байты уже есть в Telegram: отправка без загрузки
+        await bot.send_document(chat_id, file_id)
+        ATTACHMENT_DELIVERIES.inc("file_id")
+
+    async def _single_flight(
+        self,
+        inflight: Dict[str, asyncio.Task],
+        key: str,
+        factory: Callable[[], Awaitable[Any]],
+        share_errors: bool = False,
+    ) -> Tuple[Any, bool]:
+        """
+        Возвращает (результат, выполнил ли операцию именно этот вызов).
+        Без share_errors ошибку получает только выполнивший вызов, остальные получают None.
+        """
+        task = inflight.get(key)
+        if task is None:
+            task = inflight[key] = asyncio.create_task(factory())
+            task.add_done_callback(lambda _: inflight.pop(key, None))
+            return await asyncio.shield(task), True
+        try:
+            return await asyncio.shield(task), False
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            if share_errors:
+                raise
+            return None, False
+
+    async def _download(self, user_data: Dict[str, Any], attachment: Dict[str, Any], alias: Optional[str], server: str, verify_ssl: bool) -> str:
+        """Скачивает вложение в кэш и возвращает хэш содержимого"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, prefix=".download-")
+        try:
+            with os.fdopen(fd, "wb") as fileobj:
+                digest = await download_attachment_async(
+                    user_data["login"], user_data["password"], attachment["attachment_id"], fileobj, server, verify_ssl
+                )
+            size = os.path.getsize(tmp_name)
+            path = self._path(digest)
+            path.parent.mkdir(exist_ok=True)
+            os.replace(tmp_name, path)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+        if digest not in self._files:
+            self._total += size
+        self._files[digest] = size
+        self._files.move_to_end(digest)
+        self._evict(keep=digest)
+        if alias:
+            self.db.save_attachment_alias(alias, digest)
+        return digest
+
+    async def _upload(self, bot: Bot, chat_id: int, digest: str, name: str, redownload: Callable[[], Awaitable[str]]) -> Optional[str]:
+        """Загружает файл из кэша в Telegram и запоминает его file_id"""
+        path = self._path(digest)
+        try:
+            self._files.move_to_end(digest)
+            # Время доступа — порядок LRU после перезапуска
+            os.utime(path)
+        except (KeyError, FileNotFoundError):
+            # Файл вытеснен, пока ждали своей очереди (или удалён с диска) — скачиваем заново
+            logger.info(f"Cached attachment {digest} is gone, downloading it again")
+            self._forget(digest)
+            digest = await redownload()
+            path = self._path(digest)
+        with self._pinned(digest):
+            message = await bot.send_document(chat_id, FSInputFile(path, filename=name))
+        if not message.document:
+            return None
+        self.db.save_attachment_file_id(digest, message.document.file_id)
+        return message.document.file_id
+
+    @contextmanager
+    def _pinned(self, digest: str):
+        """Защищает файл от вытеснения, пока он читается"""
+        self._pins[digest] = self._pins.get(digest, 0) + 1
+        try:
+            yield
+        finally:
+            self._pins[digest] -= 1
+            if not self._pins[digest]:
+                del self._pins[digest]
+
+    def _forget(self, digest: str):
+        size = self._files.pop(digest, None)
+        if size is not None:
+            self._total -= size
+
+    def _evict(self, keep: Optional[str] = None):
+        for digest in list(self._files):
+            if self._total <= self.max_bytes:
+                break
+            if digest == keep or digest in self._pins:
+                continue
+            self._forget(digest)
+            try:
+                self._path(digest).unlink()
+            except OSError as e:
+                logger.warning(f"Failed to remove cached attachment {digest}: {e}")
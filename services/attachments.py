@@ -0,0 +1,105 @@
+"""
+services/attachments.py
+
+Вложения из Telegram для отправки по почте:
+- describe_attachment(message) -> dict | None — описание вложения (file_id, имя, размер) для FSM
+- download_attachments(bot, attachments) -> list[(имя, буфер)] — параллельная потоковая загрузка
+- close_attachments(files) — освобождение буферов
+
+Файлы скачиваются по частям во временные буферы (SpooledTemporaryFile),
+которые хранят данные в памяти только до порога и дальше переносятся на диск.
+"""
+import asyncio
+import logging
+from tempfile import SpooledTemporaryFile
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.types import Message
+
+logger = logging.getLogger(__name__)
+
+# Одновременных загрузок из Telegram на весь процесс
+MAX_PARALLEL_DOWNLOADS = 8
+_download_limit = asyncio.Semaphore(MAX_PARALLEL_DOWNLOADS)
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+def describe_attachment(message: Message) -> Optional[Dict[str, Any]]:
+    """Возвращает описание вложения любого поддерживаемого типа (сериализуемое, для хранения в FSM)"""
+    if message.document:
+        media, name = message.document, message.document.file_name
+    elif message.photo:
+        # Берём самое большое разрешение фотографии
+        media = message.photo[-1]
+        name = f"photo_{media.file_unique_id}.jpg"
+    elif message.video:
+        media, name = message.video, message.video.file_name or f"video_{message.video.file_unique_id}.mp4"
+    elif message.audio:
+        media, name = message.audio, message.audio.file_name or f"audio_{message.audio.file_unique_id}.mp3"
+    else:
+        return None
+    return {
+        "file_id": media.file_id,
+        "name": name or f"file_{media.file_unique_id}",
+        "size": media.file_size or 0,
+    }
+
+
+def check_attachment_size(attachments: List[Dict[str, Any]], new: Dict[str, Any], max_size: int, max_total: int):
+    """Проверяет лимиты до скачивания, по размеру из Telegram"""
+    if new["size"] > max_size:
+        raise AttachmentTooLarge(new["name"])
+    if sum(a["size"] for a in attachments) + new["size"] > max_total:
+        raise AttachmentTooLarge(new["name"])
+
+
+async def _download_one(bot: Bot, attachment: Dict[str, Any], spool_size: int, max_size: int) -> Tuple[str, BinaryIO]:
+    buffer = SpooledTemporaryFile(max_size=spool_size)
+    try:
+        async with _download_limit:
+            # aiogram пишет файл в буфер по частям, не загружая его целиком в память
+            await bot.download(attachment["file_id"], destination=buffer, seek=False)
+        if buffer.tell() > max_size:
+            raise AttachmentTooLarge(attachment["name"])
+        buffer.seek(0)
+        return attachment["name"], buffer
+    except BaseException:
+        buffer.close()
+        raise
+
+
+async def download_attachments(
+    bot: Bot,
+    attachments: List[Dict[str, Any]],
+    spool_size: int,
+    max_size: int,
+) -> List[Tuple[str, BinaryIO]]:
+    """
+    Параллельно скачивает вложения письма.
+    :param attachments: описания из describe_attachment
+    :param spool_size: до какого размера буфер держится в памяти
+    :param max_size: максимальный размер одного файла
+    :return: список (имя, буфер) для send_mail; буферы нужно закрыть через close_attachments
+    """
+    results = await asyncio.gather(
+        *(_download_one(bot, a, spool_size, max_size) for a in attachments),
+        return_exceptions=True,
+    )
+    files = [r for r in results if not isinstance(r, BaseException)]
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        close_attachments(files)
+        raise errors[0]
+    return files
+
+
+def close_attachments(files: List[Tuple[str, BinaryIO]]):
+    for _, buffer in files:
+        try:
+            buffer.close()
+        except Exception as e:
+            logger.debug("Failed to close attachment buffer: %s", e)
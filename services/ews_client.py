@@ -0,0 +1,467 @@
+"""
+services/ews_client.py
+
+Нативный asyncio-клиент EWS для горячих путей бота: опрос почты и отправка писем.
+exchangelib выполняется в потоках, и при тысячах ящиков потолком становятся число потоков,
+сессии requests на каждый поток и разбор XML под GIL. Этот клиент работает в event loop:
+- одна общая aiohttp-сессия с пулом keep-alive соединений на все ящики (учётные данные — в каждом запросе);
+- ответ разбирается потоково (XMLPullParser) по мере прихода, каждое письмо превращается в словарь
+  и сразу освобождается, поэтому большой ответ не держится в памяти целиком.
+Поддерживается только то, что нужно боту: FindItem, GetItem (заголовки и вложения без содержимого),
+SyncFolderItems, CreateItem (SendAndSaveCopy) и UpdateItem (прочитано / не прочитано).
+Нужен Exchange 2013 или новее, авторизация — только Basic. Включается MAIL_EWS_BACKEND=aiohttp; остальные операции
+и бэкенд по умолчанию по-прежнему используют exchangelib.
+Функции возвращают те же структуры, что и одноимённые функции services/mail_service.
+"""
+import asyncio
+import base64
+import logging
+import re
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Set, Tuple, Union
+from xml.etree.ElementTree import Element, XMLPullParser
+from xml.sax.saxutils import escape, quoteattr
+
+import aiohttp
+
+from services import previews
+
+logger = logging.getLogger(__name__)
+
+_NS_SOAP = "http://schemas.xmlsoap.org/soap/envelope/"
+_NS_M = "http://schemas.microsoft.com/exchange/services/2006/messages"
+_NS_T = "http://schemas.microsoft.com/exchange/services/2006/types"
+_NS_E = "http://schemas.microsoft.com/exchange/services/2006/errors"
+
+_ENVELOPE = (
+    '<?xml version="1.0" encoding="utf-8"?>'
+    f'<s:Envelope xmlns:s="{_NS_SOAP}" xmlns:m="{_NS_M}" xmlns:t="{_NS_T}">'
+    '<s:Header><t:RequestServerVersion Version="Exchange2013"/></s:Header>'
+    "<s:Body>{body}</s:Body></s:Envelope>"
+)
+
+# Поля заголовков письма для уведомлений (как _HEADER_FIELDS в mail_service)
+_HEADER_SHAPE = (
+    "<m:ItemShape><t:BaseShape>IdOnly</t:BaseShape><t:AdditionalProperties>"
+    '<t:FieldURI FieldURI="item:Subject"/><t:FieldURI FieldURI="message:Sender"/>'
+    '<t:FieldURI FieldURI="item:DateTimeReceived"/><t:FieldURI FieldURI="item:HasAttachments"/>'
+    '<t:FieldURI FieldURI="message:IsRead"/>'
+    "</t:AdditionalProperties></m:ItemShape>"
+)
+# Ключ идемпотентности письма очереди outbox (то же свойство, что OutboxKey в mail_service)
+_OUTBOX_KEY_URI = '<t:ExtendedFieldURI DistinguishedPropertySetId="PublicStrings" PropertyName="MailBotOutboxKey" PropertyType="String"/>'
+# Сколько изменений запрашивать за один SyncFolderItems
+_SYNC_PAGE = 512
+_READ_CHUNK = 64 * 1024
+# Сколько байт вложения читать и кодировать в base64 за раз (кратно 3)
+_ATTACHMENT_CHUNK = 3 * 256 * 1024
+
+# Символы, запрещённые в XML 1.0 (могут прийти в тексте из Telegram)
+_INVALID_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+
+class EWSError(Exception):
+    """
+    Ошибка ответа EWS. Атрибуты back_off / retry_after / status_code разбирает
+    services.throttling.throttle_delay, как и у исключений exchangelib.
+    """
+
+    def __init__(self, code: str, message: Optional[str] = None, back_off: Optional[float] = None,
+                 status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(f"{code}: {message}" if message else code)
+        self.code = code
+        self.back_off = back_off
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def _m(tag: str) -> str:
+    return f"{{{_NS_M}}}{tag}"
+
+
+def _t(tag: str) -> str:
+    return f"{{{_NS_T}}}{tag}"
+
+
+def _text(value: Optional[str]) -> str:
+    return escape(_INVALID_XML_CHARS.sub("", value or ""))
+
+
+def _endpoint(server: str) -> str:
+    # Полный адрес эндпоинта (например, fake EWS из benchmarks/) — как в _build_account
+    if server.startswith(("http://", "https://")):
+        return server
+    return f"https://{server}/EWS/Exchange.asmx"
+
+
+def _basic_auth(email: str, password: str) -> str:
+    return "Basic " + base64.b64encode(f"{email}:{password}".encode()).decode()
+
+
+def _back_off(elem: Element) -> Optional[float]:
+    for value in elem.iter(_t("Value")):
+        if value.get("Name") == "BackOffMilliseconds" and value.text:
+            return int(value.text) / 1000
+    return None
+
+
+def _response_error(elem: Element) -> Optional[EWSError]:
+    """Ошибка из ResponseMessage (None для Success и Warning)"""
+    if elem.get("ResponseClass") != "Error":
+        return None
+    return EWSError(elem.findtext(_m("ResponseCode")) or "Error", elem.findtext(_m("MessageText")), _back_off(elem))
+
+
+def _fault_error(elem: Element, status: int) -> EWSError:
+    code = elem.findtext(f".//{{{_NS_E}}}ResponseCode") or (elem.findtext("faultcode") or "Fault").rsplit(":", 1)[-1]
+    return EWSError(code, elem.findtext("faultstring"), _back_off(elem), status_code=status)
+
+
+def _raise_first_error(responses: List[Tuple[Optional[EWSError], Element]]):
+    for error, _ in responses:
+        if error is not None:
+            raise error
+
+
+def _parse_datetime(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone(timezone.utc)
+
+
+def _message_entry(elem: Element) -> Dict[str, Any]:
+    """Письмо из ответа EWS в формате fetch_unread_emails (плюс is_read для фильтрации)"""
+    item_id = elem.find(_t("ItemId"))
+    return {
+        "id": item_id.get("Id") if item_id is not None else None,
+        "changekey": item_id.get("ChangeKey") if item_id is not None else None,
+        "subject": elem.findtext(_t("Subject")),
+        "from": elem.findtext(f"{_t('Sender')}/{_t('Mailbox')}/{_t('EmailAddress')}"),
+        "datetime_received": _parse_datetime(elem.findtext(_t("DateTimeReceived"))),
+        "has_attachments": elem.findtext(_t("HasAttachments")) == "true",
+        "attachments": [],
+        "is_read": elem.findtext(_t("IsRead")) == "true",
+    }
+
+
+def _item_details(elem: Element) -> Tuple[Optional[str], List[Dict[str, Any]], Optional[str]]:
+    """(id письма, вложения без содержимого, текст тела или None, если тело не запрашивалось)"""
+    item_id = elem.find(_t("ItemId"))
+    container = elem.find(_t("Attachments"))
+    attachments = []
+    for attachment in container if container is not None else ():
+        size = attachment.findtext(_t("Size"))
+        attachments.append({"name": attachment.findtext(_t("Name")), "size": int(size) if size else None})
+    body = elem.find(_t("Body"))
+    return (item_id.get("Id") if item_id is not None else None), attachments, (body.text or "") if body is not None else None
+
+
+def _item_ids(ids: List[Tuple[str, Optional[str]]]) -> str:
+    return "".join(
+        f"<t:ItemId Id={quoteattr(item_id)}" + (f" ChangeKey={quoteattr(changekey)}" if changekey else "") + "/>"
+        for item_id, changekey in ids
+    )
+
+
+async def _create_items_body(messages: List[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    """
+    Тело CreateItem по частям: вложения читаются и кодируются в base64 блоками в потоке,
+    поэтому ни файл, ни запрос целиком в памяти не собираются.
+    """
+    yield (
+        '<m:CreateItem MessageDisposition="SendAndSaveCopy">'
+        '<m:SavedItemFolderId><t:DistinguishedFolderId Id="sentitems"/></m:SavedItemFolderId><m:Items>'
+    ).encode()
+    for m in messages:
+        # Порядок элементов задан схемой: Subject, Body, Attachments, ExtendedProperty, ToRecipients
+        yield (
+            "<t:Message>"
+            f"<t:Subject>{_text(m['subject'])}</t:Subject>"
+            f'<t:Body BodyType="Text">{_text(m["body"])}</t:Body>'
+        ).encode()
+        attachments = m.get("attachments") or []
+        if attachments:
+            yield b"<t:Attachments>"
+            for name, fileobj in attachments:
+                yield f"<t:FileAttachment><t:Name>{_text(name)}</t:Name><t:Content>".encode()
+                fileobj.seek(0)
+                while True:
+                    # Блок кратен 3 байтам, поэтому куски base64 склеиваются без выравнивания внутри
+                    chunk = await asyncio.to_thread(fileobj.read, _ATTACHMENT_CHUNK)
+                    if not chunk:
+                        break
+                    yield base64.b64encode(chunk)
+                yield b"</t:Content></t:FileAttachment>"
+            yield b"</t:Attachments>"
+        recipients = "".join(f"<t:Mailbox><t:EmailAddress>{_text(address)}</t:EmailAddress></t:Mailbox>" for address in m["to"])
+        yield (
+            f"<t:ExtendedProperty>{_OUTBOX_KEY_URI}<t:Value>{_text(m['key'])}</t:Value></t:ExtendedProperty>"
+            f"<t:ToRecipients>{recipients}</t:ToRecipients>"
+            "</t:Message>"
+        ).encode()
+    yield b"</m:Items></m:CreateItem>"
+
+
+async def _envelope(body: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """SOAP-конверт вокруг тела, которое передаётся по частям (chunked transfer encoding)"""
+    head, tail = _ENVELOPE.split("{body}")
+    yield head.encode()
+    async for chunk in body:
+        yield chunk
+    yield tail.encode()
+
+
+class EWSClient:
+    def __init__(self, connections: int = 100):
+        # Общий предел keep-alive соединений к EWS на процесс
+        self.connections = connections
+        self._sessions: Dict[bool, aiohttp.ClientSession] = {}
+
+    def _session(self, verify_ssl: bool) -> aiohttp.ClientSession:
+        session = self._sessions.get(verify_ssl)
+        if session is None or session.closed:
+            if verify_ssl:
+                connector = aiohttp.TCPConnector(limit=self.connections)
+            else:
+                # DEV: без проверки сертификата, как NoVerifyHTTPAdapter у exchangelib
+                connector = aiohttp.TCPConnector(limit=self.connections, ssl=False)
+            session = self._sessions[verify_ssl] = aiohttp.ClientSession(
+                connector=connector, headers={"Content-Type": "text/xml; charset=utf-8"}
+            )
+        return session
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+    async def _call(
+        self,
+        email: str,
+        password: str,
+        server: str,
+        verify_ssl: bool,
+        body: Union[str, AsyncIterator[bytes]],
+        container: Optional[str] = None,
+        convert: Optional[Callable[[Element], Any]] = None,
+    ) -> Tuple[List[Any], List[Tuple[Optional[EWSError], Element]]]:
+        """
+        Отправляет SOAP-запрос и разбирает ответ по мере получения.
+        body — строка или асинхронный генератор частей тела (отправляется без сборки целиком).
+        Каждый дочерний элемент container передаётся в convert и освобождается.
+        :return: (результаты convert, [(ошибка или None, ResponseMessage), ...] в порядке ответа)
+        """
+        items: List[Any] = []
+        responses: List[Tuple[Optional[EWSError], Element]] = []
+        data = _ENVELOPE.format(body=body).encode() if isinstance(body, str) else _envelope(body)
+        async with self._session(verify_ssl).post(
+            _endpoint(server), data=data, headers={"Authorization": _basic_auth(email, password)}
+        ) as response:
+            # Ошибки SOAP (Fault) приходят с кодом 500 и разбираются ниже
+            if response.status not in (200, 500):
+                retry_after = response.headers.get("Retry-After")
+                raise EWSError(
+                    f"HTTP {response.status}", response.reason, status_code=response.status,
+                    retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None,
+                )
+            parser = XMLPullParser(events=("start", "end"))
+            path: List[str] = []
+
+            def drain():
+                for event, elem in parser.read_events():
+                    if event == "start":
+                        path.append(elem.tag)
+                        continue
+                    path.pop()
+                    if container is not None and path and path[-1] == container:
+                        if convert is not None:
+                            result = convert(elem)
+                            if result is not None:
+                                items.append(result)
+                        elem.clear()
+                    elif elem.tag.endswith("ResponseMessage"):
+                        responses.append((_response_error(elem), elem))
+                    elif elem.tag == f"{{{_NS_SOAP}}}Fault":
+                        raise _fault_error(elem, response.status)
+
+            async for chunk in response.content.iter_chunked(_READ_CHUNK):
+                parser.feed(chunk)
+                drain()
+            parser.close()
+            drain()
+        if not responses:
+            raise EWSError("ErrorInvalidResponse", f"no response messages (HTTP {response.status})")
+        return items, responses
+
+    # --- операции ---
+
+    async def fetch_unread_emails(self, email: str, password: str, limit: int, mark_as_read: bool, server: str, verify_ssl: bool) -> List[Dict[str, Any]]:
+        body = (
+            '<m:FindItem Traversal="Shallow">' + _HEADER_SHAPE
+            + f'<m:IndexedPageItemView MaxEntriesReturned="{int(limit)}" Offset="0" BasePoint="Beginning"/>'
+            '<m:Restriction><t:IsEqualTo><t:FieldURI FieldURI="message:IsRead"/>'
+            '<t:FieldURIOrConstant><t:Constant Value="false"/></t:FieldURIOrConstant></t:IsEqualTo></m:Restriction>'
+            '<m:SortOrder><t:FieldOrder Order="Descending"><t:FieldURI FieldURI="item:DateTimeReceived"/></t:FieldOrder></m:SortOrder>'
+            '<m:ParentFolderIds><t:DistinguishedFolderId Id="inbox"/></m:ParentFolderIds>'
+            "</m:FindItem>"
+        )
+        entries, responses = await self._call(email, password, server, verify_ssl, body, _t("Items"), _message_entry)
+        _raise_first_error(responses)
+        entries = entries[:limit]
+        await self._add_details(email, password, entries, server, verify_ssl, with_previews=True)
+
+        if mark_as_read and entries:
+            await self.set_read(email, password, [(e["id"], e["changekey"]) for e in entries], True, server, verify_ssl)
+        logger.info("Fetched %d unread emails (limit=%d)", len(entries), limit)
+        return [_public(entry) for entry in entries]
+
+    async def sync_new_emails(self, email: str, password: str, sync_state: Optional[str], limit: int, server: str, verify_ssl: bool) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Как mail_service.sync_new_emails: первый вызов только запоминает состояние папки"""
+        initial = sync_state is None
+        shape = "<m:ItemShape><t:BaseShape>IdOnly</t:BaseShape></m:ItemShape>" if initial else _HEADER_SHAPE
+        # Базовая синхронизация пропускает письма, не разбирая их
+        convert = (lambda change: None) if initial else _created_entry
+        new_entries: List[Dict[str, Any]] = []
+        while True:
+            body = (
+                "<m:SyncFolderItems>" + shape
+                + '<m:SyncFolderId><t:DistinguishedFolderId Id="inbox"/></m:SyncFolderId>'
+                + (f"<m:SyncState>{_text(sync_state)}</m:SyncState>" if sync_state else "")
+                + f"<m:MaxChangesReturned>{_SYNC_PAGE}</m:MaxChangesReturned></m:SyncFolderItems>"
+            )
+            entries, responses = await self._call(email, password, server, verify_ssl, body, _m("Changes"), convert)
+            _raise_first_error(responses)
+            response = responses[0][1]
+            sync_state = response.findtext(_m("SyncState"))
+            new_entries.extend(entries)
+            if response.findtext(_m("IncludesLastItemInRange")) != "false":
+                break
+
+        if initial:
+            logger.info("Initial mailbox sync completed for %s", email)
+            return [], sync_state
+        min_time = datetime.min.replace(tzinfo=timezone.utc)
+        new_entries.sort(key=lambda e: e["datetime_received"] or min_time, reverse=True)
+        # Подробности — только у limit самых свежих непрочитанных, остальные письма возвращаются с заголовками
+        unread = [entry for entry in new_entries if not entry["is_read"]]
+        await self._add_details(email, password, unread[:limit], server, verify_ssl, with_previews=True)
+        logger.info("Synced %d new emails for %s", len(new_entries), email)
+        # is_read остаётся: письма, пришедшие прочитанными, нужны индексу поиска, но не уведомлениям
+        return new_entries, sync_state
+
+    async def _add_details(self, email: str, password: str, entries: List[Dict[str, Any]], server: str, verify_ssl: bool, with_previews: bool = False):
+        """
+        Имена и размеры вложений (и превью текста, если with_previews и превью включены) одним GetItem.
+        Тело запрашивается текстом, не длиннее previews.body_size() и только у писем без превью в кэше.
+        """
+        need_body = set()
+        if with_previews and previews.enabled():
+            for entry in entries:
+                cached = previews.get_preview(entry["id"])
+                if cached is not None:
+                    entry["preview"] = cached
+                elif entry["id"]:
+                    need_body.add(entry["id"])
+        ids = [(e["id"], e["changekey"]) for e in entries if e["id"] and (e["has_attachments"] or e["id"] in need_body)]
+        if not ids:
+            return
+        fields = '<t:FieldURI FieldURI="item:Attachments"/>'
+        shape = "<t:BaseShape>IdOnly</t:BaseShape>"
+        if need_body:
+            fields += '<t:FieldURI FieldURI="item:Body"/>'
+            shape += f"<t:BodyType>Text</t:BodyType><t:MaximumBodySize>{previews.body_size()}</t:MaximumBodySize>"
+        body = (
+            f"<m:GetItem><m:ItemShape>{shape}<t:AdditionalProperties>{fields}</t:AdditionalProperties></m:ItemShape>"
+            f"<m:ItemIds>{_item_ids(ids)}</m:ItemIds></m:GetItem>"
+        )
+        results, responses = await self._call(email, password, server, verify_ssl, body, _m("Items"), _item_details)
+        for error, _ in responses:
+            if error is not None:
+                # Письмо могли удалить между запросами — просто пропускаем
+                logger.warning("Failed to fetch attachments metadata or preview: %s", error)
+        details = {item_id: (attachments, text) for item_id, attachments, text in results}
+        for entry in entries:
+            attachments, text = details.get(entry["id"], ([], None))
+            entry["attachments"] = attachments
+            if entry["id"] in need_body and text is not None:
+                entry["preview"] = previews.save_preview(entry["id"], text)
+
+    async def set_read(self, email: str, password: str, ids: List[Tuple[str, Optional[str]]], is_read: bool, server: str, verify_ssl: bool):
+        """Пакетный UpdateItem: отмечает письма прочитанными или непрочитанными"""
+        value = "true" if is_read else "false"
+        changes = "".join(
+            f"<t:ItemChange>{_item_ids([item])}<t:Updates><t:SetItemField>"
+            f'<t:FieldURI FieldURI="message:IsRead"/><t:Message><t:IsRead>{value}</t:IsRead></t:Message>'
+            "</t:SetItemField></t:Updates></t:ItemChange>"
+            for item in ids
+        )
+        body = (
+            '<m:UpdateItem MessageDisposition="SaveOnly" ConflictResolution="AutoResolve">'
+            f"<m:ItemChanges>{changes}</m:ItemChanges></m:UpdateItem>"
+        )
+        _, responses = await self._call(email, password, server, verify_ssl, body)
+        _raise_first_error(responses)
+
+    async def apply_mail_actions(self, email: str, password: str, actions: Dict[str, List[Tuple[str, Optional[str]]]], server: str, verify_ssl: bool) -> Dict[str, int]:
+        """Только read / unread; перемещение и удаление выполняет exchangelib"""
+        done: Dict[str, int] = {}
+        for action in ("read", "unread"):
+            ids = actions.get(action)
+            if ids:
+                await self.set_read(email, password, ids, action == "read", server, verify_ssl)
+                done[action] = len(ids)
+        logger.info("Applied mail actions for %s: %s", email, done)
+        return done
+
+    async def send_mail_batch(self, email: str, password: str, messages: List[Dict[str, Any]], server: str, verify_ssl: bool, check_sent: bool) -> Dict[str, Optional[str]]:
+        """Как mail_service.send_mail_batch: один CreateItem на все письма, ошибка отдельного письма — в результате"""
+        results: Dict[str, Optional[str]] = {}
+        if check_sent:
+            for key in await self._find_sent_keys(email, password, [m["key"] for m in messages], server, verify_ssl):
+                results[key] = None
+            if results:
+                logger.info("Found %d already sent outbox messages for %s", len(results), email)
+
+        pending = [m for m in messages if m["key"] not in results]
+        if pending:
+            _, responses = await self._call(email, password, server, verify_ssl, _create_items_body(pending))
+            if len(responses) != len(pending):
+                _raise_first_error(responses)
+                raise EWSError("ErrorInvalidResponse", f"{len(responses)} responses for {len(pending)} messages")
+            for m, (error, _) in zip(pending, responses):
+                results[m["key"]] = str(error) if error is not None else None
+        logger.info("Sent %d outbox messages for %s in one request", len(pending), email)
+        return results
+
+    async def _find_sent_keys(self, email: str, password: str, keys: List[str], server: str, verify_ssl: bool) -> Set[str]:
+        conditions = "".join(
+            f"<t:IsEqualTo>{_OUTBOX_KEY_URI}<t:FieldURIOrConstant><t:Constant Value={quoteattr(key)}/>"
+            "</t:FieldURIOrConstant></t:IsEqualTo>"
+            for key in keys
+        )
+        restriction = f"<t:Or>{conditions}</t:Or>" if len(keys) > 1 else conditions
+        body = (
+            '<m:FindItem Traversal="Shallow"><m:ItemShape><t:BaseShape>IdOnly</t:BaseShape>'
+            f"<t:AdditionalProperties>{_OUTBOX_KEY_URI}</t:AdditionalProperties></m:ItemShape>"
+            f'<m:IndexedPageItemView MaxEntriesReturned="{len(keys)}" Offset="0" BasePoint="Beginning"/>'
+            f"<m:Restriction>{restriction}</m:Restriction>"
+            '<m:ParentFolderIds><t:DistinguishedFolderId Id="sentitems"/></m:ParentFolderIds></m:FindItem>'
+        )
+        found, responses = await self._call(
+            email, password, server, verify_ssl, body, _t("Items"),
+            lambda item: item.findtext(f"{_t('ExtendedProperty')}/{_t('Value')}"),
+        )
+        _raise_first_error(responses)
+        return set(found)
+
+
+def _created_entry(change: Element) -> Optional[Dict[str, Any]]:
+    """Из изменений SyncFolderItems нужны только новые письма (t:Create)"""
+    if change.tag != _t("Create") or not len(change):
+        return None
+    return _message_entry(change[0])
+
+
+def _public(entry: Dict[str, Any]) -> Dict[str, Any]:
+    entry.pop("is_read", None)
+    return entry
@@ -0,0 +1,117 @@
+"""
+services/executors.py
+
+Полосы (lanes) для блокирующих вызовов EWS — у каждой свой пул потоков:
+- interactive — запросы, которых ждёт пользователь (/check_mail, отправка писем, вложения, кнопки, /search);
+- background — фоновая работа poller'а.
+Очередь опросов занимает только потоки своей полосы и не задерживает запросы пользователей.
+
+Очередь полосы находится в event loop (семафор по числу потоков), а не в пуле: ожидание в ней
+можно отменить, а её глубина и время ожидания видны в метриках. Вызов ограничен timeout секундами
+(ожидание в очереди + выполнение). Уже выполняющийся в потоке запрос прервать нельзя: вызывающий
+получает LaneTimeout сразу, а поток освобождает место в полосе, когда запрос завершится.
+
+Полоса выбирается контекстной переменной: poller выставляет background в своих задачах,
+всё остальное выполняется в interactive.
+"""
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+from services.metrics import EWS_LANE_QUEUE_DEPTH, EWS_LANE_WAIT_SECONDS, THREADPOOL_BUSY, THREADPOOL_SIZE
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+_current_lane: ContextVar[str] = ContextVar("ews_lane", default=INTERACTIVE)
+
+
+class LaneTimeout(asyncio.TimeoutError):
+    def __init__(self, lane: str, timeout: float):
+        super().__init__(f"EWS call did not finish in {timeout:.0f}s ({lane} lane)")
+        self.lane = lane
+        self.timeout = timeout
+
+
+class Lane:
+    def __init__(self, name: str, workers: int, timeout: float):
+        self.name = name
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"ews-{name}")
+        # Слотов столько же, сколько потоков: пул никогда не копит задачи в своей очереди
+        self._slots = asyncio.Semaphore(self.workers)
+        THREADPOOL_SIZE.set(self.workers, name)
+
+    async def run(self, func: Callable[..., Any], *args, timeout: Optional[float] = None) -> Any:
+        """Выполняет func(*args) в потоке полосы; бросает LaneTimeout, если не уложились в timeout"""
+        loop = asyncio.get_running_loop()
+        timeout = timeout or self.timeout
+        deadline = loop.time() + timeout
+        start = time.perf_counter()
+        EWS_LANE_QUEUE_DEPTH.inc(self.name)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise LaneTimeout(self.name, timeout) from None
+        finally:
+            EWS_LANE_QUEUE_DEPTH.dec(self.name)
+            EWS_LANE_WAIT_SECONDS.observe(time.perf_counter() - start, self.name)
+
+        THREADPOOL_BUSY.inc(self.name)
+        try:
+            future = loop.run_in_executor(self._executor, func, *args)
+        except BaseException:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), max(deadline - loop.time(), 0))
+        except asyncio.TimeoutError:
+            raise LaneTimeout(self.name, timeout) from None
+
+    def _release(self, future: Optional[asyncio.Future]):
+        # Место в полосе освобождается, только когда поток действительно закончил работу
+        THREADPOOL_BUSY.dec(self.name)
+        self._slots.release()
+        if future is not None and not future.cancelled():
+            # Результат брошенного по таймауту вызова никто не ждёт: помечаем ошибку полученной
+            future.exception()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_settings: Dict[str, Dict[str, float]] = {}
+_lanes: Dict[str, Lane] = {}
+
+
+def configure_lanes(interactive_workers: int, interactive_timeout: float, background_workers: int, background_timeout: float):
+    """Задаёт размеры и таймауты полос (вызывается при старте процесса)"""
+    _settings.update({
+        INTERACTIVE: {"workers": interactive_workers, "timeout": interactive_timeout},
+        BACKGROUND: {"workers": background_workers, "timeout": background_timeout},
+    })
+    for lane in _lanes.values():
+        lane.shutdown()
+    _lanes.clear()
+
+
+def get_lane(name: Optional[str] = None) -> Lane:
+    """Полоса по имени; без имени — полоса текущего контекста"""
+    name = name or _current_lane.get()
+    lane = _lanes.get(name)
+    if lane is None:
+        settings = _settings.get(name, {"workers": 4, "timeout": 60})
+        lane = _lanes[name] = Lane(name, int(settings["workers"]), settings["timeout"])
+    return lane
+
+
+def use_lane(name: str):
+    """Выполнять вызовы EWS текущей задачи (и созданных ею задач) в полосе name"""
+    _current_lane.set(name)
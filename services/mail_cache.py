@@ -0,0 +1,95 @@
+"""
+services/mail_cache.py
+
+Кэш списка непрочитанных писем пользователя для /check_mail, общий с poller'ом.
+- Одновременные запросы одного пользователя объединяются в один запрос к EWS (single-flight).
+- Свежий результат (моложе ttl) отдаётся сразу.
+- Устаревший, но не старше max_stale результат тоже отдаётся сразу, а в фоне запускается обновление
+  (stale-while-revalidate).
+- Poller кладёт в кэш то, что получил при опросе; действия с письмами сбрасывают запись пользователя.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Сколько писем хранить в записи (столько же возвращает fetch_unread_emails по умолчанию)
+MAX_ITEMS = 20
+
+Fetcher = Callable[[], Awaitable[List[Dict[str, Any]]]]
+
+
+class UnreadCache:
+    def __init__(self, ttl: float = 60, max_stale: float = 900, maxsize: int = 10000):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.maxsize = maxsize
+        # telegram_id -> (письма, время получения по time.monotonic)
+        self._entries: "OrderedDict[int, Tuple[List[Dict[str, Any]], float]]" = OrderedDict()
+        self._inflight: Dict[int, asyncio.Task] = {}
+
+    async def get(self, telegram_id: int, fetch: Fetcher) -> Tuple[List[Dict[str, Any]], float]:
+        """
+        Возвращает (письма, возраст данных в секундах).
+        fetch — функция запроса к EWS; вызывается не больше одного раза одновременно для пользователя.
+        """
+        entry = self._entries.get(telegram_id)
+        if entry is not None:
+            emails, fetched_at = entry
+            age = time.monotonic() - fetched_at
+            if age < self.ttl:
+                return emails, age
+            if age < self.max_stale:
+                self._refresh(telegram_id, fetch)
+                return emails, age
+        # Общий запрос защищаем от отмены обработчика: его результат нужен и другим ожидающим
+        emails = await asyncio.shield(self._refresh(telegram_id, fetch))
+        return emails, 0.0
+
+    def put(self, telegram_id: int, emails: List[Dict[str, Any]]):
+        """Запоминает полный список непрочитанных писем (результат fetch_unread_emails)"""
+        self._entries[telegram_id] = (emails[:MAX_ITEMS], time.monotonic())
+        self._entries.move_to_end(telegram_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def add_new(self, telegram_id: int, emails: List[Dict[str, Any]]):
+        """
+        Добавляет к записи новые письма, найденные инкрементальной синхронизацией.
+        Возраст записи не меняется: о прочитанных с тех пор письмах синхронизация не сообщает.
+        """
+        entry = self._entries.get(telegram_id)
+        if entry is None or not emails:
+            return
+        cached, fetched_at = entry
+        known = {mail_dict.get("id") for mail_dict in emails}
+        merged = list(emails) + [mail_dict for mail_dict in cached if mail_dict.get("id") not in known]
+        self._entries[telegram_id] = (merged[:MAX_ITEMS], fetched_at)
+
+    def invalidate(self, telegram_id: int):
+        self._entries.pop(telegram_id, None)
+
+    def _refresh(self, telegram_id: int, fetch: Fetcher) -> asyncio.Task:
+        task = self._inflight.get(telegram_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch(telegram_id, fetch))
+            task.add_done_callback(self._log_failure)
+            self._inflight[telegram_id] = task
+        return task
+
+    async def _fetch(self, telegram_id: int, fetch: Fetcher) -> List[Dict[str, Any]]:
+        try:
+            emails = await fetch()
+            self.put(telegram_id, emails)
+            return emails
+        finally:
+            self._inflight.pop(telegram_id, None)
+
+    @staticmethod
+    def _log_failure(task: asyncio.Task):
+        # Ошибку фонового обновления никто может не ждать — забираем её, чтобы asyncio не ругался
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Unread mail refresh failed: {task.exception()}")
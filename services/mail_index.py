@@ -0,0 +1,159 @@
+"""
+services/mail_index.py
+
+Локальный индекс заголовков писем для команды /search.
+Poller (и /check_mail) записывают в него каждый полученный заголовок: отправитель, тема, дата,
+имена вложений и идентификаторы. Поиск идёт по FTS5-индексу в SQLite и не обращается к EWS,
+если локально найдено достаточно писем. Индекс неполон (в него попадают письма, пришедшие после
+регистрации, — и непрочитанные, и пришедшие уже прочитанными, — и результаты /check_mail), поэтому иначе
+поиск повторяется на сервере по всему ящику, а найденные там письма тоже попадают в индекс.
+"""
+import logging
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from config.config import Config
+from database.database import Database
+from services.mail_service import search_emails_async
+
+logger = logging.getLogger(__name__)
+
+_SQL_INSERT_HEADER = """
+    INSERT OR IGNORE INTO mail_headers (telegram_id, item_id, changekey, sender, subject, attachments, received_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+_HEADER_COLUMNS = "h.item_id, h.changekey, h.sender, h.subject, h.attachments, h.received_at"
+_SQL_SEARCH_FTS = f"""
+    SELECT {_HEADER_COLUMNS} FROM mail_headers_fts f JOIN mail_headers h ON h.id = f.rowid
+    WHERE mail_headers_fts MATCH ? ORDER BY h.received_at DESC LIMIT ?
+"""
+_SQL_SEARCH_LIKE = f"""
+    SELECT {_HEADER_COLUMNS} FROM mail_headers h
+    WHERE h.telegram_id = ? AND (h.subject LIKE ? OR h.sender LIKE ? OR h.attachments LIKE ?)
+    ORDER BY h.received_at DESC LIMIT ?
+"""
+_SQL_PRUNE_OLD = "DELETE FROM mail_headers WHERE received_at < ?"
+_SQL_PRUNE_USER = """
+    DELETE FROM mail_headers WHERE id IN (
+        SELECT id FROM mail_headers WHERE telegram_id = ? ORDER BY received_at DESC LIMIT -1 OFFSET ?
+    )
+"""
+
+# Сколько слов запроса учитывать и как часто (в добавленных письмах) подрезать индекс пользователя
+MAX_QUERY_TERMS = 8
+PRUNE_USER_EVERY = 100
+PRUNE_OLD_SECONDS = 3600
+
+
+def _to_utc(value: Any) -> Optional[datetime]:
+    """Дата письма exchangelib (с часовым поясом) -> наивное время UTC, как остальные даты в базе"""
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _fts_query(telegram_id: int, query: str) -> Optional[str]:
+    """Префиксный поиск всех слов запроса среди писем одного пользователя"""
+    terms = re.findall(r"\w+", query.replace("ё", "е").replace("Ё", "Е"))[:MAX_QUERY_TERMS]
+    if not terms:
+        return None
+    return f"owner:u{telegram_id} AND {{subject sender attachments}}:(" + " AND ".join(f'"{term}"*' for term in terms) + ")"
+
+
+def _row_to_entry(row: Sequence[Any]) -> Dict[str, Any]:
+    attachments = [name for name in (row[4] or "").split("\n") if name]
+    return {
+        "id": row[0],
+        "changekey": row[1],
+        "from": row[2],
+        "subject": row[3],
+        "datetime_received": datetime.fromisoformat(row[5]) if row[5] else None,
+        "has_attachments": bool(attachments),
+        "attachments": [{"name": name} for name in attachments],
+    }
+
+
+class MailIndex:
+    def __init__(self, db: Database, config: Config):
+        self.db = db
+        self.config = config
+        self.settings = config.search
+        # Сколько писем добавлено пользователю с последней подрезки его индекса
+        self._added: Dict[int, int] = {}
+        self._pruned_at = 0.0
+
+    def add(self, telegram_id: int, emails: List[Dict[str, Any]]):
+        """Записывает заголовки писем в индекс (не ждёт фиксации)"""
+        now = datetime.utcnow()
+        cutoff = now - timedelta(days=self.settings.retention_days)
+        added = 0
+        for mail_dict in emails:
+            received_at = _to_utc(mail_dict.get("datetime_received"))
+            if not mail_dict.get("id") or (received_at and received_at < cutoff):
+                continue
+            attachments = "\n".join(att.get("name") or "" for att in mail_dict.get("attachments") or [])
+            self.db.execute(_SQL_INSERT_HEADER, (
+                telegram_id, mail_dict["id"], mail_dict.get("changekey"), mail_dict.get("from"),
+                mail_dict.get("subject"), attachments, received_at or now,
+            ))
+            added += 1
+        self._prune(telegram_id, added)
+
+    def _prune(self, telegram_id: int, added: int):
+        """Держит индекс в пределах срока хранения и лимита писем на пользователя"""
+        self._added[telegram_id] = self._added.get(telegram_id, 0) + added
+        if self._added[telegram_id] >= PRUNE_USER_EVERY:
+            self._added[telegram_id] = 0
+            self.db.execute(_SQL_PRUNE_USER, (telegram_id, self.settings.max_per_user))
+        if time.monotonic() - self._pruned_at >= PRUNE_OLD_SECONDS:
+            self._pruned_at = time.monotonic()
+            self.db.execute(_SQL_PRUNE_OLD, (datetime.utcnow() - timedelta(days=self.settings.retention_days),))
+
+    async def search_local(self, telegram_id: int, query: str, limit: int) -> List[Dict[str, Any]]:
+        if self.db.fts_enabled:
+            fts_query = _fts_query(telegram_id, query)
+            if fts_query is None:
+                return []
+            rows = await self.db.fetchall(_SQL_SEARCH_FTS, (fts_query, limit))
+        else:
+            pattern = f"%{query}%"
+            rows = await self.db.fetchall(_SQL_SEARCH_LIKE, (telegram_id, pattern, pattern, pattern, limit))
+        return [_row_to_entry(row) for row in rows]
+
+    async def search(self, telegram_id: int, user_data: Dict[str, Any], query: str) -> Tuple[List[Dict[str, Any]], bool]:
+        """
+        Ищет письма пользователя. Возвращает (письма, были ли они найдены только локально).
+        На сервер идёт, только если локальных результатов меньше лимита: письма, которых нет в индексе
+        (старше регистрации, пришедшие при опросе без SyncFolderItems), могут быть любого возраста,
+        поэтому поиск на сервере не ограничивается датой.
+        Ошибки сервера (включая ServerThrottled) не скрываются, если локально ничего не найдено.
+        """
+        limit = self.settings.results
+        results = await self.search_local(telegram_id, query, limit)
+        if len(results) >= limit:
+            return results, True
+
+        try:
+            remote = await search_emails_async(
+                email=user_data["login"],
+                password=user_data["password"],
+                query=query,
+                limit=limit,
+                server=self.config.mail.server,
+                verify_ssl=self.config.mail.verify_ssl,
+            )
+        except Exception as e:
+            if results:
+                logger.warning(f"EWS search failed for user {telegram_id}, returning local results: {e}")
+                return results, True
+            raise
+        # Найденные на сервере письма попадают в индекс: следующий такой поиск будет локальным
+        self.add(telegram_id, remote)
+        known = {mail_dict["id"] for mail_dict in results}
+        results.extend(mail_dict for mail_dict in remote if mail_dict.get("id") not in known)
+        results.sort(key=lambda mail_dict: _to_utc(mail_dict.get("datetime_received")) or datetime.min, reverse=True)
+        return results[:limit], False
@@ -4,12 +4,22 @@ app/services/mail_service.py
 Функции:
 - send_mail(...) -> bool
 - fetch_unread_emails(...) -> list[dict]
+- sync_new_emails(...) -> (list[dict], sync_state) — письма, пришедшие с прошлой синхронизации (с признаком is_read)
+- apply_mail_actions(...) -> dict — пакетные действия с письмами (прочитано/перемещение/удаление)
+- subscribe_new_mail / iter_streaming_new_mail / get_pull_new_mail / unsubscribe_new_mail — push-уведомления EWS
+- invalidate_account(...) — сброс закэшированного подключения пользователя
+- configure_backend(...) — нативный asyncio-клиент (services/ews_client) для опроса и отправки вместо exchangelib
 """
 
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple, Union, BinaryIO, Iterator
+import asyncio
+import hashlib
 import logging
 from pathlib import Path
-import asyncio
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
 
 from exchangelib import (
     Account,
@@ -18,19 +28,50 @@ from exchangelib import (
     Message,
     FileAttachment,
     DELEGATE,
+    EWSDateTime,
+    ExtendedProperty,
 )
+from exchangelib.fields import FieldPath
+from exchangelib.items import ID_ONLY, MOVE_TO_DELETED_ITEMS, SEND_AND_SAVE_COPY
+from exchangelib.properties import CreatedEvent, NewMailEvent
 from exchangelib.protocol import BaseProtocol, NoVerifyHTTPAdapter
+from exchangelib.services import GetAttachment, GetItem
+from exchangelib.util import create_element
+from exchangelib.version import EXCHANGE_2013
+
+from services.ews_client import EWSClient
+from services.executors import BACKGROUND, LaneTimeout, get_lane
+from services import previews
+from services.metrics import EWS_REQUEST_ERRORS, EWS_REQUEST_SECONDS
+from services.throttling import ServerThrottled, get_governor
 
 logger = logging.getLogger(__name__)
 
 
+class OutboxKey(ExtendedProperty):
+    """
+    Ключ идемпотентности письма из очереди outbox, сохраняется в самом письме.
+    По нему повторная попытка находит в «Отправленных» письмо, ответ на отправку которого потерялся.
+    """
+    distinguished_property_set_id = "PublicStrings"
+    property_name = "MailBotOutboxKey"
+    property_type = "String"
+
+
+Message.register("outbox_key", OutboxKey)
+
+
 def _build_account(email: str, password: str, server: str, verify_ssl: bool = True) -> Account:
     """
     Создаёт и возвращает объект exchangelib.Account.
     Если verify_ssl == False — переключаем адаптер, позволяющий игнорировать валидность сертификата (DEV only).
     """
     creds = Credentials(username=email, password=password)
-    config = Configuration(server=server, credentials=creds)
+    if server.startswith(("http://", "https://")):
+        # Полный адрес EWS-эндпоинта (например, локальный сервер из benchmarks/)
+        config = Configuration(service_endpoint=server, credentials=creds)
+    else:
+        config = Configuration(server=server, credentials=creds)
 
     if not verify_ssl:
         # DEV: отключаем проверку сертификатов (внимание: небезопасно)
@@ -47,13 +88,109 @@ def _build_account(email: str, password: str, server: str, verify_ssl: bool = Tr
     return account
 
 
+class _AccountPool:
+    """
+    LRU-кэш живых объектов Account по (login, server).
+    Повторные запросы одного пользователя переиспользуют HTTP-сессию (keep-alive, TLS, NTLM),
+    записи, к которым долго не обращались, закрываются.
+    """
+
+    def __init__(self, maxsize: int = 256, idle_ttl: float = 900):
+        self.maxsize = maxsize
+        self.idle_ttl = idle_ttl
+        # (login, server) -> (account, password, verify_ssl, last_used)
+        self._items: "OrderedDict[Tuple[str, str], Tuple[Account, str, bool, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, email: str, password: str, server: str, verify_ssl: bool) -> Account:
+        key = (email.lower(), server)
+        now = time.monotonic()
+        with self._lock:
+            evicted = self._evict_idle(now)
+            cached = self._items.get(key)
+            if cached is not None:
+                account, cached_password, cached_verify_ssl, _ = cached
+                if cached_password == password and cached_verify_ssl == verify_ssl:
+                    self._items[key] = (account, password, verify_ssl, now)
+                    self._items.move_to_end(key)
+                    self._close(evicted)
+                    return account
+                # Пароль сменился — старое подключение больше не годится
+                evicted.append(self._items.pop(key)[0])
+        self._close(evicted)
+
+        # Создаём Account вне блокировки, чтобы не задерживать другие потоки
+        account = _build_account(email=email, password=password, server=server, verify_ssl=verify_ssl)
+        with self._lock:
+            cached = self._items.get(key)
+            if cached is not None and cached[1] == password and cached[2] == verify_ssl:
+                # Параллельный поток успел создать подключение раньше
+                evicted = [account]
+                account = cached[0]
+            else:
+                evicted = [cached[0]] if cached is not None else []
+            self._items[key] = (account, password, verify_ssl, now)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                evicted.append(self._items.popitem(last=False)[1][0])
+        self._close(evicted)
+        return account
+
+    def invalidate(self, email: str, server: Optional[str] = None):
+        """Удаляет подключения пользователя (на всех серверах, если server не задан)"""
+        login = email.lower()
+        with self._lock:
+            keys = [key for key in self._items if key[0] == login and (server is None or key[1] == server)]
+            evicted = [self._items.pop(key)[0] for key in keys]
+        self._close(evicted)
+
+    def _evict_idle(self, now: float) -> List[Account]:
+        evicted = []
+        # Самые давно использованные записи находятся в начале OrderedDict
+        while self._items:
+            key, (account, _, _, last_used) = next(iter(self._items.items()))
+            if now - last_used < self.idle_ttl:
+                break
+            del self._items[key]
+            evicted.append(account)
+        return evicted
+
+    @staticmethod
+    def _close(accounts: List[Account]):
+        for account in accounts:
+            try:
+                account.protocol.close()
+            except Exception as exc:
+                logger.debug("Failed to close EWS session: %s", exc)
+
+
+_account_pool = _AccountPool()
+
+
+def configure_account_pool(maxsize: int, idle_ttl: float):
+    """Задаёт размер и idle-TTL общего кэша подключений"""
+    _account_pool.maxsize = maxsize
+    _account_pool.idle_ttl = idle_ttl
+
+
+def invalidate_account(email: str, server: Optional[str] = None):
+    """Сбрасывает закэшированное подключение пользователя (например, после смены пароля)"""
+    _account_pool.invalidate(email, server)
+
+
+def on_user_changed(telegram_id: int, fields: Dict[str, Any]):
+    """Подписчик на изменения пользователей в базе: при смене пароля сбрасывает подключение"""
+    if "login" in fields and "password" in fields:
+        invalidate_account(fields["login"])
+
+
 def send_mail(
     email: str,
     password: str,
     to: List[str],
     subject: str,
     body: str,
-    attachments: Optional[List[str]] = None,
+    attachments: Optional[List[Union[str, Tuple[str, BinaryIO]]]] = None,
     server: str = "mail.spbstu.ru",
     verify_ssl: bool = False,
     save_to_sent: bool = True,
@@ -65,41 +202,198 @@ def send_mail(
     :param to: список строк с адресами получателей
     :param subject: тема
     :param body: текст тела письма (plain)
-    :param attachments: список локальных путей к файлам
+    :param attachments: список локальных путей к файлам или пар (имя, файловый объект),
+                        например буферов из services.attachments (читаются один раз, без промежуточных копий)
     :param server: сервер EWS, по умолчанию "mail.spbstu.ru"
     :param verify_ssl: проверять ли SSL-сертификат (если False — отключит проверку; DEV only)
     :param save_to_sent: сохранять копию в папке Sent
     :return: True при успехе, False при ошибке
     """
     try:
-        account = _build_account(email=email, password=password, server=server, verify_ssl=verify_ssl)
+        _send_mail(email, password, to, subject, body, attachments, server, verify_ssl, save_to_sent)
+        return True
+    except Exception as exc:
+        logger.exception("Failed to send email via EWS: %s", exc)
+        return False
+
 
-        folder = account.sent if save_to_sent else None
+def _send_mail(
+    email: str,
+    password: str,
+    to: List[str],
+    subject: str,
+    body: str,
+    attachments: Optional[List[Union[str, Tuple[str, BinaryIO]]]],
+    server: str,
+    verify_ssl: bool,
+    save_to_sent: bool,
+):
+    """send_mail без перехвата ошибок: их разбирает ограничитель запросов"""
+    account = _account_pool.get(email, password, server, verify_ssl)
+
+    folder = account.sent if save_to_sent else None
+    msg = Message(
+        account=account,
+        folder=folder,
+        subject=subject,
+        body=body,
+        to_recipients=to,
+    )
+
+    if attachments:
+        for p in attachments:
+            if isinstance(p, tuple):
+                name, fileobj = p
+                fileobj.seek(0)
+                msg.attach(FileAttachment(name=name, content=fileobj.read()))
+                continue
+            path = Path(p)
+            if not path.exists():
+                logger.warning("Attachment not found, skipping: %s", p)
+                continue
+            content = path.read_bytes()
+            msg.attach(FileAttachment(name=path.name, content=content))
+
+    # send_and_save() — отправляет и сохраняет (если folder задан)
+    msg.send_and_save()
+    logger.info("Email sent: subject=%s to=%s", subject, to)
+
+
+def send_mail_batch(
+    email: str,
+    password: str,
+    messages: List[Dict[str, Any]],
+    server: str = "mail.spbstu.ru",
+    verify_ssl: bool = True,
+    check_sent: bool = False,
+) -> Dict[str, Optional[str]]:
+    """
+    Отправляет несколько писем одной учётной записи одним запросом CreateItem (SendAndSaveCopy).
+    :param messages: список {"key", "to", "subject", "body", "attachments": [(имя, файловый объект), ...]}
+    :param check_sent: прошлая попытка могла дойти до сервера — сначала ищем письма с теми же ключами
+                       в «Отправленных» и не отправляем их повторно
+    :return: ключ -> None (отправлено) или текст ошибки сервера для этого письма.
+             Ошибка всего запроса (сеть, авторизация, перегрузка) пробрасывается.
+    """
+    account = _account_pool.get(email, password, server, verify_ssl)
+    results: Dict[str, Optional[str]] = {}
+    if check_sent:
+        keys = [m["key"] for m in messages]
+        for item in account.sent.filter(outbox_key__in=keys).only("outbox_key"):
+            results[item.outbox_key] = None
+        if results:
+            logger.info("Found %d already sent outbox messages for %s", len(results), email)
+
+    pending = [m for m in messages if m["key"] not in results]
+    items = []
+    for m in pending:
         msg = Message(
             account=account,
-            folder=folder,
-            subject=subject,
-            body=body,
-            to_recipients=to,
+            folder=account.sent,
+            subject=m["subject"],
+            body=m["body"],
+            to_recipients=m["to"],
+            outbox_key=m["key"],
         )
+        for name, fileobj in m.get("attachments") or []:
+            fileobj.seek(0)
+            msg.attach(FileAttachment(name=name, content=fileobj.read()))
+        items.append(msg)
+    if items:
+        created = account.bulk_create(folder=account.sent, items=items, message_disposition=SEND_AND_SAVE_COPY)
+        for m, result in zip(pending, created):
+            results[m["key"]] = str(result) if isinstance(result, Exception) else None
+    logger.info("Sent %d outbox messages for %s in one request", len(items), email)
+    return results
 
-        if attachments:
-            for p in attachments:
-                path = Path(p)
-                if not path.exists():
-                    logger.warning("Attachment not found, skipping: %s", p)
-                    continue
-                content = path.read_bytes()
-                msg.attach(FileAttachment(name=path.name, content=content))
-
-        # send_and_save() — отправляет и сохраняет (если folder задан)
-        msg.send_and_save()
-        logger.info("Email sent: subject=%s to=%s", subject, to)
-        return True
 
-    except Exception as exc:
-        logger.exception("Failed to send email via EWS: %s", exc)
-        return False
+# Поля, которые нужны для уведомления о письме
+_HEADER_FIELDS = ("subject", "sender", "datetime_received", "has_attachments", "is_read")
+
+
+def _item_to_entry(item, attachments: Optional[List[Dict[str, Any]]] = None, preview: Optional[str] = None) -> Dict[str, Any]:
+    """Преобразует письмо exchangelib в словарь, который используют уведомления"""
+    entry = {
+        "id": getattr(item, "item_id", None) or getattr(item, "id", None),
+        "changekey": getattr(item, "changekey", None),
+        "subject": item.subject,
+        "from": (item.sender.email_address if getattr(item, "sender", None) else None),
+        "datetime_received": getattr(item, "datetime_received", None),
+        "has_attachments": bool(getattr(item, "has_attachments", False)),
+        "attachments": attachments or [],
+    }
+    if preview is not None:
+        entry["preview"] = preview
+    return entry
+
+
+class _TextBodyGetItem(GetItem):
+    """GetItem, который возвращает тело письма текстом (не HTML) и не длиннее max_body_size символов"""
+
+    def __init__(self, *args, max_body_size: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_body_size = max_body_size
+
+    def get_payload(self, items, additional_fields, shape):
+        payload = super().get_payload(items=items, additional_fields=additional_fields, shape=shape)
+        # Порядок в ItemShape задан схемой: BaseShape, BodyType, ..., MaximumBodySize, AdditionalProperties
+        shape_elem = payload[0]
+        body_type = create_element("t:BodyType")
+        body_type.text = "Text"
+        shape_elem.insert(1, body_type)
+        if self.max_body_size and self.account.version.build >= EXCHANGE_2013:
+            max_size = create_element("t:MaximumBodySize")
+            max_size.text = str(self.max_body_size)
+            shape_elem.insert(2, max_size)
+        return payload
+
+
+def _fetch_details(account: Account, items, with_previews: bool = False) -> Tuple[Dict[str, List[Dict[str, Any]]], Dict[str, str]]:
+    """
+    Получает имена и размеры вложений (и превью текста, если with_previews и превью включены)
+    всех писем одним пакетным GetItem вместо ленивого запроса на каждое письмо.
+    Содержимое вложений не скачивается; тело запрашивается только у писем, превью которых нет в кэше.
+    :return: (id письма -> [ {"name":..., "size":...}, ... ], id письма -> превью)
+    """
+    previews_out: Dict[str, str] = {}
+    need_body = set()
+    if with_previews and previews.enabled():
+        for item in items:
+            cached = previews.get_preview(item.id)
+            if cached is None:
+                need_body.add(item.id)
+            else:
+                previews_out[item.id] = cached
+
+    ids = [
+        (item.id, item.changekey) for item in items
+        if getattr(item, "has_attachments", False) or item.id in need_body
+    ]
+    if not ids:
+        return {}, previews_out
+
+    if need_body:
+        fields = {FieldPath(field=Message.get_field_by_fieldname(name)) for name in ("attachments", "body")}
+        fetched_items = _TextBodyGetItem(account=account, max_body_size=previews.body_size()).call(
+            items=ids, additional_fields=fields, shape=ID_ONLY
+        )
+    else:
+        fetched_items = account.fetch(ids=ids, only_fields=["attachments"])
+
+    attachments: Dict[str, List[Dict[str, Any]]] = {}
+    for fetched in fetched_items:
+        if isinstance(fetched, Exception):
+            # Письмо могли удалить между запросами — просто пропускаем
+            logger.warning("Failed to fetch attachments metadata or preview: %s", fetched)
+            continue
+        # FileAttachment имеет атрибут name и size (size может быть отсутствовать)
+        attachments[fetched.id] = [
+            {"name": getattr(att, "name", None), "size": getattr(att, "size", None)}
+            for att in (fetched.attachments or [])
+        ]
+        if fetched.id in need_body:
+            previews_out[fetched.id] = previews.save_preview(fetched.id, getattr(fetched, "body", None))
+    return attachments, previews_out
 
 
 def fetch_unread_emails(
@@ -124,53 +418,451 @@ def fetch_unread_emails(
     :param email: адрес электронной почты
     :param password: пароль
     :param limit: максимум N писем (по убыванию datetime_received)
-    :param mark_as_read: пометить письма как прочитанные (save() после изменения)
+    :param mark_as_read: пометить письма как прочитанные (одним пакетным UpdateItem)
     :param server: сервер EWS, по умолчанию "mail.spbstu.ru"
     :param verify_ssl: отключить проверку сертификата (DEV only)
     """
+    try:
+        return _fetch_unread_emails(email, password, limit, mark_as_read, server, verify_ssl)
+    except Exception as exc:
+        logger.exception("Failed to fetch unread emails: %s", exc)
+        return []
+
+
+def _fetch_unread_emails(
+    email: str,
+    password: str,
+    limit: int,
+    mark_as_read: bool,
+    server: str,
+    verify_ssl: bool,
+) -> List[Dict[str, Any]]:
+    """fetch_unread_emails без перехвата ошибок: их разбирает ограничитель запросов"""
+    out: List[Dict[str, Any]] = []
+    account = _account_pool.get(email, password, server, verify_ssl)
+
+    # Фильтр непрочитанных писем
+    # Сначала применяем only() для ограничения полей, затем slice для ограничения количества
+    qs = account.inbox.filter(is_read=False).order_by("-datetime_received").only("subject", "sender", "datetime_received", "has_attachments", "id")[:limit]
+
+    items = list(qs)
+    attachments, item_previews = _fetch_details(account, items, with_previews=True)
+    for item in items:
+        out.append(_item_to_entry(item, attachments.get(item.id), item_previews.get(item.id)))
+
+    if mark_as_read and items:
+        # Один пакетный UpdateItem вместо save() на каждое письмо
+        for item in items:
+            item.is_read = True
+        _raise_first_error(account.bulk_update(items=[(item, ["is_read"]) for item in items]))
+
+    logger.info("Fetched %d unread emails (limit=%d)", len(out), limit)
+    return out
+
+
+def sync_new_emails(
+    email: str,
+    password: str,
+    sync_state: Optional[str] = None,
+    limit: int = 20,
+    server: str = "mail.spbstu.ru",
+    verify_ssl: bool = True,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Инкрементальная синхронизация INBOX через EWS SyncFolderItems.
+    Возвращает письма, появившиеся после sync_state (и непрочитанные, и пришедшие уже прочитанными —
+    их признак в поле is_read), и новое состояние синхронизации.
+    Если изменений нет — это один небольшой запрос.
+    При первом вызове (sync_state is None) запоминает текущее содержимое папки
+    и не возвращает писем, чтобы не присылать уведомления о старой почте.
+    В отличие от fetch_unread_emails, ошибки пробрасываются: состояние не должно сдвигаться при сбое.
+    :param sync_state: состояние, возвращённое предыдущим вызовом
+    :param limit: у скольких самых свежих непрочитанных писем запрашивать вложения и превью; остальные
+                  письма возвращаются только с заголовками (уйдут сводкой или только в индекс поиска),
+                  но не отбрасываются — состояние синхронизации сдвигается за все письма
+    :return: (список словарей в формате fetch_unread_emails плюс is_read, самые свежие первыми; новое sync_state)
+    """
+    account = _account_pool.get(email, password, server, verify_ssl)
+    folder = account.inbox
+
+    if sync_state is None:
+        # Базовая синхронизация: только идентификаторы, без заголовков
+        for _ in folder.sync_items(only_fields=["is_read"]):
+            pass
+        logger.info("Initial mailbox sync completed for %s", email)
+        return [], folder.item_sync_state
+
+    new_items = []
+    for change_type, item in folder.sync_items(sync_state=sync_state, only_fields=list(_HEADER_FIELDS)):
+        if change_type == "create":
+            new_items.append(item)
+
+    new_items.sort(key=lambda i: i.datetime_received or datetime.min.replace(tzinfo=timezone.utc), reverse=True)
+    unread = [item for item in new_items if not getattr(item, "is_read", False)]
+    attachments, item_previews = _fetch_details(account, unread[:limit], with_previews=True)
+    out = [
+        {**_item_to_entry(item, attachments.get(item.id), item_previews.get(item.id)), "is_read": bool(getattr(item, "is_read", False))}
+        for item in new_items
+    ]
+    logger.info("Synced %d new emails for %s", len(out), email)
+    return out, folder.item_sync_state
+
+
+def search_emails(
+    email: str,
+    password: str,
+    query: str,
+    before: Optional[datetime] = None,
+    limit: int = 10,
+    server: str = "mail.spbstu.ru",
+    verify_ssl: bool = True,
+) -> List[Dict[str, Any]]:
+    """
+    Ищет письма во «Входящих» по подстроке темы (без учёта регистра) на сервере.
+    Используется, когда локального индекса заголовков не хватает.
+    :param before: искать только письма, полученные раньше этого момента (UTC)
+    :return: список словарей в формате fetch_unread_emails (самые свежие первыми)
+    """
+    account = _account_pool.get(email, password, server, verify_ssl)
+    qs = account.inbox.filter(subject__icontains=query)
+    if before is not None:
+        qs = qs.filter(datetime_received__lt=EWSDateTime.from_datetime(before.replace(tzinfo=timezone.utc)))
+    items = list(qs.order_by("-datetime_received").only(*_HEADER_FIELDS)[:limit])
+    attachments, _ = _fetch_details(account, items)
+    return [_item_to_entry(item, attachments.get(item.id)) for item in items]
+
+
+def list_attachments(
+    email: str,
+    password: str,
+    items: List[Tuple[str, Optional[str]]],
+    server: str = "mail.spbstu.ru",
+    verify_ssl: bool = True,
+) -> List[Dict[str, Any]]:
+    """
+    Описания файловых вложений писем одним пакетным GetItem (содержимое не скачивается).
+    Вложенные письма (ItemAttachment) пропускаются.
+    :param items: список (item_id, changekey)
+    :return: список {"message_id", "attachment_id", "name", "size", "content_type"};
+             message_id — Internet Message-ID письма, одинаковый у всех получателей рассылки
+    """
+    account = _account_pool.get(email, password, server, verify_ssl)
     out: List[Dict[str, Any]] = []
+    for fetched in account.fetch(ids=items, only_fields=["attachments", "message_id"]):
+        if isinstance(fetched, Exception):
+            logger.warning("Failed to fetch attachments: %s", fetched)
+            continue
+        for att in fetched.attachments or []:
+            if not isinstance(att, FileAttachment):
+                continue
+            out.append({
+                "message_id": getattr(fetched, "message_id", None),
+                "attachment_id": att.attachment_id.id,
+                "name": att.name,
+                "size": att.size,
+                "content_type": att.content_type,
+            })
+    return out
+
+
+def download_attachment(
+    email: str,
+    password: str,
+    attachment_id: str,
+    fileobj: BinaryIO,
+    server: str = "mail.spbstu.ru",
+    verify_ssl: bool = True,
+) -> str:
+    """
+    Потоково записывает содержимое вложения в fileobj (GetAttachment по частям, без загрузки в память целиком).
+    :return: SHA-256 содержимого (hex)
+    """
+    account = _account_pool.get(email, password, server, verify_ssl)
+    digest = hashlib.sha256()
+    for chunk in GetAttachment(account=account).stream_file_content(attachment_id=attachment_id):
+        digest.update(chunk)
+        fileobj.write(chunk)
+    return digest.hexdigest()
+
+
+# Действия с письмами и папки, в которые они перемещают письмо
+MAIL_ACTIONS = ("read", "unread", "junk", "delete")
+_MOVE_TARGETS = {"junk": "junk"}
+
+
+def _raise_first_error(results):
+    """Пакетные методы exchangelib возвращают ошибки в списке результатов — пробрасываем первую"""
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+
+
+def apply_mail_actions(
+    email: str,
+    password: str,
+    actions: Dict[str, List[Tuple[str, Optional[str]]]],
+    server: str = "mail.spbstu.ru",
+    verify_ssl: bool = True,
+) -> Dict[str, int]:
+    """
+    Применяет накопленные действия с письмами пакетно: по одному EWS-запросу на тип действия,
+    независимо от количества писем.
+    :param actions: действие из MAIL_ACTIONS -> список (item_id, changekey)
+    :return: действие -> сколько писем обработано
+    """
+    account = _account_pool.get(email, password, server, verify_ssl)
+    done: Dict[str, int] = {}
+
+    for action in ("read", "unread"):
+        ids = actions.get(action)
+        if not ids:
+            continue
+        items = [
+            (Message(account=account, id=item_id, changekey=changekey, is_read=(action == "read")), ["is_read"])
+            for item_id, changekey in ids
+        ]
+        _raise_first_error(account.bulk_update(items=items))
+        done[action] = len(ids)
+
+    for action, folder_name in _MOVE_TARGETS.items():
+        ids = actions.get(action)
+        if not ids:
+            continue
+        _raise_first_error(account.bulk_move(ids=ids, to_folder=getattr(account, folder_name)))
+        done[action] = len(ids)
+
+    ids = actions.get("delete")
+    if ids:
+        _raise_first_error(account.bulk_delete(ids=ids, delete_type=MOVE_TO_DELETED_ITEMS))
+        done["delete"] = len(ids)
+
+    logger.info("Applied mail actions for %s: %s", email, done)
+    return done
+
+
+# События подписки, означающие появление нового письма во «Входящих»
+_NEW_MAIL_EVENTS = (NewMailEvent, CreatedEvent)
+
+
+def subscribe_new_mail(
+    email: str,
+    password: str,
+    streaming: bool = True,
+    server: str = "mail.spbstu.ru",
+    verify_ssl: bool = True,
+) -> Tuple[str, Optional[str]]:
+    """
+    Создаёт подписку EWS на события папки «Входящие».
+    :param streaming: True — streaming-подписка, False — pull-подписка
+    :return: (subscription_id, watermark); watermark есть только у pull-подписки
+    """
+    account = _account_pool.get(email, password, server, verify_ssl)
+    if streaming:
+        return account.inbox.subscribe_to_streaming(), None
+    subscription_id, watermark = account.inbox.subscribe_to_pull()
+    return subscription_id, watermark
+
+
+def iter_streaming_new_mail(
+    email: str,
+    password: str,
+    subscription_id: str,
+    connection_timeout: int = 30,
+    server: str = "mail.spbstu.ru",
+    verify_ssl: bool = True,
+) -> Iterator[bool]:
+    """
+    Держит открытым соединение GetStreamingEvents до connection_timeout минут (блокирующий вызов).
+    Отдаёт True на каждое уведомление, в котором есть новое письмо.
+    """
+    account = _account_pool.get(email, password, server, verify_ssl)
+    for notification in account.inbox.get_streaming_events(subscription_id, connection_timeout=connection_timeout):
+        if any(isinstance(event, _NEW_MAIL_EVENTS) for event in notification.events):
+            yield True
+
+
+def get_pull_new_mail(
+    email: str,
+    password: str,
+    subscription_id: str,
+    watermark: str,
+    server: str = "mail.spbstu.ru",
+    verify_ssl: bool = True,
+) -> Tuple[bool, str]:
+    """
+    Забирает события pull-подписки (один небольшой запрос GetEvents, если событий мало).
+    :return: (было ли новое письмо, новый watermark)
+    """
+    account = _account_pool.get(email, password, server, verify_ssl)
+    has_new_mail = False
+    # get_events сам запрашивает следующие порции, пока сервер отвечает MoreEvents
+    for notification in account.inbox.get_events(subscription_id, watermark):
+        for event in notification.events:
+            # Новый водяной знак — у последнего события (StatusEvent приходит, даже если событий нет)
+            watermark = event.watermark or watermark
+            if isinstance(event, _NEW_MAIL_EVENTS):
+                has_new_mail = True
+    return has_new_mail, watermark
+
+
+def unsubscribe_new_mail(
+    email: str,
+    password: str,
+    subscription_id: str,
+    server: str = "mail.spbstu.ru",
+    verify_ssl: bool = True,
+):
+    """Отменяет подписку"""
+    account = _account_pool.get(email, password, server, verify_ssl)
+    account.inbox.unsubscribe(subscription_id)
+
+
+# Нативный клиент EWS (MAIL_EWS_BACKEND=aiohttp); None — всё через exchangelib
+_native: Optional[EWSClient] = None
+
+
+def configure_backend(backend: str, connections: int = 100):
+    """Выбирает бэкенд горячих операций: exchangelib (по умолчанию) или aiohttp"""
+    global _native
+    if backend == "aiohttp":
+        _native = EWSClient(connections)
+        logger.info("Using native asyncio EWS client for polling and sending (Basic auth)")
+    elif backend == "exchangelib":
+        _native = None
+    else:
+        raise ValueError(f"Unknown EWS backend: {backend}")
+
+
+async def close_backend():
+    """Закрывает соединения нативного клиента"""
+    if _native is not None:
+        await _native.close()
+
+
+async def _run_ews(operation: str, server: str, func, *args):
+    """
+    Выполняет блокирующий вызов EWS в пуле потоков полосы текущего контекста (interactive / background)
+    через общий ограничитель сервера и записывает его длительность в метрики.
+    Ответ о перегрузке сервера превращается в ServerThrottled, превышение таймаута полосы — в LaneTimeout.
+    """
+    lane = get_lane()
+    return await _guarded(operation, server, lane.name, lambda: lane.run(func, *args))
+
+
+async def _run_native(operation: str, server: str, call):
+    """Как _run_ews, но для корутины нативного клиента: без потока, по таймауту полосы запрос отменяется"""
+    lane = get_lane()
+
+    async def run():
+        try:
+            return await asyncio.wait_for(call(), lane.timeout)
+        except asyncio.TimeoutError:
+            raise LaneTimeout(lane.name, lane.timeout) from None
+
+    return await _guarded(operation, server, lane.name, run)
+
+
+async def _guarded(operation: str, server: str, lane: str, call):
+    """Пропускает вызов EWS любого бэкенда через ограничитель сервера и записывает метрики"""
+    governor = get_governor(server)
+    probe = await governor.acquire(background=lane == BACKGROUND)
+    start = time.perf_counter()
     try:
-        account = _build_account(email=email, password=password, server=server, verify_ssl=verify_ssl)
+        result = await call()
+    except asyncio.TimeoutError:
+        # Таймаут полосы или вызывающего — ответа сервера нет: это ошибка запроса, но не признак живого сервера
+        EWS_REQUEST_ERRORS.inc(operation)
+        if probe:
+            governor.release_probe()
+        raise
+    except Exception as exc:
+        EWS_REQUEST_ERRORS.inc(operation)
+        pause = governor.record(exc, probe)
+        if pause is not None:
+            raise ServerThrottled(server, pause) from exc
+        raise
+    except BaseException:
+        # Отмена — ответа сервера нет, но пробный запрос circuit breaker'а нужно освободить
+        if probe:
+            governor.release_probe()
+        raise
+    finally:
+        EWS_REQUEST_SECONDS.observe(time.perf_counter() - start, operation)
+    governor.record(probe=probe)
+    return result
 
-        # Фильтр непрочитанных писем
-        # Сначала применяем only() для ограничения полей, затем slice для ограничения количества
-        qs = account.inbox.filter(is_read=False).order_by("-datetime_received").only("subject", "sender", "datetime_received", "has_attachments", "id")[:limit]
-
-        for item in qs:
-            entry: Dict[str, Any] = {
-                "id": getattr(item, "item_id", None) or getattr(item, "id", None),
-                "subject": item.subject,
-                "from": (item.sender.email_address if getattr(item, "sender", None) else None),
-                "datetime_received": getattr(item, "datetime_received", None),
-                "has_attachments": bool(getattr(item, "has_attachments", False)),
-                "attachments": [],
-            }
-
-            # Если есть вложения — перечислим имена и размеры (не скачиваем содержимое по-умолчанию)
-            if item.has_attachments:
-                # item.attachments — коллекция вложений
-                for att in item.attachments:
-                    # FileAttachment имеет атрибут name и size (size может быть отсутствовать)
-                    name = getattr(att, "name", None)
-                    size = getattr(att, "size", None)
-                    entry["attachments"].append({"name": name, "size": size})
-
-            out.append(entry)
-
-            if mark_as_read:
-                item.is_read = True
-                item.save(update_fields=["is_read"])
-
-        logger.info("Fetched %d unread emails (limit=%d)", len(out), limit)
-        return out
 
+async def send_mail_async(email: str, password: str, to: List[str], subject: str, body: str, attachments: Optional[List[Union[str, Tuple[str, BinaryIO]]]] = None, server: str = "mail.spbstu.ru", verify_ssl: bool = False, save_to_sent: bool = True) -> bool:
+    """Как send_mail, но при перегрузке сервера бросает ServerThrottled"""
+    try:
+        await _run_ews("send_mail", server, _send_mail, email, password, to, subject, body, attachments, server, verify_ssl, save_to_sent)
+        return True
+    except ServerThrottled:
+        raise
+    except Exception as exc:
+        logger.exception("Failed to send email via EWS: %s", exc)
+        return False
+
+
+async def fetch_unread_emails_async(email: str, password: str, limit: int = 20, mark_as_read: bool = False, server: str = "mail.spbstu.ru", verify_ssl: bool = True, raise_errors: bool = False) -> List[Dict[str, Any]]:
+    """
+    Как fetch_unread_emails, но при перегрузке сервера бросает ServerThrottled.
+    raise_errors=True — пробрасывать и остальные ошибки (например, чтобы не закэшировать пустой список).
+    """
+    try:
+        if _native is not None:
+            return await _run_native("fetch_unread", server, lambda: _native.fetch_unread_emails(email, password, limit, mark_as_read, server, verify_ssl))
+        return await _run_ews("fetch_unread", server, _fetch_unread_emails, email, password, limit, mark_as_read, server, verify_ssl)
+    except ServerThrottled:
+        raise
     except Exception as exc:
+        if raise_errors:
+            raise
         logger.exception("Failed to fetch unread emails: %s", exc)
         return []
 
 
-async def send_mail_async(email: str, password: str, to: List[str], subject: str, body: str, attachments: Optional[List[str]] = None, server: str = "mail.spbstu.ru", verify_ssl: bool = False, save_to_sent: bool = True) -> bool:
-    return await asyncio.to_thread(send_mail, email, password, to, subject, body, attachments, server, verify_ssl, save_to_sent)
+async def sync_new_emails_async(email: str, password: str, sync_state: Optional[str] = None, limit: int = 20, server: str = "mail.spbstu.ru", verify_ssl: bool = True) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    if _native is not None:
+        return await _run_native("sync", server, lambda: _native.sync_new_emails(email, password, sync_state, limit, server, verify_ssl))
+    return await _run_ews("sync", server, sync_new_emails, email, password, sync_state, limit, server, verify_ssl)
+
+
+async def apply_mail_actions_async(email: str, password: str, actions: Dict[str, List[Tuple[str, Optional[str]]]], server: str = "mail.spbstu.ru", verify_ssl: bool = True) -> Dict[str, int]:
+    if _native is not None and {action for action, ids in actions.items() if ids} <= {"read", "unread"}:
+        return await _run_native("apply_actions", server, lambda: _native.apply_mail_actions(email, password, actions, server, verify_ssl))
+    return await _run_ews("apply_actions", server, apply_mail_actions, email, password, actions, server, verify_ssl)
+
+
+async def search_emails_async(email: str, password: str, query: str, before: Optional[datetime] = None, limit: int = 10, server: str = "mail.spbstu.ru", verify_ssl: bool = True) -> List[Dict[str, Any]]:
+    return await _run_ews("search", server, search_emails, email, password, query, before, limit, server, verify_ssl)
 
-async def fetch_unread_emails_async(email: str, password: str, limit: int = 20, mark_as_read: bool = False, server: str = "mail.spbstu.ru", verify_ssl: bool = True) -> List[Dict[str, Any]]:
-    return await asyncio.to_thread(fetch_unread_emails, email, password, limit, mark_as_read, server, verify_ssl)
\ No newline at end of file
+
+async def list_attachments_async(email: str, password: str, items: List[Tuple[str, Optional[str]]], server: str = "mail.spbstu.ru", verify_ssl: bool = True) -> List[Dict[str, Any]]:
+    return await _run_ews("list_attachments", server, list_attachments, email, password, items, server, verify_ssl)
+
+
+async def download_attachment_async(email: str, password: str, attachment_id: str, fileobj: BinaryIO, server: str = "mail.spbstu.ru", verify_ssl: bool = True) -> str:
+    return await _run_ews("download_attachment", server, download_attachment, email, password, attachment_id, fileobj, server, verify_ssl)
+
+
+async def send_mail_batch_async(email: str, password: str, messages: List[Dict[str, Any]], server: str = "mail.spbstu.ru", verify_ssl: bool = True, check_sent: bool = False) -> Dict[str, Optional[str]]:
+    if _native is not None:
+        return await _run_native("send_batch", server, lambda: _native.send_mail_batch(email, password, messages, server, verify_ssl, check_sent))
+    return await _run_ews("send_batch", server, send_mail_batch, email, password, messages, server, verify_ssl, check_sent)
+
+
+async def subscribe_new_mail_async(email: str, password: str, streaming: bool = True, server: str = "mail.spbstu.ru", verify_ssl: bool = True) -> Tuple[str, Optional[str]]:
+    return await _run_ews("subscribe", server, subscribe_new_mail, email, password, streaming, server, verify_ssl)
+
+
+async def get_pull_new_mail_async(email: str, password: str, subscription_id: str, watermark: str, server: str = "mail.spbstu.ru", verify_ssl: bool = True) -> Tuple[bool, str]:
+    return await _run_ews("get_events", server, get_pull_new_mail, email, password, subscription_id, watermark, server, verify_ssl)
+
+
+async def unsubscribe_new_mail_async(email: str, password: str, subscription_id: str, server: str = "mail.spbstu.ru", verify_ssl: bool = True):
+    """Как unsubscribe_new_mail, но ошибки игнорируются — подписка всё равно истечёт сама"""
+    try:
+        await _run_ews("unsubscribe", server, unsubscribe_new_mail, email, password, subscription_id, server, verify_ssl)
+    except Exception as exc:
+        logger.debug("Failed to unsubscribe %s: %s", email, exc)
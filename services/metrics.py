@@ -0,0 +1,215 @@
+"""
+services/metrics.py
+
+Метрики бота в текстовом формате Prometheus.
+Счётчики, gauge и гистограммы — простые объекты в памяти: запись метрики стоит
+одного поиска корзины и нескольких прибавлений, текст формируется только при запросе /metrics.
+Метрики обновляются из потока event loop, поэтому блокировки не нужны.
+"""
+import bisect
+import logging
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Корзины по умолчанию, секунд: от десятков миллисекунд до минут (запросы к EWS и Telegram)
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Корзины для отставания опроса от расписания, секунд
+LAG_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 900, 3600)
+
+_REGISTRY: List["_Metric"] = []
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        _REGISTRY.append(self)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    @abstractmethod
+    def _samples(self) -> List[str]:
+        """Строки значений метрики (без HELP и TYPE)"""
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {value}" for labels, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def set_function(self, function: Callable[[], float]):
+        """Значение вычисляется при каждом запросе метрик (для размеров очередей и т.п.)"""
+        self._function = function
+
+    def _samples(self) -> List[str]:
+        if self._function is not None:
+            try:
+                return [f"{self.name} {self._function()}"]
+            except Exception as e:
+                logger.error(f"Error collecting metric {self.name}: {e}")
+                return []
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {value}" for labels, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # метки -> [количество по корзинам (не накопительное, последняя — +Inf), сумма]
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1][0] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total[0]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    return "\n".join(line for metric in _REGISTRY for line in metric.render()) + "\n"
+
+
+# --- метрики бота ---
+
+EWS_REQUEST_SECONDS = Histogram(
+    "ews_request_duration_seconds", "Duration of EWS operations", ("operation",)
+)
+EWS_REQUEST_ERRORS = Counter(
+    "ews_request_errors_total", "EWS operations that raised an error", ("operation",)
+)
+EWS_THROTTLED = Counter(
+    "ews_throttled_total", "EWS responses that asked to back off (ErrorServerBusy, 429, 503)", ("server",)
+)
+EWS_ADMISSION_REJECTED = Counter(
+    "ews_admission_rejected_total", "EWS calls rejected by the server governor without being sent", ("server",)
+)
+THREADPOOL_BUSY = Gauge(
+    "threadpool_busy_threads", "Blocking EWS calls currently running in a lane thread pool", ("lane",)
+)
+THREADPOOL_SIZE = Gauge(
+    "threadpool_max_threads", "Size of a lane thread pool", ("lane",)
+)
+EWS_LANE_QUEUE_DEPTH = Gauge(
+    "ews_lane_queue_depth", "EWS calls waiting for a free thread in a lane", ("lane",)
+)
+EWS_LANE_WAIT_SECONDS = Histogram(
+    "ews_lane_wait_seconds", "Time EWS calls spent waiting for a free thread in a lane", ("lane",)
+)
+
+POLL_LAG_SECONDS = Histogram(
+    "poll_lag_seconds", "How late a poll started relative to next_poll_at", buckets=LAG_BUCKETS
+)
+POLLS = Counter(
+    "polls_total", "Mailbox polls by outcome (success, rate_limited, backoff)", ("outcome",)
+)
+POLL_NEW_EMAILS = Counter(
+    "poll_new_emails_total", "New emails found by the poller"
+)
+SCHEDULED_USERS = Gauge(
+    "poller_scheduled_users", "Active users known to the poll scheduler"
+)
+
+NOTIFICATION_SEND_SECONDS = Histogram(
+    "notification_send_duration_seconds", "Duration of Telegram sendMessage calls for notifications"
+)
+NOTIFICATIONS = Counter(
+    "notifications_total", "Notification messages by outcome (sent, retry_after, forbidden, error)", ("outcome",)
+)
+NOTIFICATION_QUEUE_DEPTH = Gauge(
+    "notification_queue_depth", "Emails waiting to be delivered as notifications"
+)
+
+ATTACHMENT_DELIVERIES = Counter(
+    "attachment_deliveries_total", "Mail attachments sent to Telegram by source (file_id, cache, download)", ("source",)
+)
+ATTACHMENT_CACHE_BYTES = Gauge(
+    "attachment_cache_bytes", "Size of the on-disk attachment cache"
+)
+
+
+# --- HTTP-эндпоинт ---
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Запускает HTTP-сервер с /metrics; остановка — await runner.cleanup()"""
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Metrics available at http://%s:%d/metrics", host, port)
+    return runner
@@ -0,0 +1,83 @@
+"""
+services/previews.py
+
+Превью текста писем для уведомлений и /check_mail.
+- Тело письма запрашивается тем же пакетным GetItem, что и вложения, текстом (не HTML)
+  и не длиннее body_size() символов — большое письмо не скачивается целиком.
+- Превью хранится в LRU-кэше по id письма: повторные показы (уведомление, затем /check_mail)
+  не запрашивают тело ещё раз.
+- Текст хранится как есть; экранирование для ParseMode.HTML — при выводе.
+Выключено, пока configure_previews не задаст ненулевую длину (MAIL_PREVIEW_CHARS).
+"""
+import re
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# Сколько символов тела запрашивать на каждый символ превью: пробелы и переносы строк схлопываются
+_BODY_SIZE_FACTOR = 2
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+class PreviewCache:
+    """LRU превью по id письма; используется и из потоков exchangelib, поэтому под блокировкой"""
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._items: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, item_id: str) -> Optional[str]:
+        with self._lock:
+            preview = self._items.get(item_id)
+            if preview is not None:
+                self._items.move_to_end(item_id)
+            return preview
+
+    def put(self, item_id: str, preview: str):
+        with self._lock:
+            self._items[item_id] = preview
+            self._items.move_to_end(item_id)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+
+_settings = {"chars": 0}
+_cache = PreviewCache()
+
+
+def configure_previews(chars: int, cache_size: int):
+    """Задаёт длину превью (0 — без превью) и размер кэша (вызывается при старте процесса)"""
+    _settings["chars"] = max(chars, 0)
+    _cache.maxsize = cache_size
+
+
+def enabled() -> bool:
+    return _settings["chars"] > 0
+
+
+def body_size() -> int:
+    """Сколько символов тела письма запрашивать у сервера (MaximumBodySize)"""
+    return _settings["chars"] * _BODY_SIZE_FACTOR
+
+
+def make_preview(text: Optional[str]) -> str:
+    """Первые символы текста в одну строку, с многоточием, если текст обрезан"""
+    chars = _settings["chars"]
+    text = _WHITESPACE.sub(" ", text or "").strip()
+    if len(text) > chars:
+        text = text[:chars].rstrip() + "…"
+    return text
+
+
+def get_preview(item_id: Optional[str]) -> Optional[str]:
+    return _cache.get(item_id) if item_id else None
+
+
+def save_preview(item_id: Optional[str], body: Optional[str]) -> str:
+    """Делает превью из тела письма и запоминает его по id письма"""
+    preview = make_preview(body)
+    if item_id:
+        _cache.put(item_id, preview)
+    return preview
@@ -0,0 +1,259 @@
+"""
+services/throttling.py
+
+Общий для всех пользователей ограничитель запросов к одному EWS-серверу.
+- Token bucket ограничивает частоту запросов к серверу.
+- Circuit breaker открывается, когда сервер отвечает ErrorServerBusy / 429 / 503:
+  пока он открыт, запросы к серверу не отправляются вовсе. Время паузы берётся из ответа
+  сервера (BackOffMilliseconds, Retry-After), иначе растёт экспоненциально.
+- После паузы пропускается один пробный запрос; если он прошёл, частота запросов
+  плавно возвращается к норме за ramp_seconds.
+- Часть запаса токенов (INTERACTIVE_RESERVE) доступна только запросам пользователей:
+  фоновый опрос не может выбрать весь запас, и запрос пользователя не ждёт токена.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from services.metrics import EWS_ADMISSION_REJECTED, EWS_THROTTLED
+
+logger = logging.getLogger(__name__)
+
+# Признаки ответа о перегрузке в тексте ошибки (если у исключения нет явных полей)
+_THROTTLE_MARKERS = ("ErrorServerBusy", "throttl", "Too Many Requests", "Service Unavailable", " 429", " 503")
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+# Доля запаса токенов, которую фоновые запросы не расходуют
+INTERACTIVE_RESERVE = 0.2
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity в запасе"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, reserve: float = 0) -> float:
+        """Сколько секунд ждать до появления токена сверх reserve (0 — токен есть)"""
+        self._refill(time.monotonic())
+        need = 1 + reserve
+        return 0.0 if self.tokens >= need else (need - self.tokens) / self.rate
+
+    def consume(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def is_full(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+class ServerThrottled(Exception):
+    """Сервер перегружен: запрос не отправлялся (или сервер попросил подождать) retry_after секунд"""
+
+    def __init__(self, server: str, retry_after: float):
+        super().__init__(f"EWS server {server} is throttling requests, retry after {retry_after:.0f}s")
+        self.server = server
+        self.retry_after = retry_after
+
+
+def throttle_delay(exc: BaseException) -> Optional[float]:
+    """
+    Если исключение означает перегрузку сервера — пауза, которую просит сервер (0, если не указана).
+    Для остальных ошибок — None.
+    """
+    # exchangelib кладёт BackOffMilliseconds из ErrorServerBusy в back_off (секунды)
+    for attr in ("back_off", "retry_after"):
+        value = getattr(exc, attr, None)
+        if value:
+            return float(value)
+    if getattr(exc, "status_code", None) in (429, 503):
+        return 0.0
+    text = f"{type(exc).__name__} {exc}"
+    if any(marker in text for marker in _THROTTLE_MARKERS):
+        return 0.0
+    return None
+
+
+class EWSGovernor:
+    def __init__(
+        self,
+        server: str,
+        rate: float = 20,
+        burst: float = 20,
+        max_wait: float = 10,
+        backoff: float = 5,
+        max_backoff: float = 300,
+        ramp_seconds: float = 60,
+    ):
+        self.server = server
+        self.rate = rate
+        self.max_wait = max_wait
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.ramp_seconds = ramp_seconds
+        self._bucket = TokenBucket(rate, burst)
+        self.state = CLOSED
+        self._open_until = 0.0
+        self._closed_at = 0.0
+        self._failures = 0
+        self._probing = False
+
+    def blocked_for(self) -> float:
+        """Сколько секунд circuit breaker ещё не пропустит запросы (0 — можно отправлять)"""
+        if self.state == OPEN:
+            return max(self._open_until - time.monotonic(), 0.0)
+        return 0.0
+
+    async def acquire(self, background: bool = False) -> bool:
+        """
+        Ждёт разрешения на запрос. Если ждать пришлось бы дольше max_wait — сразу бросает ServerThrottled,
+        чтобы не держать воркеров и пользователей во время сбоя.
+        background=True — фоновый запрос: не трогает резерв токенов для запросов пользователей.
+        Возвращает True, если запрос пропущен как пробный (после паузы circuit breaker'а).
+        """
+        capacity = self._bucket.capacity
+        # Резерв не больше capacity - 1, иначе фоновым запросам токена не хватит никогда
+        reserve = max(min(capacity * INTERACTIVE_RESERVE, capacity - 1), 0) if background else 0
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            delay = self._admit(reserve)
+            if delay == 0:
+                # В состоянии half-open пропускается только пробный запрос
+                return self.state == HALF_OPEN
+            if time.monotonic() + delay > deadline:
+                EWS_ADMISSION_REJECTED.inc(self.server)
+                raise ServerThrottled(self.server, delay)
+            await asyncio.sleep(delay)
+
+    def _admit(self, reserve: float = 0) -> float:
+        now = time.monotonic()
+        if self.state == OPEN:
+            if now < self._open_until:
+                return self._open_until - now
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            # Пока пробный запрос не вернулся, остальные ждут
+            if self._probing:
+                return 1.0
+            self._probing = True
+            return 0.0
+
+        # После сбоя частота восстанавливается постепенно, начиная с 10%
+        if self._closed_at and now - self._closed_at < self.ramp_seconds:
+            self._bucket.rate = self.rate * max(0.1, (now - self._closed_at) / self.ramp_seconds)
+        else:
+            self._bucket.rate = self.rate
+        delay = self._bucket.delay(reserve)
+        if delay > 0:
+            return delay
+        self._bucket.consume()
+        return 0.0
+
+    def record(self, exc: Optional[BaseException] = None, probe: bool = False) -> Optional[float]:
+        """
+        Учитывает ответ сервера. Возвращает паузу, если сервер перегружен (и открывает circuit breaker),
+        иначе None. Обычные ошибки (неверный пароль и т.п.) считаются ответом живого сервера.
+        probe=True — ответ на пробный запрос (acquire вернул True): только он закрывает circuit breaker.
+        """
+        delay = throttle_delay(exc) if exc is not None else None
+        now = time.monotonic()
+        if delay is None:
+            if self.state == HALF_OPEN and probe:
+                logger.info("EWS server %s recovered, ramping traffic back up", self.server)
+                self.state = CLOSED
+                self._closed_at = now
+            # Запоздалый ответ запроса, отправленного до паузы, не сбрасывает счётчик пауз
+            if self.state == CLOSED:
+                self._probing = False
+                self._failures = 0
+            return None
+
+        EWS_THROTTLED.inc(self.server)
+        if self.state == OPEN:
+            # Ответы запросов, отправленных до открытия, только продлевают паузу
+            self._open_until = max(self._open_until, now + delay)
+            return self._open_until - now
+
+        self._failures += 1
+        pause = min(max(delay, self.backoff * 2 ** (self._failures - 1)), self.max_backoff)
+        self.state = OPEN
+        self._open_until = now + pause
+        self._probing = False
+        logger.warning("EWS server %s is throttling, pausing requests for %.0fs", self.server, pause)
+        return pause
+
+    def release_probe(self):
+        """
+        Пробный запрос завершился без ответа сервера (например, отменён при остановке или по таймауту
+        вызывающего): пробу выполнит следующий запрос, иначе остальные ждали бы её до перезапуска.
+        """
+        if self.state == HALF_OPEN:
+            self._probing = False
+
+    def checkpoint(self) -> Optional[Dict[str, Any]]:
+        """Пауза сервера для сохранения при остановке (None, если сервер не на паузе)"""
+        blocked_for = self.blocked_for()
+        if not blocked_for and not self._failures:
+            return None
+        return {
+            "blocked_until": (datetime.utcnow() + timedelta(seconds=blocked_for)).isoformat(),
+            "failures": self._failures,
+        }
+
+    def restore(self, blocked_until: datetime, failures: int):
+        """Продолжает сохранённую паузу после перезапуска, чтобы не нагрузить сервер заново"""
+        self._failures = max(self._failures, failures)
+        remaining = (blocked_until - datetime.utcnow()).total_seconds()
+        if remaining > 0:
+            self.state = OPEN
+            self._open_until = max(self._open_until, time.monotonic() + remaining)
+            logger.info("EWS server %s is still paused for %.0fs after restart", self.server, remaining)
+
+
+_settings: Dict[str, float] = {}
+_governors: Dict[str, EWSGovernor] = {}
+
+
+def configure_governors(
+    rate: float,
+    burst: float,
+    max_wait: float,
+    backoff: float,
+    max_backoff: float,
+    ramp_seconds: float,
+):
+    """Задаёт параметры ограничителей (вызывается при старте бота)"""
+    _settings.update(
+        rate=rate, burst=burst, max_wait=max_wait, backoff=backoff, max_backoff=max_backoff, ramp_seconds=ramp_seconds
+    )
+    _governors.clear()
+
+
+def governors_checkpoint() -> Dict[str, Dict[str, Any]]:
+    """Паузы всех серверов, которые нужно пережить перезапуск"""
+    states = {server: governor.checkpoint() for server, governor in _governors.items()}
+    return {server: state for server, state in states.items() if state}
+
+
+def restore_governors(states: Dict[str, Dict[str, Any]]):
+    for server, state in states.items():
+        get_governor(server).restore(datetime.fromisoformat(state["blocked_until"]), state.get("failures", 0))
+
+
+def get_governor(server: str) -> EWSGovernor:
+    """Ограничитель для EWS-сервера (один на сервер на процесс)"""
+    governor = _governors.get(server)
+    if governor is None:
+        governor = _governors[server] = EWSGovernor(server, **_settings)
+    return governor
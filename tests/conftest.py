@@ -0,0 +1,52 @@
+"""
+tests/conftest.py
+
+Общие фикстуры: локальный заменитель EWS из benchmarks/fake_ews.py.
+Сервер работает в отдельном потоке со своим event loop, поэтому его можно вызывать
+и из потоков exchangelib, и из asyncio.run() в самом тесте.
+"""
+import asyncio
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.fake_ews import FakeEWS  # noqa: E402
+from services import throttling  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def governors():
+    """Тесты меняют параметры ограничителей EWS: после теста возвращаем прежние и забываем паузы серверов"""
+    settings = dict(throttling._settings)
+    yield
+    throttling._settings.clear()
+    throttling._settings.update(settings)
+    throttling._governors.clear()
+
+
+@pytest.fixture
+def fake_ews():
+    """(FakeEWS, адрес EWS-эндпоинта): ящики без новой почты по времени и без задержки ответа"""
+    ews = FakeEWS(initial_unread=3, mail_rate=0, latency=0, attachment_ratio=0.5)
+    app = web.Application()
+    app.router.add_post("/EWS/Exchange.asmx", ews.handle)
+    runner = web.AppRunner(app, access_log=None)
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", 0).start())
+    host, port = runner.addresses[0][:2]
+    thread = threading.Thread(target=loop.run_forever, name="fake-ews", daemon=True)
+    thread.start()
+    try:
+        yield ews, f"http://{host}:{port}/EWS/Exchange.asmx"
+    finally:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result(10)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(10)
+        loop.close()
@@ -0,0 +1,184 @@
+"""
+tests/test_ews_client.py
+
+Нативный клиент EWS (MAIL_EWS_BACKEND=aiohttp) против локального FakeEWS: вызовы идут через
+асинхронные обёртки mail_service, как из poller'а, обработчиков и очереди outbox.
+"""
+import asyncio
+import io
+
+import pytest
+
+from services.mail_service import (
+    apply_mail_actions_async,
+    close_backend,
+    configure_backend,
+    fetch_unread_emails_async,
+    send_mail_batch_async,
+    sync_new_emails_async,
+)
+from services.throttling import ServerThrottled, configure_governors
+
+LOGIN = "user@bench.local"
+PASSWORD = "secret"
+
+
+@pytest.fixture(autouse=True)
+def native_backend():
+    configure_backend("aiohttp", connections=10)
+    yield
+    configure_backend("exchangelib")
+
+
+def _run(scenario):
+    """Выполняет сценарий в новом event loop и закрывает соединения клиента в нём же"""
+    async def main():
+        try:
+            return await scenario()
+        finally:
+            await close_backend()
+
+    return asyncio.run(main())
+
+
+def test_fetch_unread_reads_headers_and_attachments(fake_ews):
+    ews, url = fake_ews
+    box = ews.mailbox(LOGIN)
+
+    emails = _run(lambda: fetch_unread_emails_async(LOGIN, PASSWORD, server=url, raise_errors=True))
+
+    assert sorted(mail["subject"] for mail in emails) == ["bench 0-0", "bench 0-1", "bench 0-2"]
+    for mail in emails:
+        number = int(mail["subject"].rsplit("-", 1)[1])
+        assert mail["id"] == box.item_id(number)
+        assert mail["from"] == "sender@bench.local"
+        assert mail["has_attachments"] == box.has_attachments(number)
+        # Имена и размеры вложений пришли одним пакетным GetItem
+        assert [att["name"] for att in mail["attachments"]] == (["report.pdf"] if mail["has_attachments"] else [])
+    assert ews.requests["FindItem"] == 1
+    assert ews.requests["GetItem"] == (1 if any(mail["has_attachments"] for mail in emails) else 0)
+
+
+def test_fetch_unread_marks_as_read(fake_ews):
+    ews, url = fake_ews
+
+    async def scenario():
+        first = await fetch_unread_emails_async(LOGIN, PASSWORD, mark_as_read=True, server=url, raise_errors=True)
+        second = await fetch_unread_emails_async(LOGIN, PASSWORD, server=url, raise_errors=True)
+        return first, second
+
+    first, second = _run(scenario)
+    assert len(first) == 3
+    assert second == []
+    assert ews.requests["UpdateItem"] == 1
+    assert ews.mailbox(LOGIN).read == {0, 1, 2}
+
+
+def test_sync_returns_only_new_mail(fake_ews):
+    ews, url = fake_ews
+    box = ews.mailbox(LOGIN)
+
+    async def scenario():
+        # Базовая синхронизация запоминает ящик и ни о чём не уведомляет
+        initial, state = await sync_new_emails_async(LOGIN, PASSWORD, None, server=url)
+        box.deliver(2)
+        new, state = await sync_new_emails_async(LOGIN, PASSWORD, state, server=url)
+        again, _ = await sync_new_emails_async(LOGIN, PASSWORD, state, server=url)
+        return initial, new, again
+
+    initial, new, again = _run(scenario)
+    assert initial == []
+    assert sorted(mail["subject"] for mail in new) == ["bench 0-3", "bench 0-4"]
+    assert not any(mail["is_read"] for mail in new)
+    assert again == []
+
+
+def test_sync_returns_mail_that_arrived_read(fake_ews):
+    ews, url = fake_ews
+    box = ews.mailbox(LOGIN)
+
+    async def scenario():
+        _, state = await sync_new_emails_async(LOGIN, PASSWORD, None, server=url)
+        box.deliver(2)
+        # Письмо прочитали в другом клиенте до опроса: оно нужно индексу поиска, но не уведомлениям
+        box.read.add(3)
+        new, _ = await sync_new_emails_async(LOGIN, PASSWORD, state, server=url)
+        return new
+
+    new = _run(scenario)
+    assert {mail["subject"]: mail["is_read"] for mail in new} == {"bench 0-3": True, "bench 0-4": False}
+
+
+def test_sync_keeps_mail_beyond_limit(fake_ews):
+    ews, url = fake_ews
+    box = ews.mailbox(LOGIN)
+
+    async def scenario():
+        _, state = await sync_new_emails_async(LOGIN, PASSWORD, None, server=url)
+        box.deliver(5)
+        new, _ = await sync_new_emails_async(LOGIN, PASSWORD, state, limit=2, server=url)
+        return new
+
+    # Сверх limit письма не теряются, просто приходят без вложений и превью
+    assert len(_run(scenario)) == 5
+
+
+def test_apply_read_action_updates_items(fake_ews):
+    ews, url = fake_ews
+    box = ews.mailbox(LOGIN)
+    items = [(box.item_id(0), "CQAAAB0"), (box.item_id(2), "CQAAAB2")]
+
+    done = _run(lambda: apply_mail_actions_async(LOGIN, PASSWORD, {"read": items}, server=url))
+
+    assert done == {"read": 2}
+    assert box.read == {0, 2}
+    assert ews.requests["UpdateItem"] == 1
+
+
+def test_send_batch_is_one_create_item_and_retry_finds_sent_mail(fake_ews):
+    ews, url = fake_ews
+    messages = [
+        {"key": "k1", "to": ["a@bench.local"], "subject": "Отчёт", "body": "См. вложение",
+         "attachments": [("report.txt", io.BytesIO(b"report"))]},
+        {"key": "k2", "to": ["b@bench.local"], "subject": "<Привет & пока>", "body": "", "attachments": []},
+    ]
+
+    async def scenario():
+        sent = await send_mail_batch_async(LOGIN, PASSWORD, messages, server=url)
+        # Повтор после потерянного ответа: k1 и k2 уже в «Отправленных», k3 — новое письмо
+        retry = messages + [{"key": "k3", "to": ["c@bench.local"], "subject": "Ещё", "body": "", "attachments": []}]
+        for message in retry:
+            for _, fileobj in message["attachments"]:
+                fileobj.seek(0)
+        resent = await send_mail_batch_async(LOGIN, PASSWORD, retry, server=url, check_sent=True)
+        return sent, resent
+
+    sent, resent = _run(scenario)
+    assert sent == {"k1": None, "k2": None}
+    assert resent == {"k1": None, "k2": None, "k3": None}
+    assert ews.mailbox(LOGIN).sent_keys == {"k1", "k2", "k3"}
+    # Один CreateItem на пакет; при повторе отправлено только письмо, которого нет в «Отправленных»
+    assert ews.requests["CreateItem"] == 2
+    assert ews.requests["FindItem"] == 1
+
+
+def test_server_busy_maps_to_server_throttled(fake_ews):
+    ews, url = fake_ews
+    ews.throttle_rate = 1.0
+    # Ждать конца паузы дольше max_wait нельзя: запрос сразу получает ServerThrottled
+    configure_governors(rate=100, burst=10, max_wait=0.5, backoff=5, max_backoff=300, ramp_seconds=0)
+
+    async def scenario():
+        with pytest.raises(ServerThrottled) as first:
+            await fetch_unread_emails_async(LOGIN, PASSWORD, server=url, raise_errors=True)
+        requests = sum(ews.requests.values())
+        # Circuit breaker открыт: следующий запрос даже не уходит на сервер
+        with pytest.raises(ServerThrottled):
+            await sync_new_emails_async(LOGIN, PASSWORD, "0", server=url)
+        assert sum(ews.requests.values()) == requests
+        return first.value
+
+    throttled = _run(scenario)
+    # Пауза взята из BackOffMilliseconds ответа (FakeEWS просит 1–5 с)
+    assert throttled.retry_after >= 1
+    assert ews.errors["server_busy"] == 1
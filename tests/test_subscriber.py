@@ -0,0 +1,127 @@
+"""
+tests/test_subscriber.py
+
+Subscriber против локального FakeEWS: событие о новом письме будит poller (UserScheduler.poke),
+при неработающей streaming-подписке пользователь переходит на pull, stop() не ждёт паузы цикла,
+запросы подписок соблюдают паузу перегруженного сервера.
+"""
+import asyncio
+import time
+
+import pytest
+
+from app.tasks import subscriber as subscriber_module
+from app.tasks.scheduler import UserScheduler
+from app.tasks.subscriber import PULL, Subscriber
+from config.config import load_config
+from database.database import Database
+from services.throttling import configure_governors, get_governor
+
+TELEGRAM_ID = 1
+LOGIN = "user@bench.local"
+
+
+class _ServerBusy(Exception):
+    """Ответ ErrorServerBusy: exchangelib кладёт BackOffMilliseconds в back_off (секунды)"""
+    back_off = 60
+
+
+@pytest.fixture
+def config(fake_ews, monkeypatch):
+    monkeypatch.setenv("BOT_TOKEN", "123:test")
+    config = load_config()
+    config.mail.server = fake_ews[1]
+    config.subscriptions.enabled = True
+    config.subscriptions.pull_interval = 0.05
+    return config
+
+
+async def _until(condition, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition was not met in time"
+        await asyncio.sleep(0.02)
+
+
+async def _run(tmp_path, config, scenario):
+    """Запускает Subscriber с одним пользователем, выполняет scenario(subscriber, pokes) и останавливает его"""
+    db = Database(str(tmp_path / "users.db"))
+    scheduler = UserScheduler(db)
+    pokes = []
+    poke = scheduler.poke
+    scheduler.poke = lambda telegram_id: (pokes.append(telegram_id), poke(telegram_id))
+    await db.add_user(TELEGRAM_ID, LOGIN, "secret")
+
+    subscriber = Subscriber(db, config, scheduler)
+    task = asyncio.create_task(subscriber.run())
+    try:
+        await scenario(subscriber, pokes)
+    finally:
+        subscriber.stop()
+        await asyncio.wait_for(task, 5)
+        await db.close()
+
+
+def test_new_mail_event_pokes_scheduler(tmp_path, fake_ews, config):
+    ews, _ = fake_ews
+    config.subscriptions.max_streams = 0
+
+    async def scenario(subscriber, pokes):
+        # Подписка создана и уже опрошена: старые письма событий не дают
+        await _until(lambda: ews.requests["GetEvents"] >= 1)
+        assert pokes == []
+        ews.mailbox(LOGIN).deliver()
+        await _until(lambda: pokes)
+        assert pokes[0] == TELEGRAM_ID
+
+    asyncio.run(_run(tmp_path, config, scenario))
+
+
+def test_falls_back_to_pull_when_streaming_fails(tmp_path, fake_ews, config, monkeypatch):
+    ews, _ = fake_ews
+    config.subscriptions.max_streams = 1
+    monkeypatch.setattr(subscriber_module, "STREAM_RETRY_SECONDS", 0)
+
+    async def scenario(subscriber, pokes):
+        await _until(lambda: ews.requests["GetEvents"] >= 1)
+        assert subscriber._modes[TELEGRAM_ID] == PULL
+        # FakeEWS не поддерживает streaming: было MAX_FAILURES попыток, потом pull-подписка
+        assert ews.requests["Subscribe"] == subscriber_module.MAX_FAILURES + 1
+        ews.mailbox(LOGIN).deliver()
+        await _until(lambda: pokes)
+
+    asyncio.run(_run(tmp_path, config, scenario))
+
+
+def test_stop_does_not_wait_for_pull_interval(tmp_path, fake_ews, config):
+    ews, _ = fake_ews
+    config.subscriptions.max_streams = 0
+    config.subscriptions.pull_interval = 30
+
+    async def scenario(subscriber, pokes):
+        # Первый проход только создаёт pull-подписку, дальше цикл ждёт pull_interval
+        await _until(lambda: ews.requests["Subscribe"] >= 1)
+        await asyncio.sleep(0.1)
+
+    started = time.monotonic()
+    asyncio.run(_run(tmp_path, config, scenario))
+    assert time.monotonic() - started < 5
+
+
+def test_pull_waits_while_server_is_throttling(tmp_path, fake_ews, config):
+    ews, url = fake_ews
+    config.subscriptions.max_streams = 0
+    # Запрос не ждёт конца паузы дольше max_wait, а сразу получает ServerThrottled
+    configure_governors(rate=100, burst=10, max_wait=0, backoff=60, max_backoff=60, ramp_seconds=0)
+
+    async def scenario(subscriber, pokes):
+        await _until(lambda: ews.requests["GetEvents"] >= 1)
+        get_governor(url).record(_ServerBusy())
+        requests = ews.requests["GetEvents"]
+        await asyncio.sleep(0.3)
+        # GetEvents идёт через ограничитель сервера: на паузе запросов нет, а подписка не сброшена
+        assert ews.requests["GetEvents"] == requests
+        assert subscriber._modes[TELEGRAM_ID] == PULL
+        assert TELEGRAM_ID in subscriber._pull
+
+    asyncio.run(_run(tmp_path, config, scenario))
@@ -0,0 +1,108 @@
+"""
+tests/test_throttling.py
+
+Circuit breaker EWSGovernor: пробный запрос после паузы, его отмена и таймаут, запоздалые ответы.
+"""
+import asyncio
+
+import pytest
+
+from services.executors import BACKGROUND, LaneTimeout
+from services.mail_service import _guarded
+from services.throttling import CLOSED, HALF_OPEN, OPEN, configure_governors, get_governor
+
+SERVER = "ews.test"
+
+
+class _ServerBusy(Exception):
+    """Ответ ErrorServerBusy: exchangelib кладёт BackOffMilliseconds в back_off (секунды)"""
+    back_off = 0.01
+
+
+@pytest.fixture
+def governor():
+    configure_governors(rate=100, burst=10, max_wait=5, backoff=0.01, max_backoff=0.01, ramp_seconds=0)
+    governor = get_governor(SERVER)
+    governor.record(_ServerBusy())
+    return governor
+
+
+async def _half_open(governor):
+    """Ждёт конца паузы: следующий запрос станет пробным"""
+    await asyncio.sleep(governor.blocked_for() + 0.01)
+
+
+def test_successful_probe_closes_circuit(governor):
+    async def scenario():
+        await _half_open(governor)
+        assert await _guarded("sync", SERVER, BACKGROUND, lambda: asyncio.sleep(0, "ok")) == "ok"
+
+    asyncio.run(scenario())
+    assert governor.state == CLOSED
+
+
+def test_cancelled_probe_lets_next_request_probe(governor):
+    async def scenario():
+        await _half_open(governor)
+        probe_started = asyncio.Event()
+
+        async def hanging_call():
+            probe_started.set()
+            await asyncio.sleep(60)
+
+        probe = asyncio.create_task(_guarded("sync", SERVER, BACKGROUND, hanging_call))
+        await probe_started.wait()
+        assert governor.state == HALF_OPEN
+        # Отмена, как при остановке poller'а или wait_for вызывающего
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+        # Следующий запрос не ждёт отменённую пробу, а сам становится пробным
+        result = await asyncio.wait_for(_guarded("sync", SERVER, BACKGROUND, lambda: asyncio.sleep(0, "ok")), 0.5)
+        assert result == "ok"
+
+    asyncio.run(scenario())
+    assert governor.state == CLOSED
+
+
+def test_cancelled_regular_request_keeps_probe_in_flight(governor):
+    async def scenario():
+        await _half_open(governor)
+        await _guarded("sync", SERVER, BACKGROUND, lambda: asyncio.sleep(0))
+        # Запрос пропущен до новой паузы и всё ещё выполняется
+        request = asyncio.create_task(_guarded("sync", SERVER, BACKGROUND, lambda: asyncio.sleep(60)))
+        await asyncio.sleep(0)
+        governor.record(_ServerBusy())
+        await _half_open(governor)
+        assert await governor.acquire() is True
+
+        request.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await request
+        # Его отмена не освобождает чужую пробу: остальные по-прежнему ждут её результата
+        assert governor._admit() > 0
+
+    asyncio.run(scenario())
+
+
+def test_timed_out_probe_does_not_close_circuit(governor):
+    async def timed_out_call():
+        raise LaneTimeout(BACKGROUND, 120)
+
+    async def scenario():
+        await _half_open(governor)
+        with pytest.raises(LaneTimeout):
+            await _guarded("sync", SERVER, BACKGROUND, timed_out_call)
+        # Ответа сервера не было: circuit breaker не закрыт, пробу выполнит следующий запрос
+        assert governor.state == HALF_OPEN
+        assert await governor.acquire() is True
+
+    asyncio.run(scenario())
+
+
+def test_late_success_keeps_backoff_growing(governor):
+    # Ответ запроса, отправленного до паузы, пришёл, пока сервер на паузе
+    governor.record()
+    assert governor.state == OPEN
+    assert governor._failures == 1